@@ -1,6 +1,7 @@
 from tapiriik.database import db
 from tapiriik.web.email import generate_message_from_template, send_email
 from tapiriik.services import Service
+from tapiriik.sync.activity_record import ActivityRecordStore
 from tapiriik.settings import WITHDRAWN_SERVICES
 from datetime import datetime, timedelta
 import os
@@ -40,10 +41,10 @@ for expired_payment in expired_payments:
 	}
 	subscription_fuzzy_time = [v for k,v in subscription_fuzzy_time_map.items() if k[0] <= subscription_days and k[1] > subscription_days][0]
 
-	activity_records = db.activity_records.find_one({"UserID": connected_user["_id"]})
+	activity_records = ActivityRecordStore.Fetch(connected_user["_id"], ["Distance"])
 	total_distance_synced = None
 	if activity_records:
-		total_distance_synced = sum([x["Distance"] for x in activity_records["Activities"] if x["Distance"]])
+		total_distance_synced = sum([x["Distance"] for x in activity_records if x["Distance"]])
 		total_distance_synced = math.floor(total_distance_synced/1000 / 100) * 100
 
 	context = {
@@ -1,5 +1,6 @@
 from tapiriik.services import Service
 from tapiriik.services.ratelimiting import RateLimit
 
+# Keeps the DB's windows going - RateLimit.Limit falls back on these if Redis isn't configured (or isn't answering)
 for svc in Service.List():
 	RateLimit.Refresh(svc.ID, svc.GlobalRateLimits)
@@ -1,5 +1,7 @@
 from tapiriik.database import db, close_connections
 from tapiriik.settings import RABBITMQ_USER_QUEUE_STATS_URL
+from tapiriik.sync.profiler import percentile
+from tapiriik.services.http_metrics import HTTPMetrics
 from datetime import datetime, timedelta
 import requests
 
@@ -50,6 +52,49 @@ else:
     timeUsed = 0
     avgSyncTime = 0
 
+# scheduler batch claim latency and queue depth (see sync_scheduler.py)
+db.sync_scheduler_stats.remove({"Timestamp": {"$lt": datetime.utcnow() - timedelta(hours=1)}})
+schedulerAgg = list(db.sync_scheduler_stats.aggregate([{"$group": {"_id": None, "batches": {"$sum": "$Batches"}, "claimTime": {"$sum": "$ClaimTime"}, "maxClaimTime": {"$max": "$MaxClaimTime"}, "avgQueueDepth": {"$avg": "$QueueDepth"}, "maxQueueDepth": {"$max": "$QueueDepth"}}}]))
+if schedulerAgg and schedulerAgg[0]["batches"]:
+    schedulerClaimTime = schedulerAgg[0]["claimTime"] / schedulerAgg[0]["batches"]
+    schedulerMaxClaimTime = schedulerAgg[0]["maxClaimTime"]
+else:
+    schedulerClaimTime = schedulerMaxClaimTime = 0
+schedulerQueueDepth = schedulerAgg[0]["avgQueueDepth"] if schedulerAgg else 0
+schedulerMaxQueueDepth = schedulerAgg[0]["maxQueueDepth"] if schedulerAgg else 0
+
+# where sync time goes, per phase and service (see SyncProfiler)
+db.sync_timing_stats.remove({"Timestamp": {"$lt": datetime.utcnow() - timedelta(hours=1)}})
+syncTimingSpans = {}
+for timingRecord in db.sync_timing_stats.find({}, {"Spans": True}):
+    for span in timingRecord["Spans"]:
+        timing = syncTimingSpans.setdefault((span["Phase"], span["Service"]), {"Phase": span["Phase"], "Service": span["Service"], "Count": 0, "Time": 0, "Durations": []})
+        timing["Count"] += span["Count"]
+        timing["Time"] += span["Time"]
+        timing["Durations"] += span["Durations"]
+syncTimings = []
+for timing in sorted(syncTimingSpans.values(), key=lambda x: (x["Phase"], x["Service"] or "")):
+    syncTimings.append({"Phase": timing["Phase"], "Service": timing["Service"], "Count": timing["Count"], "Time": timing["Time"], "P50": percentile(timing["Durations"], 0.5), "P95": percentile(timing["Durations"], 0.95)})
+
+# partner API health - requests, errors, latency and bytes per service (see HTTPMetrics)
+db.http_metrics.remove({"Timestamp": {"$lt": datetime.utcnow() - timedelta(hours=1)}})
+httpServiceCounters = {}
+for metricsRecord in db.http_metrics.find({}, {"Services": True}):
+    for counters in metricsRecord["Services"]:
+        total = httpServiceCounters.setdefault(counters["Service"], {"Service": counters["Service"], "Requests": 0, "Errors": 0, "Retries": 0, "Statuses": {}, "Time": 0, "Latency": [0] * len(counters["Latency"]), "BytesSent": 0, "BytesReceived": 0})
+        for key in ["Requests", "Errors", "Retries", "Time", "BytesSent", "BytesReceived"]:
+            total[key] += counters[key]
+        for status, count in counters["Statuses"].items():
+            total["Statuses"][status] = total["Statuses"].get(status, 0) + count
+        total["Latency"] = [x + y for x, y in zip(total["Latency"], counters["Latency"])]
+httpServices = []
+for counters in sorted(httpServiceCounters.values(), key=lambda x: x["Service"]):
+    counters["AverageTime"] = counters["Time"] / counters["Requests"] if counters["Requests"] else 0
+    counters["RateLimited"] = counters["Statuses"].get("429", 0)
+    counters["P50"] = HTTPMetrics.LatencyPercentile(counters["Latency"], 0.5)
+    counters["P95"] = HTTPMetrics.LatencyPercentile(counters["Latency"], 0.95)
+    httpServices.append(counters)
+
 # error/pending/locked stats
 lockedSyncRecords = list(db.users.aggregate([
                                        {"$match": {"SynchronizationWorker": {"$ne": None}}},
@@ -97,7 +142,11 @@ db.sync_status_stats.insert({
         "TotalErrors": totalErrors,
         "SyncTimeUsed": timeUsed,
         "SyncEnqueueTime": enqueueTime.total_seconds(),
-        "SyncQueueHeadTime": rmq_user_queue_wait_time
+        "SyncQueueHeadTime": rmq_user_queue_wait_time,
+        "SchedulerClaimTime": schedulerClaimTime,
+        "SchedulerMaxClaimTime": schedulerMaxClaimTime,
+        "SchedulerQueueDepth": schedulerQueueDepth,
+        "SchedulerMaxQueueDepth": schedulerMaxQueueDepth
 })
 
 db.stats.update({}, {"$set": {
@@ -109,6 +158,8 @@ db.stats.update({}, {"$set": {
                         "LastHourSynchronizationCount": totalSyncOps,
                         "EnqueueTime": enqueueTime.total_seconds(),
                         "QueueHeadTime": rmq_user_queue_wait_time,
+                        "SyncTimings": syncTimings,
+                        "HTTPServices": httpServices,
                         "Updated": datetime.utcnow() }}, upsert=True)
 
 
@@ -1,9 +1,11 @@
+from tapiriik.settings import SYNC_WORKER_CONCURRENCY
 import os
 import time
 import subprocess
 
 cpulimit_procs = {}
-worker_cpu_limit = int(os.environ.get("TAPIRIIK_WORKER_CPU_LIMIT", 4))
+# Per user being synchronized - a worker can be running several at once
+worker_cpu_limit = int(os.environ.get("TAPIRIIK_WORKER_CPU_LIMIT", 4)) * SYNC_WORKER_CONCURRENCY
 
 while True:
     active_pids = [pid for pid in os.listdir('/proc') if pid.isdigit()] # Sorry, operating systems without procfs
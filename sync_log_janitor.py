@@ -0,0 +1,33 @@
+from tapiriik.settings import USER_SYNC_LOGS, USER_SYNC_LOG_ROTATE_BYTES, USER_SYNC_LOG_BACKUP_COUNT
+from datetime import datetime
+import glob
+import gzip
+import os
+import shutil
+
+# Sync workers only ever append to the per-user sync logs (one write at the end of each sync).
+# This rotates the ones that have grown large - run it from cron on each sync host.
+
+print("Sync log janitor run at %s" % datetime.now())
+
+rotated = 0
+for log_path in glob.glob(USER_SYNC_LOGS + "*.log"):
+    rotating_path = log_path + ".rotating"
+    try:
+        if os.path.getsize(log_path) < USER_SYNC_LOG_ROTATE_BYTES:
+            continue
+        # Moved aside first, so a sync that finishes in the meantime starts a new file instead of writing into the one being compressed
+        os.rename(log_path, rotating_path)
+    except OSError:
+        continue  # Someone beat us to it
+
+    if USER_SYNC_LOG_BACKUP_COUNT:
+        for index in range(USER_SYNC_LOG_BACKUP_COUNT - 1, 0, -1):
+            if os.path.exists("%s.%d.gz" % (log_path, index)):
+                os.replace("%s.%d.gz" % (log_path, index), "%s.%d.gz" % (log_path, index + 1))
+        with open(rotating_path, "rb") as log_file, gzip.open(log_path + ".1.gz", "wb") as archive_file:
+            shutil.copyfileobj(log_file, archive_file)
+    os.remove(rotating_path)
+    rotated += 1
+
+print("Rotated %d logs" % rotated)
@@ -1,5 +1,5 @@
-from tapiriik.database import db, close_connections
-from tapiriik.requests_lib import patch_requests_source_address
+from tapiriik.database import db, redis, close_connections
+from tapiriik.requests_lib import patch_requests_source_address, patch_requests_with_metrics
 from tapiriik.settings import RABBITMQ_BROKER_URL, MONGO_HOST, MONGO_FULL_WRITE_CONCERN
 from tapiriik import settings
 from datetime import datetime
@@ -8,7 +8,10 @@ if isinstance(settings.HTTP_SOURCE_ADDR, list):
     settings.HTTP_SOURCE_ADDR = settings.HTTP_SOURCE_ADDR[0]
     patch_requests_source_address((settings.HTTP_SOURCE_ADDR, 0))
 
+patch_requests_with_metrics()
+
 from tapiriik.services import Service
+from tapiriik.services.http_metrics import HTTPMetrics
 from celery import Celery
 from celery.signals import worker_shutdown
 from datetime import datetime
@@ -17,7 +20,8 @@ class _celeryConfig:
     CELERY_ROUTES = {
         "sync_poll_triggers.trigger_poll": {"queue": "tapiriik-poll"}
     }
-    CELERYD_CONCURRENCY = 1 # Otherwise the GC rate limiting breaks since file locking is per-process.
+    # GC requests are paced through Redis (see RequestPacer) - without it, they'd all be queueing on one lock file anyways
+    CELERYD_CONCURRENCY = settings.POLL_WORKER_CONCURRENCY if redis else 1
     CELERYD_PREFETCH_MULTIPLIER = 1 # The message queue could use some exercise.
 
 celery_app = Celery('sync_poll_triggers', broker=RABBITMQ_BROKER_URL)
@@ -25,14 +29,17 @@ celery_app.config_from_object(_celeryConfig())
 
 @worker_shutdown.connect
 def celery_shutdown(**kwargs):
+    HTTPMetrics.Flush()
     close_connections()
 
 @celery_app.task(acks_late=True)
 def trigger_poll(service_id, index):
     from tapiriik.auth import User
+    from tapiriik.sync import SyncPriority
     print("Polling %s-%d" % (service_id, index))
     svc = Service.FromID(service_id)
-    affected_connection_external_ids = svc.PollPartialSyncTrigger(index)
+    with HTTPMetrics.ServiceContext(svc.ID):
+        affected_connection_external_ids = svc.PollPartialSyncTrigger(index)
     print("Triggering %d connections via %s-%d" % (len(affected_connection_external_ids), service_id, index))
 
     # MONGO_FULL_WRITE_CONCERN because there was a race where users would get picked for synchronization before their service record was updated on the correct secondary
@@ -44,7 +51,7 @@ def trigger_poll(service_id, index):
     trigger_users_query = User.PaidUserMongoQuery()
     trigger_users_query.update({"ConnectedServices.ID": {"$in": affected_connection_ids}})
     trigger_users_query.update({"Config.suppress_auto_sync": {"$ne": True}})
-    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow()}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow(), "NextSyncPriority": SyncPriority.Triggered}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
 
     db.poll_stats.insert({"Service": service_id, "Index": index, "Timestamp": datetime.utcnow(), "TriggerCount": len(affected_connection_external_ids)})
 
@@ -21,6 +21,7 @@ def celery_shutdown(**kwargs):
 @celery_app.task(acks_late=True)
 def trigger_remote(service_id, affected_connection_external_ids):
     from tapiriik.auth import User
+    from tapiriik.sync import SyncPriority
     from tapiriik.services import Service
     svc = Service.FromID(service_id)
     db.connections.update({"Service": svc.ID, "ExternalID": {"$in": affected_connection_external_ids}}, {"$set":{"TriggerPartialSync": True, "TriggerPartialSyncTimestamp": datetime.utcnow()}}, multi=True, w=MONGO_FULL_WRITE_CONCERN)
@@ -29,4 +30,4 @@ def trigger_remote(service_id, affected_connection_external_ids):
     trigger_users_query = User.PaidUserMongoQuery()
     trigger_users_query.update({"ConnectedServices.ID": {"$in": affected_connection_ids}})
     trigger_users_query.update({"Config.suppress_auto_sync": {"$ne": True}})
-    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow()}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow(), "NextSyncPriority": SyncPriority.Triggered}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
@@ -1,5 +1,7 @@
 from tapiriik.database import db
-from tapiriik.sync import Sync
+from tapiriik.messagequeue import mq
+from tapiriik.sync import Sync, SyncPriority
+from tapiriik.settings import SYNC_SCHEDULER_BATCH_SIZE
 from datetime import datetime
 from pymongo.read_preferences import ReadPreference
 import kombu
@@ -8,27 +10,73 @@ import uuid
 
 Sync.InitializeWorkerBindings()
 
-producer = kombu.Producer(Sync._channel, Sync._exchange)
+# Each batch is published in a single transaction - one round trip to commit the lot, instead of waiting on a confirm for every message.
+# (a channel can't do both, so this gets its own connection without publisher confirms)
+publish_channel = mq.clone(transport_options={}).channel()
+publish_channel.tx_select()
+producer = kombu.Producer(publish_channel, Sync._exchange)
 
 while True:
     generation = str(uuid.uuid4())
     queueing_at = datetime.utcnow()
-    users = list(db.users.with_options(read_preference=ReadPreference.PRIMARY).find(
-                {
-                    "NextSynchronization": {"$lte": datetime.utcnow()},
-                    "QueuedAt": {"$exists": False}
-                },
-                {
-                    "_id": True,
-                    "SynchronizationHostRestriction": True
-                }
-            ))
-    scheduled_ids = [x["_id"] for x in users]
-    print("Found %d users at %s" % (len(scheduled_ids), datetime.utcnow()))
-    db.users.update({"_id": {"$in": scheduled_ids}}, {"$set": {"QueuedAt": queueing_at, "QueuedGeneration": generation}, "$unset": {"NextSynchronization": True}}, multi=True)
-    print("Marked %d users as queued at %s" % (len(scheduled_ids), datetime.utcnow()))
-    for user in users:
-        producer.publish({"user_id": str(user["_id"]), "generation": generation}, routing_key=user["SynchronizationHostRestriction"] if "SynchronizationHostRestriction" in user and user["SynchronizationHostRestriction"] else "")
-    print("Scheduled %d users at %s" % (len(scheduled_ids), datetime.utcnow()))
+    scheduled_count = 0
+    claim_times = []
+    publish_times = []
+    lane_counts = dict((priority, 0) for priority in SyncPriority.All)
+    # Users are claimed and published a batch at a time, most overdue first - so a backlog (e.g. after an outage) starts flowing into the queue right away
+    # ...but anyone waiting on a manual or triggered sync is claimed ahead of the backlog
+    for claim_filter in [{"NextSyncPriority": {"$exists": True}}, {}]:
+        while True:
+            claim_start = time.time()
+            claim_query = {
+                "NextSynchronization": {"$lte": datetime.utcnow()},
+                "QueuedAt": {"$exists": False}
+            }
+            claim_query.update(claim_filter)
+            users = list(db.users.with_options(read_preference=ReadPreference.PRIMARY).find(
+                        claim_query,
+                        {
+                            "_id": True,
+                            "SynchronizationHostRestriction": True,
+                            # For Sync.NextSyncPriority
+                            "NextSyncPriority": True,
+                            "NextSyncIsExhaustive": True,
+                            "NonblockingSyncErrorCount": True,
+                            "ForcingExhaustiveSyncErrorCount": True
+                        }
+                    ).sort("NextSynchronization").limit(SYNC_SCHEDULER_BATCH_SIZE))
+            if not len(users):
+                break
+            db.users.update({"_id": {"$in": [x["_id"] for x in users]}}, {"$set": {"QueuedAt": queueing_at, "QueuedGeneration": generation}, "$unset": {"NextSynchronization": True, "NextSyncPriority": True}}, multi=True)
+            claim_times.append(time.time() - claim_start)
+
+            publish_start = time.time()
+            for user in users:
+                priority = Sync.NextSyncPriority(user)
+                lane_counts[priority] += 1
+                producer.publish({"user_id": str(user["_id"]), "generation": generation}, routing_key=user["SynchronizationHostRestriction"] if "SynchronizationHostRestriction" in user and user["SynchronizationHostRestriction"] else Sync.RoutingKey(priority))
+            publish_channel.tx_commit()
+            publish_times.append(time.time() - publish_start)
+
+            scheduled_count += len(users)
+            print("Scheduled batch of %d users at %s" % (len(users), datetime.utcnow()))
+            if len(users) < SYNC_SCHEDULER_BATCH_SIZE:
+                break
+
+    lane_depths = dict((priority, queue.queue_declare(passive=True)[1]) for priority, queue in Sync._priority_queues.items())
+    queue_depth = sum(lane_depths.values())
+    print("Scheduled %d users at %s (%s) - %d in queue (%s)" % (scheduled_count, datetime.utcnow(), lane_counts, queue_depth, lane_depths))
+    # Summarized by stats_cron.py
+    db.sync_scheduler_stats.insert({
+        "Timestamp": datetime.utcnow(),
+        "Users": scheduled_count,
+        "Batches": len(claim_times),
+        "ClaimTime": sum(claim_times),
+        "MaxClaimTime": max(claim_times) if claim_times else 0,
+        "PublishTime": sum(publish_times),
+        "QueueDepth": queue_depth,
+        "LaneUsers": lane_counts,
+        "LaneQueueDepths": lane_depths
+    })
 
     time.sleep(5)
@@ -19,15 +19,18 @@ for worker in db.sync_workers.find({"Host": host}):
         alive = False
 
     # Has it been stalled for too long?
-    if worker["State"] == SyncStep.List:
-        timeout = timedelta(minutes=45)  # This can take a loooooooong time
-    else:
-        timeout = timedelta(minutes=10)  # But everything else shouldn't
-
-    if alive and worker["Heartbeat"] < datetime.utcnow() - timeout:
-        print("%s timed out" % worker)
-        os.kill(worker["Process"], signal.SIGKILL)
-        alive = False
+    # Workers synchronizing several users at once keep a heartbeat for each (idle slots don't count)
+    heartbeats = [worker] + [slot for slot in worker.get("Slots", {}).values() if slot["User"]]
+    for heartbeat in heartbeats:
+        if heartbeat["State"] == SyncStep.List:
+            timeout = timedelta(minutes=45)  # This can take a loooooooong time
+        else:
+            timeout = timedelta(minutes=10)  # But everything else shouldn't
+
+        if alive and heartbeat["Heartbeat"] < datetime.utcnow() - timeout:
+            print("%s timed out" % worker)
+            os.kill(worker["Process"], signal.SIGKILL)
+            alive = False
 
     # Clear it from the database if it's not alive.
     if not alive:
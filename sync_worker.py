@@ -7,22 +7,30 @@ def worker_message(state):
 
 worker_message("booting")
 
-from tapiriik.requests_lib import patch_requests_with_default_timeout, patch_requests_source_address
+from tapiriik.requests_lib import patch_requests_with_default_timeout, patch_requests_source_address, patch_requests_with_metrics
 from tapiriik import settings
 from tapiriik.database import db, close_connections
 from pymongo import ReturnDocument
 import sys
 import subprocess
 import socket
+import resource
 
-RecycleInterval = 2 # Time spent rebooting workers < time spent wrangling Python memory management.
+# Time spent rebooting workers < time spent wrangling Python memory management.
+# So, once the worker has grown past SYNC_WORKER_RECYCLE_RSS_MB it finishes up and exits.
+def should_recycle():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 > settings.SYNC_WORKER_RECYCLE_RSS_MB # (KB on Linux)
 
 oldCwd = os.getcwd()
 WorkerVersion = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, cwd=os.path.dirname(__file__)).communicate()[0].strip()
 os.chdir(oldCwd)
 
-def sync_heartbeat(state, user=None):
-    db.sync_workers.update({"_id": heartbeat_rec_id}, {"$set": {"Heartbeat": datetime.utcnow(), "State": state, "User": user}})
+def sync_heartbeat(state, user=None, slot=None):
+    if slot is None:
+        db.sync_workers.update({"_id": heartbeat_rec_id}, {"$set": {"Heartbeat": datetime.utcnow(), "State": state, "User": user}})
+    else:
+        # Each user being synchronized concurrently gets their own entry - see sync_watchdog.py
+        db.sync_workers.update({"_id": heartbeat_rec_id}, {"$set": {"Heartbeat": datetime.utcnow(), "Slots.%d" % slot: {"Heartbeat": datetime.utcnow(), "State": state, "User": user}}})
 
 worker_message("initialized")
 
@@ -48,6 +56,7 @@ heartbeat_rec = db.sync_workers.find_one_and_update(
 			"Startup":  datetime.utcnow(),
 			"Version": WorkerVersion,
 			"Index": settings.WORKER_INDEX,
+			"Concurrency": settings.SYNC_WORKER_CONCURRENCY,
 			"State": "startup"
 		}
 	}, upsert=True,
@@ -55,6 +64,7 @@ heartbeat_rec = db.sync_workers.find_one_and_update(
 heartbeat_rec_id = heartbeat_rec["_id"]
 
 patch_requests_with_default_timeout(timeout=60)
+patch_requests_with_metrics()
 
 if isinstance(settings.HTTP_SOURCE_ADDR, list):
     settings.HTTP_SOURCE_ADDR = settings.HTTP_SOURCE_ADDR[settings.WORKER_INDEX % len(settings.HTTP_SOURCE_ADDR)]
@@ -72,9 +82,11 @@ sync_heartbeat("ready")
 
 worker_message("ready")
 
-Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion, max_users=RecycleInterval)
+Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion, concurrency=settings.SYNC_WORKER_CONCURRENCY, recycle_check=should_recycle)
 
 worker_message("shutting down cleanly")
+from tapiriik.services.http_metrics import HTTPMetrics
+HTTPMetrics.Flush()
 db.sync_workers.remove({"_id": heartbeat_rec_id})
 close_connections()
 worker_message("shut down")
@@ -0,0 +1,102 @@
+from pymongo.operations import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+import threading
+
+class _BufferedWrite:
+	def __init__(self, collection, request_fn, filter=None, update=None, upsert=False, document=None):
+		self.Collection = collection
+		self._request_fn = request_fn
+		self.Filter = filter
+		self.Update = update
+		self.Upsert = upsert
+		self.Document = document
+		self.ErrorHandlers = []
+
+	def Request(self):
+		if self.Document is not None:
+			return self._request_fn(self.Document)
+		return self._request_fn(self.Filter, self.Update, upsert=self.Upsert)
+
+def _merge_updates(existing, update):
+	merged = dict((op, dict(fields)) for op, fields in existing.items())
+	for op, fields in update.items():
+		if op == "$set":
+			merged.setdefault(op, {}).update(fields)
+		elif op == "$addToSet":
+			target = merged.setdefault(op, {})
+			for field, value in fields.items():
+				values = list(value["$each"]) if type(value) is dict and "$each" in value else [value]
+				if field in target:
+					previous = target[field]
+					values = (list(previous["$each"]) if type(previous) is dict and "$each" in previous else [previous]) + values
+				target[field] = {"$each": values}
+		else:
+			raise ValueError("Can't merge %s updates" % op)
+	return merged
+
+class WriteBuffer:
+	"""
+	Collects small writes and sends them as one unordered bulk_write per collection.
+
+	Updates given the same key are merged into a single update ($set and $addToSet only) - so repeated progress updates or $addToSets on the same document cost one write.
+	Since the writes are unordered, only buffer writes whose relative order doesn't matter.
+	"""
+	def __init__(self, max_operations=100):
+		self._max_operations = max_operations
+		self._pending = []
+		self._keyed = {}
+		self._lock = threading.RLock()
+
+	def __len__(self):
+		return len(self._pending)
+
+	def Insert(self, collection, document):
+		with self._lock:
+			self._pending.append(_BufferedWrite(collection, InsertOne, document=document))
+		self._flush_if_full()
+
+	def Update(self, collection, filter, update, upsert=False, key=None, on_error=None):
+		"""
+		on_error is called with the write error (as found in BulkWriteError.details) if this update fails - returning True marks it as handled.
+		Unhandled errors are raised from Flush() as a BulkWriteError once the rest of the batch has been written.
+		"""
+		with self._lock:
+			keyed_write = self._keyed.get((collection.full_name, key)) if key is not None else None
+			if keyed_write and keyed_write.Filter == filter and keyed_write.Upsert == upsert:
+				keyed_write.Update = _merge_updates(keyed_write.Update, update)
+			else:
+				keyed_write = _BufferedWrite(collection, UpdateOne, filter=filter, update=update, upsert=upsert)
+				self._pending.append(keyed_write)
+				if key is not None:
+					self._keyed[(collection.full_name, key)] = keyed_write
+			if on_error and on_error not in keyed_write.ErrorHandlers:
+				keyed_write.ErrorHandlers.append(on_error)
+		self._flush_if_full()
+
+	def _flush_if_full(self):
+		if len(self._pending) >= self._max_operations:
+			self.Flush()
+
+	def Flush(self):
+		with self._lock:
+			pending = self._pending
+			self._pending = []
+			self._keyed = {}
+
+			by_collection = {}
+			for write in pending:
+				if write.Collection.full_name not in by_collection:
+					by_collection[write.Collection.full_name] = []
+				by_collection[write.Collection.full_name].append(write)
+
+			# The other collections' writes are still sent if one of them fails
+			unhandled = None
+			for writes in by_collection.values():
+				try:
+					writes[0].Collection.bulk_write([x.Request() for x in writes], ordered=False)
+				except BulkWriteError as e:
+					unhandled_errors = [error for error in e.details["writeErrors"] if not any(handler(error) for handler in writes[error["index"]].ErrorHandlers)]
+					if (unhandled_errors or e.details.get("writeConcernErrors")) and not unhandled:
+						unhandled = e
+			if unhandled:
+				raise unhandled
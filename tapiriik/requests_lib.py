@@ -40,3 +40,21 @@ def patch_requests_user_agent(user_agent):
 		kwargs["headers"] = headers
 		return old_request(*args, **kwargs)
 	requests.Session.request = new_request
+
+def patch_requests_with_metrics():
+	# Per-service request counts, status codes, latency and bytes transferred - see HTTPMetrics
+	import requests
+	import time
+	from tapiriik.services.http_metrics import HTTPMetrics
+	old_request = requests.Session.request
+	def new_request(self, method, url, *args, **kwargs):
+		service_id = HTTPMetrics.ServiceFor(self, url)
+		start = time.time()
+		try:
+			response = old_request(self, method, url, *args, **kwargs)
+		except Exception:
+			HTTPMetrics.Record(service_id, None, time.time() - start)
+			raise
+		HTTPMetrics.Record(service_id, response, time.time() - start, stream=kwargs.get("stream", False))
+		return response
+	requests.Session.request = new_request
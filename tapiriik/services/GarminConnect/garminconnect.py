@@ -1,13 +1,16 @@
 from tapiriik.settings import WEB_ROOT, HTTP_SOURCE_ADDR, GARMIN_CONNECT_USER_WATCH_ACCOUNTS
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
 from tapiriik.services.service_record import ServiceRecord
-from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, Location, Lap
+from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Lap, Track
 from tapiriik.services.api import APIException, APIWarning, APIExcludeActivity, UserException, UserExceptionType
 from tapiriik.services.statistic_calculator import ActivityStatisticCalculator
 from tapiriik.services.tcx import TCXIO
 from tapiriik.services.gpx import GPXIO
 from tapiriik.services.fit import FITIO
 from tapiriik.services.sessioncache import SessionCache
+from tapiriik.services.http_metrics import HTTPMetrics
+from tapiriik.services.retry_policy import RetryPolicy
+from tapiriik.services.pacing import RequestPacer
 from tapiriik.services.devices import DeviceIdentifier, DeviceIdentifierType, Device
 from tapiriik.database import cachedb, db
 
@@ -21,8 +24,8 @@ import logging
 import time
 import json
 import re
+import socket
 import random
-import tempfile
 import json
 from urllib.parse import urlencode
 logger = logging.getLogger(__name__)
@@ -94,6 +97,10 @@ class GarminConnectService(ServiceBase):
 
     _sessionCache = SessionCache("garminconnect", lifetime=timedelta(minutes=120), freshen_on_get=True)
     _reauthAttempts = 1 # per request
+    # Server errors are retried (with backoff) whatever the method - that's always been the way with GC
+    HTTPRetryPolicy = RetryPolicy(retries=_reauthAttempts, retry_statuses=(500,))
+    # The watch accounts' feeds seem to fail with a 500 (talking about a timeout) the first time, so keep trying
+    _pollRetryPolicy = RetryPolicy(retries=10, retry_statuses=(500,))
 
     _unitMap = {
         "mph": ActivityStatisticUnit.MilesPerHour,
@@ -128,38 +135,30 @@ class GarminConnectService(ServiceBase):
             cachedb.gc_type_hierarchy.insert({"Hierarchy": rawHierarchy})
         else:
             self._activityHierarchy = json.loads(cachedHierarchy["Hierarchy"])["dictionary"]
-        rate_lock_path = tempfile.gettempdir() + "/gc_rate.%s.lock" % HTTP_SOURCE_ADDR
-        # Ensure the rate lock file exists (...the easy way)
-        open(rate_lock_path, "a").close()
-        self._rate_lock = open(rate_lock_path, "r+")
-
-    def _rate_limit(self):
-        import fcntl, struct, time
-        min_period = 1  # I appear to been banned from Garmin Connect while determining this.
-        fcntl.flock(self._rate_lock,fcntl.LOCK_EX)
-        try:
-            self._rate_lock.seek(0)
-            last_req_start = self._rate_lock.read()
-            if not last_req_start:
-                last_req_start = 0
-            else:
-                last_req_start = float(last_req_start)
-
-            wait_time = max(0, min_period - (time.time() - last_req_start))
-            time.sleep(wait_time)
-
-            self._rate_lock.seek(0)
-            self._rate_lock.write(str(time.time()))
-            self._rate_lock.flush()
-        finally:
-            fcntl.flock(self._rate_lock,fcntl.LOCK_UN)
+        # Shared by the sync and poll workers on every host going out through this address
+        # (unless it's the wildcard address - that's a different address on each host, so each gets its own)
+        pacerScope = "garminconnect:%s" % HTTP_SOURCE_ADDR
+        if HTTP_SOURCE_ADDR in ("0.0.0.0", "::", ""):
+            pacerScope += "@%s" % socket.gethostname()
+        self._pacer = RequestPacer(pacerScope, min_period=1) # I appear to been banned from Garmin Connect while determining this.
+
+    def _rate_limit(self, slot=None):
+        # Pass a slot from self._pacer.Reserve() to only wait out what's left of it
+        if slot:
+            self._pacer.Wait(slot)
+        else:
+            self._pacer.Pace()
 
-    def _request_with_reauth(self, req_lambda, serviceRecord=None, email=None, password=None):
+    def _request_with_reauth(self, req_lambda, serviceRecord=None, email=None, password=None, slot=None):
         for i in range(self._reauthAttempts + 1):
             session = self._get_session(record=serviceRecord, email=email, password=password, skip_cache=i > 0)
-            self._rate_limit()
+            # A reserved slot's only good for the first attempt
+            self._rate_limit(slot if i == 0 else None)
             result = req_lambda(session)
-            if result.status_code not in (403, 500):
+            if result.status_code == 403:
+                if i < self._reauthAttempts:
+                    HTTPMetrics.RecordRetry(self.ID)
+            elif not self.HTTPRetryPolicy.Wait(self.ID, result, i):
                 return result
         # Pass the failed response back any ways - another handler will catch it and provide a nicer error
         return result
@@ -285,16 +284,19 @@ class GarminConnectService(ServiceBase):
                 raise ValueError("Activity type not found in activity hierarchy")
         return self._activityMappings[act_type]
 
-    def DownloadActivityList(self, serviceRecord, exhaustive=False):
+    def IterActivityList(self, serviceRecord, exhaustive=False):
         #http://connect.garmin.com/proxy/activity-search-service-1.0/json/activities?&start=0&limit=50
         page = 1
         pageSz = 100
-        activities = []
-        exclusions = []
+        # Partial listings page through (newest first) until they're past what we've already seen - usually that's somewhere in a much smaller first page
+        highWaterMark = self._listingHighWaterMark(serviceRecord, exhaustive)
+        if highWaterMark:
+            pageSz = 20
+        nextPageSlot = None
         while True:
             logger.debug("Req with " + str({"start": (page - 1) * pageSz, "limit": pageSz}))
 
-            res = self._request_with_reauth(lambda session: session.get("https://connect.garmin.com/modern/proxy/activity-search-service-1.0/json/activities", params={"start": (page - 1) * pageSz, "limit": pageSz}), serviceRecord)
+            res = self._request_with_reauth(lambda session: session.get("https://connect.garmin.com/modern/proxy/activity-search-service-1.0/json/activities", params={"start": (page - 1) * pageSz, "limit": pageSz}), serviceRecord, slot=nextPageSlot)
 
             try:
                 res = res.json()["results"]
@@ -303,6 +305,9 @@ class GarminConnectService(ServiceBase):
                 raise APIException("Parse failure in GC list resp: %s - %s" % (res.status_code, res.text))
             if "activities" not in res:
                 break  # No activities on this page - empty account.
+            # Exhaustive listings always go on to the next page, so its slot can come up while this one's being parsed
+            nextPageSlot = self._pacer.Reserve() if exhaustive and int(res["search"]["totalPages"]) > page else None
+            activities = []
             for act in res["activities"]:
                 act = act["activity"]
                 activity = UploadedActivity()
@@ -358,11 +363,13 @@ class GarminConnectService(ServiceBase):
 
                 activities.append(activity)
             logger.debug("Finished page " + str(page) + " of " + str(res["search"]["totalPages"]))
-            if not exhaustive or int(res["search"]["totalPages"]) == page:
+            yield activities, []
+            if int(res["search"]["totalPages"]) == page:
+                break
+            elif not exhaustive and (not highWaterMark or not activities or min(x.StartTime for x in activities).astimezone(pytz.utc).replace(tzinfo=None) <= highWaterMark):
                 break
             else:
                 page += 1
-        return activities, exclusions
 
     def _downloadActivitySummary(self, serviceRecord, activity):
         activityID = activity.ServiceData["ActivityID"]
@@ -498,46 +505,48 @@ class GarminConnectService(ServiceBase):
                         attrs_map[key]["to_units"] = attrs_map[key]["from_units"] = None
                 attrs_indexed[measurement["metricsIndex"]] = attrs_map[key]
 
-        # Process the data frames
-        frame_idx = 0
+        # Process the data frames - straight into Tracks, these can run to tens of thousands of points
         active_lap_idx = 0
         for frame in raw_data["metrics"]:
-            wp = Waypoint()
+            values = {}
+            has_location = False
+            timestamp_ms = None
             for idx, attr in attrs_indexed.items():
                 value = frame["metrics"][idx]
-                target_obj = wp
-                if attr["in_location"]:
-                    if not wp.Location:
-                        wp.Location = Location()
-                    target_obj = wp.Location
+                has_location = has_location or attr["in_location"]
 
                 # Handle units
                 if attr["is_timestamp"]:
-                    value = pytz.utc.localize(datetime.utcfromtimestamp(value / 1000))
+                    timestamp_ms = value
+                    continue
                 elif attr["to_units"]:
                     value = ActivityStatistic.convertValue(value, attr["from_units"], attr["to_units"])
 
-                # Write the value (can't use __dict__ because __slots__)
-                setattr(target_obj, attr["key"], value)
+                values[attr["key"]] = value
 
             # Fix up lat/lng being zero (which appear to represent missing coords)
-            if wp.Location and wp.Location.Latitude == 0 and wp.Location.Longitude == 0:
-                wp.Location.Latitude = None
-                wp.Location.Longitude = None
+            if values.get("Latitude") == 0 and values.get("Longitude") == 0:
+                values["Latitude"] = values["Longitude"] = None
             # Please visit a physician before complaining about this
-            if wp.HR == 0:
-                wp.HR = None
+            if values.get("HR") == 0:
+                values["HR"] = None
+            timestamp = pytz.utc.localize(datetime.utcfromtimestamp(timestamp_ms / 1000))
             # Bump the active lap if required
             while (active_lap_idx < len(activity.Laps) - 1 and # Not the last lap
-                   activity.Laps[active_lap_idx + 1].StartTime <= wp.Timestamp):
+                   activity.Laps[active_lap_idx + 1].StartTime <= timestamp):
                 active_lap_idx += 1
-            activity.Laps[active_lap_idx].Waypoints.append(wp)
-            frame_idx += 1
+            lap = activity.Laps[active_lap_idx]
+            if lap.Track is None:
+                lap.Track = Track(timestamp)
+                lap_start_ms = timestamp_ms
+            lap.Track.Append((timestamp_ms - lap_start_ms) / 1000, hasLocation=has_location, **values)
 
         return activity
 
     def UploadActivity(self, serviceRecord, activity, activitySource):
         #/proxy/upload-service-1.1/json/upload/.fit
+        # Serializing a long activity takes a while - no reason not to be waiting for the slot at the same time
+        slot = self._pacer.Reserve()
         fit_file = FITIO.Dump(activity)
         files = {"data": ("tap-sync-" + str(os.getpid()) + "-" + activity.UID + ".fit", fit_file)}
 
@@ -545,7 +554,7 @@ class GarminConnectService(ServiceBase):
             lambda session: session.post("https://connect.garmin.com/modern/proxy/upload-service/upload/.fit",
                                          files=files,
                                          headers={"nk": "NT"}),
-            serviceRecord)
+            serviceRecord, slot=slot)
         try:
             res = res.json()["detailedImportResult"]
         except ValueError:
@@ -657,21 +666,21 @@ class GarminConnectService(ServiceBase):
             "password": watch_user["Password"]
         }
 
-        # These seems to fail with a 500 (talkking about a timeout) the first time, so keep trying.
-        SERVER_ERROR_RETRIES = 10
         PAGE_SIZE = 100
         TOTAL_SIZE = 1000
         # Then, check for users with new activities
         watch_activities = []
         for i in range(1, TOTAL_SIZE, PAGE_SIZE):
-            for x in range(SERVER_ERROR_RETRIES):
-                logger.debug("Fetching activity list from %d - attempt %d", i, x)
+            attempt = 0
+            while True:
+                logger.debug("Fetching activity list from %d - attempt %d", i, attempt)
                 watch_activities_resp = self._request_with_reauth(
                     lambda session: session.get("https://connect.garmin.com/modern/proxy/activitylist-service/activities/subscriptionFeed",
                                                 params={"limit": PAGE_SIZE, "start": i}),
                     **sess_args)
-                if watch_activities_resp.status_code != 500:
+                if not self._pollRetryPolicy.Wait(self.ID, watch_activities_resp, attempt):
                     break
+                attempt += 1
             try:
                 watch_activities += watch_activities_resp.json()["activityList"]
             except ValueError:
@@ -694,14 +703,16 @@ class GarminConnectService(ServiceBase):
                 to_sync_ids.append(active_user_rec.ExternalID)
                 active_user_rec.SetConfiguration({"WatchUserLastID": this_active_id, "WatchUserKey": watch_user_key})
 
-        for x in range(SERVER_ERROR_RETRIES):
+        attempt = 0
+        while True:
             self._rate_limit()
-            logger.debug("Fetching connection request list - attempt %d", x)
+            logger.debug("Fetching connection request list - attempt %d", attempt)
             pending_connections_resp = self._request_with_reauth(
                 lambda session: session.get("https://connect.garmin.com/modern/proxy/userprofile-service/connection/pending"),
                 **sess_args)
-            if pending_connections_resp.status_code != 500:
+            if not self._pollRetryPolicy.Wait(self.ID, pending_connections_resp, attempt):
                 break
+            attempt += 1
         try:
             pending_connections = pending_connections_resp.json()
         except ValueError:
@@ -7,7 +7,6 @@ from tapiriik.services.api import APIException, UserException, UserExceptionType
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, WaypointType, Waypoint, Location, Lap
 from tapiriik.database import cachedb
 from datetime import datetime, timedelta
-import requests
 import urllib.parse
 import json
 import logging
@@ -57,7 +56,7 @@ class PulsstoryService(ServiceBase):
         code = req.GET.get("code")
         params = {"code": code, "client_id": PULSSTORY_CLIENT_ID, "client_secret": PULSSTORY_CLIENT_SECRET}
 
-        response = requests.post(self.URLBase + "/ExternalSyncAPI/GenerateToken", data=urllib.parse.urlencode(params), headers={"Content-Type": "application/x-www-form-urlencoded"})
+        response = self._httpSession().post(self.URLBase + "/ExternalSyncAPI/GenerateToken", data=urllib.parse.urlencode(params), headers={"Content-Type": "application/x-www-form-urlencoded"})
         if response.status_code != 200:
             raise APIException("Invalid code")
 
@@ -69,7 +68,7 @@ class PulsstoryService(ServiceBase):
         return (uid, {"Token": token})
 
     def RevokeAuthorization(self, serviceRecord):
-        resp = requests.post(self.URLBase + "/ExternalSyncAPI/Deauthorize", data=self._apiData(serviceRecord))
+        resp = self._httpSession().post(self.URLBase + "/ExternalSyncAPI/Deauthorize", data=self._apiData(serviceRecord))
         if resp.status_code != 204 and resp.status_code != 200:
             raise APIException("Unable to deauthorize pulsstory auth token, status " + str(resp.status_code) + " resp " + resp.text)
         pass
@@ -81,7 +80,7 @@ class PulsstoryService(ServiceBase):
         if hasattr(self, "_uris"):  # cache these for the life of the batch job at least? hope so
             return self._uris
         else:
-            response = requests.post(self.URLBase + "/ExternalSyncAPI/Uris", data=self._apiData(serviceRecord))
+            response = self._httpSession().post(self.URLBase + "/ExternalSyncAPI/Uris", data=self._apiData(serviceRecord))
 
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
@@ -96,7 +95,7 @@ class PulsstoryService(ServiceBase):
             return uris
 
     def _getUserId(self, serviceRecord):
-        resp = requests.post(self.URLBase + "/ExternalSyncAPI/GetUserId", data=self._apiData(serviceRecord))
+        resp = self._httpSession().post(self.URLBase + "/ExternalSyncAPI/GetUserId", data=self._apiData(serviceRecord))
         if resp.status_code != 200:
             raise APIException("Unable to retrieve user id" + str(resp));
         data = resp.json()
@@ -110,7 +109,7 @@ class PulsstoryService(ServiceBase):
         pageUri = uris["fitness_activities"]
 
         while True:
-            response = requests.post(pageUri, data=self._apiData(serviceRecord))
+            response = self._httpSession().post(pageUri, data=self._apiData(serviceRecord))
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
                     raise APIException("No authorization to retrieve activity list", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
@@ -161,7 +160,7 @@ class PulsstoryService(ServiceBase):
     def DownloadActivity(self, serviceRecord, activity):
         activityID = activity.ServiceData["ActivityID"]
 
-        response = requests.post(self.URLBase + activityID, data=self._apiData(serviceRecord))
+        response = self._httpSession().post(self.URLBase + activityID, data=self._apiData(serviceRecord))
         if response.status_code != 200:
             if response.status_code == 401 or response.status_code == 403:
                 raise APIException("No authorization to download activity" + activityID, block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
@@ -273,7 +272,7 @@ class PulsstoryService(ServiceBase):
                 myzip.writestr('activity.txt', jsonData, compress_type=zipfile.ZIP_DEFLATED)
         files = {"data": buffer.getvalue()}
 
-        response = requests.post(uris["upload_activity_zip"], data=data, files=files, headers=headers)
+        response = self._httpSession().post(uris["upload_activity_zip"], data=data, files=files, headers=headers)
         if response.status_code != 200:
             if response.status_code == 401 or response.status_code == 403:
                 raise APIException("No authorization to upload activity " + activity.UID, block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
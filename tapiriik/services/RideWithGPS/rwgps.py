@@ -4,7 +4,6 @@ import dateutil.parser
 
 import pytz
 from dateutil.tz import tzutc
-import requests
 from django.core.urlresolvers import reverse
 
 from tapiriik.settings import WEB_ROOT, RWGPS_APIKEY
@@ -66,7 +65,7 @@ class RideWithGPSService(ServiceBase):
 
     def Authorize(self, email, password):
         from tapiriik.auth.credential_storage import CredentialStore
-        res = requests.get("https://ridewithgps.com/users/current.json",
+        res = self._httpSession().get("https://ridewithgps.com/users/current.json",
                            params={'email': email, 'password': password, 'apikey': RWGPS_APIKEY})
         if res.status_code == 401:
             raise APIException("Invalid login", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
@@ -108,7 +107,7 @@ class RideWithGPSService(ServiceBase):
         # They don't actually support paging right now, for whatever reason
         params = self._add_auth_params({}, record=serviceRecord)
 
-        res = requests.get("https://ridewithgps.com/users/{}/trips.json".format(serviceRecord.ExternalID), params=params)
+        res = self._httpSession().get("https://ridewithgps.com/users/{}/trips.json".format(serviceRecord.ExternalID), params=params)
         res = res.json()
 
         # Apparently some API users are seeing this new result format - I'm not
@@ -183,7 +182,7 @@ class RideWithGPSService(ServiceBase):
             return activity # Nothing more to download - it doesn't serve these files for manually entered activites
         # https://ridewithgps.com/trips/??????.tcx
         activityID = activity.ServiceData["ActivityID"]
-        res = requests.get("https://ridewithgps.com/trips/{}.tcx".format(activityID),
+        res = self._httpSession().get("https://ridewithgps.com/trips/{}.tcx".format(activityID),
                            params=self._add_auth_params({'sub_format': 'history'}, record=serviceRecord))
         try:
             TCXIO.Parse(res.content, activity)
@@ -203,7 +202,7 @@ class RideWithGPSService(ServiceBase):
         if activity.Private:
             params['trip[visibility]'] = 1 # Yes, this logic seems backwards but it's how it works
 
-        res = requests.post("https://ridewithgps.com/trips.json", files=files,
+        res = self._httpSession().post("https://ridewithgps.com/trips.json", files=files,
                             params=self._add_auth_params(params, record=serviceRecord))
         if res.status_code % 100 == 4:
             raise APIException("Invalid login", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
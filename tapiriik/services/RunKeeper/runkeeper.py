@@ -8,7 +8,6 @@ from tapiriik.services.interchange import UploadedActivity, ActivityType, Activi
 from tapiriik.database import cachedb
 from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
-import requests
 import urllib.parse
 import json
 import logging
@@ -59,7 +58,7 @@ class RunKeeperService(ServiceBase):
         if token is None:
             params = {"grant_type": "authorization_code", "code": code, "client_id": RUNKEEPER_CLIENT_ID, "client_secret": RUNKEEPER_CLIENT_SECRET, "redirect_uri": WEB_ROOT + reverse("oauth_return", kwargs={"service": "runkeeper"})}
 
-            response = requests.post("https://runkeeper.com/apps/token", data=urllib.parse.urlencode(params), headers={"Content-Type": "application/x-www-form-urlencoded"})
+            response = self._httpSession().post("https://runkeeper.com/apps/token", data=urllib.parse.urlencode(params), headers={"Content-Type": "application/x-www-form-urlencoded"})
             if response.status_code != 200:
                 raise APIException("Invalid code")
             token = response.json()["access_token"]
@@ -71,7 +70,7 @@ class RunKeeperService(ServiceBase):
         return (uid, {"Token": token})
 
     def RevokeAuthorization(self, serviceRecord):
-        resp = requests.post("https://runkeeper.com/apps/de-authorize", data={"access_token": serviceRecord.Authorization["Token"]})
+        resp = self._httpSession().post("https://runkeeper.com/apps/de-authorize", data={"access_token": serviceRecord.Authorization["Token"]})
         if resp.status_code != 204 and resp.status_code != 200:
             raise APIException("Unable to deauthorize RK auth token, status " + str(resp.status_code) + " resp " + resp.text)
         pass
@@ -84,7 +83,7 @@ class RunKeeperService(ServiceBase):
         if hasattr(self, "_uris"):  # cache these for the life of the batch job at least? hope so
             return self._uris
         else:
-            response = requests.get("https://api.runkeeper.com/user/", headers=self._apiHeaders(serviceRecord))
+            response = self._httpSession().get("https://api.runkeeper.com/user/", headers=self._apiHeaders(serviceRecord))
 
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
@@ -99,7 +98,7 @@ class RunKeeperService(ServiceBase):
             return uris
 
     def _getUserId(self, serviceRecord):
-        resp = requests.get("https://api.runkeeper.com/user/", headers=self._apiHeaders(serviceRecord))
+        resp = self._httpSession().get("https://api.runkeeper.com/user/", headers=self._apiHeaders(serviceRecord))
         data = resp.json()
         return data["userID"]
 
@@ -111,7 +110,7 @@ class RunKeeperService(ServiceBase):
         pageUri = uris["fitness_activities"]
 
         while True:
-            response = requests.get(pageUri, headers=self._apiHeaders(serviceRecord))
+            response = self._httpSession().get(pageUri, headers=self._apiHeaders(serviceRecord))
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
                     raise APIException("No authorization to retrieve activity list", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
@@ -163,7 +162,7 @@ class RunKeeperService(ServiceBase):
         if AGGRESSIVE_CACHE:
             ridedata = cachedb.rk_activity_cache.find_one({"uri": activityID})
         if not AGGRESSIVE_CACHE or ridedata is None:
-            response = requests.get("https://api.runkeeper.com" + activityID, headers=self._apiHeaders(serviceRecord))
+            response = self._httpSession().get("https://api.runkeeper.com" + activityID, headers=self._apiHeaders(serviceRecord))
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
                     raise APIException("No authorization to download activity" + activityID, block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
@@ -231,7 +230,7 @@ class RunKeeperService(ServiceBase):
         uris = self._getAPIUris(serviceRecord)
         headers = self._apiHeaders(serviceRecord)
         headers["Content-Type"] = "application/vnd.com.runkeeper.NewFitnessActivity+json"
-        response = requests.post(uris["fitness_activities"], headers=headers, data=json.dumps(uploadData))
+        response = self._httpSession().post(uris["fitness_activities"], headers=headers, data=json.dumps(uploadData))
 
         if response.status_code != 201:
             if response.status_code == 401 or response.status_code == 403:
@@ -330,6 +329,6 @@ class RunKeeperService(ServiceBase):
 
     def DeleteActivity(self, serviceRecord, uri):
         headers = self._apiHeaders(serviceRecord)
-        del_res = requests.delete("https://api.runkeeper.com/%s" % uri, headers=headers)
+        del_res = self._httpSession().delete("https://api.runkeeper.com/%s" % uri, headers=headers)
         del_res.raise_for_status()
 
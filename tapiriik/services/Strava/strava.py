@@ -10,7 +10,6 @@ from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
 from urllib.parse import urlencode
 import calendar
-import requests
 import os
 import logging
 import pytz
@@ -98,6 +97,11 @@ class StravaService(ServiceBase):
     def _apiHeaders(self, serviceRecord):
         return {"Authorization": "access_token " + serviceRecord.Authorization["OAuthToken"]}
 
+    def _checkRateLimit(self, response):
+        # Whatever's still rate limited after the retry policy's had its go is left for a later sync, rather than treated as a failure
+        if response.status_code == 429:
+            raise APIException("Strava rate limit reached", user_exception=UserException(UserExceptionType.RateLimited))
+
     def RetrieveAuthorizationToken(self, req, level):
         code = req.GET.get("code")
         token = req.GET.get("access_token")
@@ -106,7 +110,7 @@ class StravaService(ServiceBase):
         if token is None:
             params = {"grant_type": "authorization_code", "code": code, "client_id": STRAVA_CLIENT_ID, "client_secret": STRAVA_CLIENT_SECRET, "redirect_uri": WEB_ROOT + reverse("oauth_return", kwargs={"service": "strava"})}
 
-            response = requests.post("https://www.strava.com/oauth/token", data=params)
+            response = self._httpSession().post("https://www.strava.com/oauth/token", data=params)
             if response.status_code != 200:
                 raise APIException("Invalid code")
             data = response.json()
@@ -115,28 +119,31 @@ class StravaService(ServiceBase):
         authorizationData = {"OAuthToken": token}
         if uid is None:
             # Retrieve the user ID, meh.
-            id_resp = requests.get("https://www.strava.com/api/v3/athlete", headers=self._apiHeaders(ServiceRecord({"Authorization": authorizationData})))
+            id_resp = self._httpSession().get("https://www.strava.com/api/v3/athlete", headers=self._apiHeaders(ServiceRecord({"Authorization": authorizationData})))
             uid = id_resp.json()["id"]
         return (uid, authorizationData)
 
     def RevokeAuthorization(self, serviceRecord):
-        resp = requests.post("https://www.strava.com/oauth/deauthorize", headers=self._apiHeaders(serviceRecord))
+        resp = self._httpSession().post("https://www.strava.com/oauth/deauthorize", headers=self._apiHeaders(serviceRecord))
         if resp.status_code != 204 and resp.status_code != 200:
             raise APIException("Unable to deauthorize Strava auth token, status " + str(resp.status_code) + " resp " + resp.text)
         pass
 
-    def DownloadActivityList(self, svcRecord, exhaustive=False):
-        activities = []
-        exclusions = []
+    def IterActivityList(self, svcRecord, exhaustive=False):
         before = earliestDate = None
+        # Partial listings only ask for what's newer than we've already seen (partial listings are a single page, so this doesn't interfere with the before cursor)
+        highWaterMark = self._listingHighWaterMark(svcRecord, exhaustive)
+        after = calendar.timegm(highWaterMark.timetuple()) if highWaterMark else None
 
         while True:
             if before is not None and before < 0:
                 break # Caused by activities that "happened" before the epoch. We generally don't care about those activities...
             logger.debug("Req with before=" + str(before) + "/" + str(earliestDate))
-            resp = requests.get("https://www.strava.com/api/v3/athletes/" + str(svcRecord.ExternalID) + "/activities", headers=self._apiHeaders(svcRecord), params={"before": before})
+            self._globalRateLimit()
+            resp = self._httpSession().get("https://www.strava.com/api/v3/athletes/" + str(svcRecord.ExternalID) + "/activities", headers=self._apiHeaders(svcRecord), params={"before": before, "after": after})
             if resp.status_code == 401:
                 raise APIException("No authorization to retrieve activity list", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
+            self._checkRateLimit(resp)
 
             earliestDate = None
 
@@ -148,6 +155,8 @@ class StravaService(ServiceBase):
             if not len(reqdata):
                 break  # No more activities to see
 
+            activities = []
+            exclusions = []
             for ride in reqdata:
                 activity = UploadedActivity()
                 activity.TZ = pytz.timezone(re.sub("^\([^\)]+\)\s*", "", ride["timezone"]))  # Comes back as "(GMT -13:37) The Stuff/We Want""
@@ -191,11 +200,11 @@ class StravaService(ServiceBase):
                 activity.CalculateUID()
                 activities.append(activity)
 
+            yield activities, exclusions
+
             if not exhaustive or not earliestDate:
                 break
 
-        return activities, exclusions
-
     def SubscribeToPartialSyncTrigger(self, serviceRecord):
         # There is no per-user webhook subscription with Strava.
         serviceRecord.SetPartialSyncTriggerSubscriptionState(True)
@@ -223,9 +232,11 @@ class StravaService(ServiceBase):
             return activity
         activityID = activity.ServiceData["ActivityID"]
 
-        streamdata = requests.get("https://www.strava.com/api/v3/activities/" + str(activityID) + "/streams/time,altitude,heartrate,cadence,watts,temp,moving,latlng,distance,velocity_smooth", headers=self._apiHeaders(svcRecord))
+        self._globalRateLimit()
+        streamdata = self._httpSession().get("https://www.strava.com/api/v3/activities/" + str(activityID) + "/streams/time,altitude,heartrate,cadence,watts,temp,moving,latlng,distance,velocity_smooth", headers=self._apiHeaders(svcRecord))
         if streamdata.status_code == 401:
             raise APIException("No authorization to download activity", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
+        self._checkRateLimit(streamdata)
 
         try:
             streamdata = streamdata.json()
@@ -331,12 +342,15 @@ class StravaService(ServiceBase):
             else:
                 # TODO: put the fit back into PrerenderedFormats once there's more RAM to go around and there's a possibility of it actually being used.
                 fitData = FITIO.Dump(activity, drop_pauses=True)
+            # The upload, and (usually) one status poll - the polls aren't limited themselves, since we can't abandon an upload halfway
+            self._globalRateLimit(count=2)
             files = {"file":("tap-sync-" + activity.UID + "-" + str(os.getpid()) + ("-" + source_svc if source_svc else "") + ".fit", fitData)}
 
-            response = requests.post("https://www.strava.com/api/v3/uploads", data=req, files=files, headers=self._apiHeaders(serviceRecord))
+            response = self._httpSession().post("https://www.strava.com/api/v3/uploads", data=req, files=files, headers=self._apiHeaders(serviceRecord))
             if response.status_code != 201:
                 if response.status_code == 401:
                     raise APIException("No authorization to upload activity " + activity.UID + " response " + response.text + " status " + str(response.status_code), block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
+                self._checkRateLimit(response)
                 if "duplicate of activity" in response.text:
                     logger.debug("Duplicate")
                     self.LastUpload = datetime.now()
@@ -347,7 +361,7 @@ class StravaService(ServiceBase):
             upload_poll_wait = 8 # The mode of processing times
             while not response.json()["activity_id"]:
                 time.sleep(upload_poll_wait)
-                response = requests.get("https://www.strava.com/api/v3/uploads/%s" % upload_id, headers=self._apiHeaders(serviceRecord))
+                response = self._httpSession().get("https://www.strava.com/api/v3/uploads/%s" % upload_id, headers=self._apiHeaders(serviceRecord))
                 logger.debug("Waiting for upload - status %s id %s" % (response.json()["status"], response.json()["activity_id"]))
                 if response.json()["error"]:
                     error = response.json()["error"]
@@ -369,11 +383,13 @@ class StravaService(ServiceBase):
                     "elapsed_time": round((activity.EndTime - activity.StartTime).total_seconds())
                 }
             headers = self._apiHeaders(serviceRecord)
-            response = requests.post("https://www.strava.com/api/v3/activities", data=req, headers=headers)
+            self._globalRateLimit()
+            response = self._httpSession().post("https://www.strava.com/api/v3/activities", data=req, headers=headers)
             # FFR this method returns the same dict as the activity listing, as REST services are wont to do.
             if response.status_code != 201:
                 if response.status_code == 401:
                     raise APIException("No authorization to upload activity " + activity.UID + " response " + response.text + " status " + str(response.status_code), block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
+                self._checkRateLimit(response)
                 raise APIException("Unable to upload stationary activity " + activity.UID + " response " + response.text + " status " + str(response.status_code))
             upload_id = response.json()["id"]
 
@@ -386,5 +402,5 @@ class StravaService(ServiceBase):
 
     def DeleteActivity(self, serviceRecord, uploadId):
         headers = self._apiHeaders(serviceRecord)
-        del_res = requests.delete("https://www.strava.com/api/v3/activities/%d" % uploadId, headers=headers)
+        del_res = self._httpSession().delete("https://www.strava.com/api/v3/activities/%d" % uploadId, headers=headers)
         del_res.raise_for_status()
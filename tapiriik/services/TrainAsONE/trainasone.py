@@ -11,7 +11,6 @@ from datetime import datetime, timedelta
 from urllib.parse import urlencode
 import calendar
 import dateutil.parser
-import requests
 import os
 import logging
 import pytz
@@ -56,18 +55,18 @@ class TrainAsONEService(ServiceBase):
         code = req.GET.get("code")
         params = {"grant_type": "authorization_code", "code": code, "client_id": TRAINASONE_CLIENT_ID, "client_secret": TRAINASONE_CLIENT_SECRET, "redirect_uri": WEB_ROOT + reverse("oauth_return", kwargs={"service": "trainasone"})}
 
-        response = requests.post(TRAINASONE_SERVER_URL + "/oauth/token", data=params)
+        response = self._httpSession().post(TRAINASONE_SERVER_URL + "/oauth/token", data=params)
         if response.status_code != 200:
             raise APIException("Invalid code")
         data = response.json()
 
         authorizationData = {"OAuthToken": data["access_token"]}
 
-        id_resp = requests.get(TRAINASONE_SERVER_URL + "/api/sync/user", headers=self._apiHeaders(authorizationData))
+        id_resp = self._httpSession().get(TRAINASONE_SERVER_URL + "/api/sync/user", headers=self._apiHeaders(authorizationData))
         return (id_resp.json()["id"], authorizationData)
 
     def RevokeAuthorization(self, serviceRecord):
-        resp = requests.post(TRAINASONE_SERVER_URL + "/api/oauth/revoke", data={"token": serviceRecord.Authorization["OAuthToken"]}, headers=self._apiHeaders(serviceRecord.Authorization))
+        resp = self._httpSession().post(TRAINASONE_SERVER_URL + "/api/oauth/revoke", data={"token": serviceRecord.Authorization["OAuthToken"]}, headers=self._apiHeaders(serviceRecord.Authorization))
         if resp.status_code != 204 and resp.status_code != 200:
             raise APIException("Unable to deauthorize TAO auth token, status " + str(resp.status_code) + " resp " + resp.text)
         pass
@@ -78,7 +77,7 @@ class TrainAsONEService(ServiceBase):
         pageUri = TRAINASONE_SERVER_URL + "/api/sync/activities"
 
         while True:
-            response = requests.get(pageUri,  headers=self._apiHeaders(serviceRecord.Authorization))
+            response = self._httpSession().get(pageUri,  headers=self._apiHeaders(serviceRecord.Authorization))
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
                     raise APIException("No authorization to retrieve activity list", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
@@ -118,7 +117,7 @@ class TrainAsONEService(ServiceBase):
         activity_id = activity.ServiceData["id"]
 
 	# Switch URL to /api/sync/activity/fit/ once FITIO.Parse() available
-        resp = requests.get(TRAINASONE_SERVER_URL + "/api/sync/activity/tcx/" + activity_id, headers=self._apiHeaders(serviceRecord.Authorization))
+        resp = self._httpSession().get(TRAINASONE_SERVER_URL + "/api/sync/activity/tcx/" + activity_id, headers=self._apiHeaders(serviceRecord.Authorization))
 
         try:
             TCXIO.Parse(resp.content, activity)
@@ -133,7 +132,7 @@ class TrainAsONEService(ServiceBase):
 
         headers = self._apiHeaders(serviceRecord.Authorization)
         headers['Content-Type'] = 'application/octet-stream'
-        resp = requests.post(TRAINASONE_SERVER_URL + "/api/sync/activity/fit", data=uploaddata, headers=headers)
+        resp = self._httpSession().post(TRAINASONE_SERVER_URL + "/api/sync/activity/fit", data=uploaddata, headers=headers)
 
         if resp.status_code != 200:
             raise APIException(
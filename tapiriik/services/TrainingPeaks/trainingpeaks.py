@@ -8,7 +8,6 @@ from tapiriik.services.sessioncache import SessionCache
 from datetime import datetime, timedelta
 from urllib.parse import urlencode
 import dateutil.parser
-import requests
 import logging
 from io import BytesIO
 import gzip
@@ -67,12 +66,12 @@ class TrainingPeaksService(ServiceBase):
         }
 
         req_url = TRAININGPEAKS_OAUTH_BASE_URL + "/oauth/token"
-        response = requests.post(req_url, data=params)
+        response = self._httpSession().post(req_url, data=params)
         if response.status_code != 200:
             raise APIException("Invalid code")
         auth_data = response.json()
 
-        profile_data = requests.get(TRAININGPEAKS_API_BASE_URL + "/v1/athlete/profile",
+        profile_data = self._httpSession().get(TRAININGPEAKS_API_BASE_URL + "/v1/athlete/profile",
                                     headers={"Authorization": "Bearer %s" % auth_data["access_token"]}).json()
         if type(profile_data) is list and any("is not a valid athlete" in x for x in profile_data):
             raise APIException("TP user is coach account", block=True, user_exception=UserException(UserExceptionType.NonAthleteAccount, intervention_required=True))
@@ -95,7 +94,7 @@ class TrainingPeaksService(ServiceBase):
                 # "redirect_uri": self._redirect_url
             }
             headers = {"Content-Type": "application/x-www-form-urlencoded"}
-            response = requests.post(TRAININGPEAKS_OAUTH_BASE_URL + "/oauth/token", data=urlencode(params), headers=headers)
+            response = self._httpSession().post(TRAININGPEAKS_OAUTH_BASE_URL + "/oauth/token", data=urlencode(params), headers=headers)
             if response.status_code != 200:
                 if response.status_code >= 400 and response.status_code < 500:
                     raise APIException("Could not retrieve refreshed token %s %s" % (response.status_code, response.text), block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
@@ -132,7 +131,7 @@ class TrainingPeaksService(ServiceBase):
 
         while True:
             logger.debug("Requesting %s to %s" % (listStart, listEnd))
-            resp = requests.get(
+            resp = self._httpSession().get(
                 TRAININGPEAKS_API_BASE_URL + "/v1/workouts/%s/%s" % (
                     listStart.strftime(limitDateFormat),
                     listEnd.strftime(limitDateFormat)),
@@ -204,7 +203,7 @@ class TrainingPeaksService(ServiceBase):
             "Data": base64.b64encode(pwxdata_gz.getvalue()).decode("ascii")
         }
 
-        resp = requests.post(TRAININGPEAKS_API_BASE_URL + "/v1/file", data=json.dumps(data), headers=headers)
+        resp = self._httpSession().post(TRAININGPEAKS_API_BASE_URL + "/v1/file", data=json.dumps(data), headers=headers)
         if resp.status_code != 200:
             raise APIException("Unable to upload activity response " + resp.text + " status " + str(resp.status_code))
         return resp.json()[0]["Id"]
@@ -11,7 +11,6 @@ from lxml import etree
 from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
 import dateutil.parser
-import requests
 import time
 import json
 import os
@@ -106,7 +105,7 @@ class VeloHeroService(ServiceBase):
 
         from tapiriik.auth.credential_storage import CredentialStore
 
-        res = requests.post(self._urlRoot + "/sso",
+        res = self._httpSession().post(self._urlRoot + "/sso",
                            params={'user': email, 'pass': password, 'view': 'json'})
 
         if res.status_code != 200:
@@ -167,7 +166,7 @@ class VeloHeroService(ServiceBase):
 
         params.update({"date_from": listStart.strftime(limitDateFormat), "date_to": listEnd.strftime(limitDateFormat)})
         logger.debug("Requesting %s to %s" % (listStart, listEnd))
-        res = requests.get(self._urlRoot + "/export/workouts/json", params=params)
+        res = self._httpSession().get(self._urlRoot + "/export/workouts/json", params=params)
 
         if res.status_code != 200:
           if res.status_code == 403:
@@ -233,7 +232,7 @@ class VeloHeroService(ServiceBase):
         workoutId = activity.ServiceData["workoutId"]
         logger.debug("Download PWX export with ID: " + str(workoutId))
         params = self._add_auth_params({}, record=serviceRecord)
-        res = requests.get(self._urlRoot + "/export/activity/pwx/{}".format(workoutId), params=params)
+        res = self._httpSession().get(self._urlRoot + "/export/activity/pwx/{}".format(workoutId), params=params)
 
         if res.status_code != 200:
           if res.status_code == 403:
@@ -286,7 +285,7 @@ class VeloHeroService(ServiceBase):
         # Upload
         files = {"file": ("tap-sync-" + str(os.getpid()) + "-" + activity.UID + "." + format, data)}
         params = self._add_auth_params({"view":"json"}, record=serviceRecord)
-        res = requests.post(self._urlRoot + "/upload/file", files=files, params=params)
+        res = self._httpSession().post(self._urlRoot + "/upload/file", files=files, params=params)
 
         if res.status_code != 200:
             if res.status_code == 403:
@@ -312,7 +311,7 @@ class VeloHeroService(ServiceBase):
                 "sport_id" : self._activityMappings[activity.Type],
                 "workout_hide": "yes" if activity.Private else "no"
             }, record=serviceRecord)
-            res = requests.get(self._urlRoot + "/workouts/change/{}".format(workoutId), params=params)
+            res = self._httpSession().get(self._urlRoot + "/workouts/change/{}".format(workoutId), params=params)
             if res.status_code != 200:
                 if res.status_code == 403:
                     raise APIException("No authorization to change activity with workout ID: {}".format(workoutId), block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
@@ -459,29 +459,32 @@ class FITIO:
 			if value is not None:
 				dict[key] = value
 
-		_mapStat(session_stats, "total_moving_time", act.Stats.MovingTime.asUnits(ActivityStatisticUnit.Seconds).Value)
-		_mapStat(session_stats, "total_timer_time", act.Stats.TimerTime.asUnits(ActivityStatisticUnit.Seconds).Value)
-		_mapStat(session_stats, "total_distance", act.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value)
-		_mapStat(session_stats, "total_calories", act.Stats.Energy.asUnits(ActivityStatisticUnit.Kilocalories).Value)
-		_mapStat(session_stats, "avg_speed", act.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Average)
-		_mapStat(session_stats, "max_speed", act.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Max)
+		# The units FIT wants these in, converted all at once for the activity and each lap
+		statUnits = {"MovingTime": ActivityStatisticUnit.Seconds, "TimerTime": ActivityStatisticUnit.Seconds, "Distance": ActivityStatisticUnit.Meters, "Energy": ActivityStatisticUnit.Kilocalories, "Speed": ActivityStatisticUnit.MetersPerSecond, "Elevation": ActivityStatisticUnit.Meters, "Temperature": ActivityStatisticUnit.DegreesCelcius}
+		actStats = act.Stats.asUnits(statUnits)
+		_mapStat(session_stats, "total_moving_time", actStats.MovingTime.Value)
+		_mapStat(session_stats, "total_timer_time", actStats.TimerTime.Value)
+		_mapStat(session_stats, "total_distance", actStats.Distance.Value)
+		_mapStat(session_stats, "total_calories", actStats.Energy.Value)
+		_mapStat(session_stats, "avg_speed", actStats.Speed.Average)
+		_mapStat(session_stats, "max_speed", actStats.Speed.Max)
 		_mapStat(session_stats, "avg_heart_rate", act.Stats.HR.Average)
 		_mapStat(session_stats, "max_heart_rate", act.Stats.HR.Max)
 		_mapStat(session_stats, "avg_cadence", _resolveRunCadence(act.Stats.Cadence.Average, act.Stats.RunCadence.Average))
 		_mapStat(session_stats, "max_cadence", _resolveRunCadence(act.Stats.Cadence.Max, act.Stats.RunCadence.Max))
 		_mapStat(session_stats, "avg_power", act.Stats.Power.Average)
 		_mapStat(session_stats, "max_power", act.Stats.Power.Max)
-		_mapStat(session_stats, "total_ascent", act.Stats.Elevation.asUnits(ActivityStatisticUnit.Meters).Gain)
-		_mapStat(session_stats, "total_descent", act.Stats.Elevation.asUnits(ActivityStatisticUnit.Meters).Loss)
-		_mapStat(session_stats, "avg_altitude", act.Stats.Elevation.asUnits(ActivityStatisticUnit.Meters).Average)
-		_mapStat(session_stats, "max_altitude", act.Stats.Elevation.asUnits(ActivityStatisticUnit.Meters).Max)
-		_mapStat(session_stats, "min_altitude", act.Stats.Elevation.asUnits(ActivityStatisticUnit.Meters).Min)
-		_mapStat(session_stats, "avg_temperature", act.Stats.Temperature.asUnits(ActivityStatisticUnit.DegreesCelcius).Average)
-		_mapStat(session_stats, "max_temperature", act.Stats.Temperature.asUnits(ActivityStatisticUnit.DegreesCelcius).Max)
+		_mapStat(session_stats, "total_ascent", actStats.Elevation.Gain)
+		_mapStat(session_stats, "total_descent", actStats.Elevation.Loss)
+		_mapStat(session_stats, "avg_altitude", actStats.Elevation.Average)
+		_mapStat(session_stats, "max_altitude", actStats.Elevation.Max)
+		_mapStat(session_stats, "min_altitude", actStats.Elevation.Min)
+		_mapStat(session_stats, "avg_temperature", actStats.Temperature.Average)
+		_mapStat(session_stats, "max_temperature", actStats.Temperature.Max)
 
 		inPause = False
 		for lap in act.Laps:
-			for wp in lap.Waypoints:
+			for wp in lap.IterWaypoints():
 				if wp.Type == WaypointType.Resume and inPause:
 					fmg.GenerateMessage("event", timestamp=toUtc(wp.Timestamp), event=FITEvent.Timer, event_type=FITEventType.Start)
 					inPause = False
@@ -516,26 +519,27 @@ class FITIO:
 			# Man, I love copy + paste and multi-cursor editing
 			# But seriously, I'm betting that, some time down the road, a stat will pop up in X but not in Y, so I won't feel so bad about the C&P abuse
 			lap_stats = {}
+			lapStats = lap.Stats.asUnits(statUnits)
 			_mapStat(lap_stats, "total_elapsed_time", lap.EndTime - lap.StartTime)
-			_mapStat(lap_stats, "total_moving_time", lap.Stats.MovingTime.asUnits(ActivityStatisticUnit.Seconds).Value)
-			_mapStat(lap_stats, "total_timer_time", lap.Stats.TimerTime.asUnits(ActivityStatisticUnit.Seconds).Value)
-			_mapStat(lap_stats, "total_distance", lap.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value)
-			_mapStat(lap_stats, "total_calories", lap.Stats.Energy.asUnits(ActivityStatisticUnit.Kilocalories).Value)
-			_mapStat(lap_stats, "avg_speed", lap.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Average)
-			_mapStat(lap_stats, "max_speed", lap.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Max)
+			_mapStat(lap_stats, "total_moving_time", lapStats.MovingTime.Value)
+			_mapStat(lap_stats, "total_timer_time", lapStats.TimerTime.Value)
+			_mapStat(lap_stats, "total_distance", lapStats.Distance.Value)
+			_mapStat(lap_stats, "total_calories", lapStats.Energy.Value)
+			_mapStat(lap_stats, "avg_speed", lapStats.Speed.Average)
+			_mapStat(lap_stats, "max_speed", lapStats.Speed.Max)
 			_mapStat(lap_stats, "avg_heart_rate", lap.Stats.HR.Average)
 			_mapStat(lap_stats, "max_heart_rate", lap.Stats.HR.Max)
 			_mapStat(lap_stats, "avg_cadence", _resolveRunCadence(lap.Stats.Cadence.Average, lap.Stats.RunCadence.Average))
 			_mapStat(lap_stats, "max_cadence", _resolveRunCadence(lap.Stats.Cadence.Max, lap.Stats.RunCadence.Max))
 			_mapStat(lap_stats, "avg_power", lap.Stats.Power.Average)
 			_mapStat(lap_stats, "max_power", lap.Stats.Power.Max)
-			_mapStat(lap_stats, "total_ascent", lap.Stats.Elevation.asUnits(ActivityStatisticUnit.Meters).Gain)
-			_mapStat(lap_stats, "total_descent", lap.Stats.Elevation.asUnits(ActivityStatisticUnit.Meters).Loss)
-			_mapStat(lap_stats, "avg_altitude", lap.Stats.Elevation.asUnits(ActivityStatisticUnit.Meters).Average)
-			_mapStat(lap_stats, "max_altitude", lap.Stats.Elevation.asUnits(ActivityStatisticUnit.Meters).Max)
-			_mapStat(lap_stats, "min_altitude", lap.Stats.Elevation.asUnits(ActivityStatisticUnit.Meters).Min)
-			_mapStat(lap_stats, "avg_temperature", lap.Stats.Temperature.asUnits(ActivityStatisticUnit.DegreesCelcius).Average)
-			_mapStat(lap_stats, "max_temperature", lap.Stats.Temperature.asUnits(ActivityStatisticUnit.DegreesCelcius).Max)
+			_mapStat(lap_stats, "total_ascent", lapStats.Elevation.Gain)
+			_mapStat(lap_stats, "total_descent", lapStats.Elevation.Loss)
+			_mapStat(lap_stats, "avg_altitude", lapStats.Elevation.Average)
+			_mapStat(lap_stats, "max_altitude", lapStats.Elevation.Max)
+			_mapStat(lap_stats, "min_altitude", lapStats.Elevation.Min)
+			_mapStat(lap_stats, "avg_temperature", lapStats.Temperature.Average)
+			_mapStat(lap_stats, "max_temperature", lapStats.Temperature.Max)
 
 			# These are some really... stupid lookups.
 			# Oh well, futureproofing.
@@ -0,0 +1,111 @@
+from tapiriik.database import db
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlparse
+import bisect
+import logging
+import os
+import socket
+import threading
+import time
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the request latency histogram buckets - there's one more bucket on the end for everything slower
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# How often each process writes its counters out to http_metrics (they're summarized by stats_cron.py)
+FLUSH_INTERVAL = 60
+
+_context = threading.local()
+
+
+class HTTPMetrics:
+    """ Counts requests, status codes, latency and bytes transferred per service - installed with requests_lib.patch_requests_with_metrics.
+
+    Requests are attributed to the service whose call they're made within (see ServiceContext), otherwise to the host they're sent to.
+    """
+    _lock = threading.Lock()
+    _counters = {}
+    _lastFlush = time.time()
+
+    @contextmanager
+    def ServiceContext(service_id):
+        previous = getattr(_context, "service", None)
+        _context.service = service_id
+        try:
+            yield
+        finally:
+            _context.service = previous
+
+    def ServiceFor(session, url):
+        service_id = getattr(session, "tapiriik_service", None) or getattr(_context, "service", None)
+        if service_id:
+            return service_id
+        return urlparse(url).hostname or "unknown"
+
+    def _serviceCounters(service_id):
+        if service_id not in HTTPMetrics._counters:
+            HTTPMetrics._counters[service_id] = {"Service": service_id, "Requests": 0, "Errors": 0, "Retries": 0, "Statuses": {}, "Time": 0, "Latency": [0] * (len(LATENCY_BUCKETS) + 1), "BytesSent": 0, "BytesReceived": 0}
+        return HTTPMetrics._counters[service_id]
+
+    def Record(service_id, response, duration, stream=False):
+        # response is None if the request didn't get one (connection errors, timeouts, etc.)
+        if response is not None:
+            status = str(response.status_code)
+            body = response.request.body if response.request else None
+            sent = len(body) if isinstance(body, (bytes, str)) else 0
+            if not stream:
+                received = len(response.content)
+            else:
+                # Not going to read it for them
+                try:
+                    received = int(response.headers.get("Content-Length", 0))
+                except ValueError:
+                    received = 0
+        else:
+            status = "error"
+            sent = received = 0
+        with HTTPMetrics._lock:
+            counters = HTTPMetrics._serviceCounters(service_id)
+            counters["Requests"] += 1
+            if response is None or response.status_code >= 500:
+                counters["Errors"] += 1
+            counters["Statuses"][status] = counters["Statuses"].get(status, 0) + 1
+            counters["Time"] += duration
+            counters["Latency"][bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+            counters["BytesSent"] += sent
+            counters["BytesReceived"] += received
+        HTTPMetrics._flushIfDue()
+
+    def RecordRetry(service_id):
+        with HTTPMetrics._lock:
+            HTTPMetrics._serviceCounters(service_id)["Retries"] += 1
+
+    def _flushIfDue():
+        if time.time() - HTTPMetrics._lastFlush >= FLUSH_INTERVAL:
+            HTTPMetrics.Flush()
+
+    def Flush():
+        with HTTPMetrics._lock:
+            counters = list(HTTPMetrics._counters.values())
+            HTTPMetrics._counters = {}
+            HTTPMetrics._lastFlush = time.time()
+        if not counters:
+            return
+        try:
+            db.http_metrics.insert({"Timestamp": datetime.utcnow(), "Host": socket.gethostname(), "Process": os.getpid(), "Services": counters})
+        except Exception:
+            logger.exception("Could not write HTTP metrics")
+
+    def LatencyPercentile(latency, fraction):
+        # Only as precise as the buckets - the upper bound of the bucket the percentile falls into (None if it's in the open-ended one)
+        total = sum(latency)
+        if not total:
+            return None
+        rank = fraction * total
+        seen = 0
+        for index, count in enumerate(latency):
+            seen += count
+            if seen >= rank and count:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else None
+        return None
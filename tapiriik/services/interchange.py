@@ -1,7 +1,9 @@
 from datetime import timedelta, datetime
 from tapiriik.database import cachedb
 from tapiriik.database.tz import TZLookup
+from array import array
 import hashlib
+import math
 import pytz
 
 
@@ -86,7 +88,7 @@ class Activity:
         self.UID = csp.hexdigest()
 
     def CountTotalWaypoints(self):
-        return sum([len(x.Waypoints) for x in self.Laps])
+        return sum([x.CountWaypoints() for x in self.Laps])
 
     def GetFlatWaypoints(self):
         return [wp for waypoints in [x.Waypoints for x in self.Laps] for wp in waypoints]
@@ -94,7 +96,7 @@ class Activity:
     def GetFirstWaypointWithLocation(self):
         loc_wp = None
         for lap in self.Laps:
-            for wp in lap.Waypoints:
+            for wp in lap.IterWaypoints():
                 if wp.Location is not None and wp.Location.Latitude is not None and wp.Location.Longitude is not None:
                     loc_wp = wp.Location
                     break
@@ -111,6 +113,9 @@ class Activity:
         for lap in self.Laps:
             lap.StartTime = self.TZ.localize(lap.StartTime) if lap.StartTime.tzinfo is None else lap.StartTime
             lap.EndTime = self.TZ.localize(lap.EndTime) if lap.EndTime.tzinfo is None else lap.EndTime
+            if lap.Track is not None:
+                lap.Track.Localize(self.TZ)
+                continue
             for wp in lap.Waypoints:
                 if wp.Timestamp.tzinfo is None:
                     wp.Timestamp = self.TZ.localize(wp.Timestamp)
@@ -126,6 +131,9 @@ class Activity:
         for lap in self.Laps:
             lap.StartTime = lap.StartTime.astimezone(self.TZ)
             lap.EndTime = lap.EndTime.astimezone(self.TZ)
+            if lap.Track is not None:
+                lap.Track.AsTimezone(self.TZ)
+                continue
             for wp in lap.Waypoints:
                     wp.Timestamp = wp.Timestamp.astimezone(self.TZ)
         self.CalculateUID()
@@ -162,6 +170,13 @@ class Activity:
         else:
             self.AdjustTZ()
 
+    def Validate(self, sanity=False, timestamps=False, cleanStats=False, cleanWaypoints=False):
+        """ Does whichever of the checks and clean-ups below are asked for, in one pass over the waypoints (see ActivityValidator)
+            Returns a list of ValidationViolations - the clean-ups are done regardless
+        """
+        from tapiriik.services.validation import ActivityValidator
+        return ActivityValidator(self, sanity=sanity, timestamps=timestamps, cleanStats=cleanStats, cleanWaypoints=cleanWaypoints).Run()
+
     def CheckSanity(self):
         """ Started out as a function that checked to make sure the activity itself is sane.
             Now we perform a lot of checks to make sure all the objects were initialized properly
@@ -171,157 +186,27 @@ class Activity:
         """
         if "ServiceDataCollection" in self.__dict__:
             srcs = self.ServiceDataCollection  # this is just so I can see the source of the activity in the exception message
-        if len(self.Laps) == 0:
-                raise ValueError("No laps")
-        wptCt = sum([len(x.Waypoints) for x in self.Laps])
-        if self.Stationary is None:
-            raise ValueError("Activity is undecidedly stationary")
-        if self.GPS is None:
-            raise ValueError("Activity is undecidedly GPS-tracked")
-        if not self.Stationary:
-            if wptCt == 0:
-                raise ValueError("Exactly 0 waypoints")
-            if wptCt == 1:
-                raise ValueError("Only 1 waypoint")
-        if self.Stats.Distance.Value is not None and self.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value > 1000 * 1000:
-            raise ValueError("Exceedingly long activity (distance)")
-        if self.StartTime.replace(tzinfo=None) > (datetime.now() + timedelta(days=5)):
-            raise ValueError("Activity is from the future")
-        if self.StartTime.replace(tzinfo=None) < datetime(1995, 1, 1):
-            raise ValueError("Activity falls implausibly far in the past")
-        if self.EndTime and self.EndTime.replace(tzinfo=None) > (datetime.now() + timedelta(days=5 + 5)): # Based on the 5-day activity length limit imposed later.
-            raise ValueError("Activity ends in the future")
-
-        if self.StartTime and self.EndTime:
-            # We can only do these checks if the activity has both start and end times (Dropbox)
-            if (self.EndTime - self.StartTime).total_seconds() < 0:
-                raise ValueError("Event finishes before it starts")
-            if (self.EndTime - self.StartTime).total_seconds() == 0:
-                raise ValueError("0-duration activity")
-            if (self.EndTime - self.StartTime).total_seconds() > 60 * 60 * 24 * 5:
-                raise ValueError("Exceedingly long activity (time)")
-
-        if len(self.Laps) == 1:
-            if self.Laps[0].Stats != self.Stats:
-                raise ValueError("Activity with 1 lap has mismatching statistics between activity and lap")
-        altLow = None
-        altHigh = None
-        pointsWithLocation = 0
-        unpausedPoints = 0
-        for lap in self.Laps:
-            if not lap.StartTime:
-                raise ValueError("Lap has no start time")
-            if not lap.EndTime:
-                raise ValueError("Lap has no end time")
-            for wp in lap.Waypoints:
-                if wp.Type != WaypointType.Pause:
-                    unpausedPoints += 1
-                if wp.Location:
-                    if wp.Location.Latitude == 0 and wp.Location.Longitude == 0:
-                        raise ValueError("Invalid lat/lng")
-                    if (wp.Location.Latitude is not None and (wp.Location.Latitude > 90 or wp.Location.Latitude < -90)) or (wp.Location.Longitude is not None and (wp.Location.Longitude > 180 or wp.Location.Longitude < -180)):
-                        raise ValueError("Out of range lat/lng")
-                    if wp.Location.Altitude is not None and (altLow is None or wp.Location.Altitude < altLow):
-                        altLow = wp.Location.Altitude
-                    if wp.Location.Altitude is not None and (altHigh is None or wp.Location.Altitude > altHigh):
-                        altHigh = wp.Location.Altitude
-                if wp.Location and wp.Location.Latitude is not None and wp.Location.Longitude is not None:
-                    pointsWithLocation += 1
-        if unpausedPoints == 1:
-            raise ValueError("0 < n <= 1 unpaused points in activity")
-        if pointsWithLocation == 1:
-            raise ValueError("0 < n <= 1 geographic points in activity") # Make RK happy
-        if altLow is not None and altLow == altHigh and altLow == 0:  # some activities have very sporadic altitude data, we'll let it be...
-            raise ValueError("Invalid altitudes / no change from " + str(altLow))
+        violations = self.Validate(sanity=True)
+        if violations:
+            violations[0].Raise()
 
     # Gets called a bit later than CheckSanity, meh
     def CheckTimestampSanity(self):
-        out_of_bounds_leeway = timedelta(minutes=10)
-
-        if self.StartTime.tzinfo != self.TZ:
-            raise ValueError("Activity StartTime TZ mismatch - %s master vs %s instance" % (self.TZ, self.StartTime.tzinfo))
-        if self.EndTime.tzinfo != self.TZ:
-            raise ValueError("Activity EndTime TZ mismatch - %s master vs %s instance" % (self.TZ, self.EndTime.tzinfo))
-
-        for lap in self.Laps:
-            if lap.StartTime.tzinfo != self.TZ:
-                raise ValueError("Lap StartTime TZ mismatch - %s master vs %s instance" % (self.TZ, lap.StartTime.tzinfo))
-            if lap.EndTime.tzinfo != self.TZ:
-                raise ValueError("Lap EndTime TZ mismatch - %s master vs %s instance" % (self.TZ, lap.EndTime.tzinfo))
-
-            for wp in lap.Waypoints:
-                if wp.Timestamp.tzinfo != self.TZ:
-                    raise ValueError("Waypoint TZ mismatch - %s master vs %s instance" % (self.TZ, wp.Timestamp.tzinfo))
-
-                if lap.StartTime - wp.Timestamp > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far before lap")
-
-                if wp.Timestamp - lap.EndTime > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far after lap")
-
-                if self.StartTime - wp.Timestamp > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far before activity")
-
-                if wp.Timestamp - self.EndTime > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far after activity")
-
-            if self.StartTime - lap.StartTime > out_of_bounds_leeway:
-                raise ValueError("Lap starts too far before activity")
-
-            if lap.EndTime - self.EndTime > out_of_bounds_leeway:
-                raise ValueError("Lap ends too far after activity")
+        violations = self.Validate(timestamps=True)
+        if violations:
+            violations[0].Raise()
 
     def CleanStats(self):
         """
             Some devices/apps populate fields with patently false values, e.g. HR avg = 1bpm, calories = 0kcal
             So, rather than propagating these, or bailing, we silently strip them, in hopes that destinations will do a better job of calculating them.
-            Most of the upper limits match the FIT spec
+            Most of the upper limits match the FIT spec (see ActivityValidator.StatRanges)
         """
-        def _cleanStatsObj(stats):
-            ranges = {
-                "Power": (ActivityStatisticUnit.Watts, 0, 5000),
-                "Speed": (ActivityStatisticUnit.KilometersPerHour, 0, 150),
-                "Elevation": (ActivityStatisticUnit.Meters, -500, 8850), # Props for bringing your Forerunner up Everest
-                "HR": (ActivityStatisticUnit.BeatsPerMinute, 15, 300), # Please visit the ER before you email me about these limits
-                "Cadence": (ActivityStatisticUnit.RevolutionsPerMinute, 0, 255), # FIT
-                "RunCadence": (ActivityStatisticUnit.StepsPerMinute, 0, 255), # FIT
-                "Strides": (ActivityStatisticUnit.Strides, 1, 9999999),
-                "Temperature": (ActivityStatisticUnit.DegreesCelcius, -62, 50),
-                "Energy": (ActivityStatisticUnit.Kilocalories, 1, 65535), # FIT
-                "Distance": (ActivityStatisticUnit.Kilometers, 0, 1000) # You can let me know when you ride 1000 km and I'll up this.
-            }
-            checkFields = ("Average", "Max", "Min", "Value")
-            for key in ranges:
-                raw_stat = getattr(stats, key)
-                stat = raw_stat.asUnits(ranges[key][0])
-                for field in checkFields:
-                    value = getattr(stat, field)
-                    if value is not None and (value < ranges[key][1] or value > ranges[key][2]):
-                        raw_stat._samples[field] = 0 # Need to update the original (raw_stat), not the asUnits copy (stat)
-                        setattr(raw_stat, field, None)
-
-        _cleanStatsObj(self.Stats)
-        for lap in self.Laps:
-            _cleanStatsObj(lap.Stats)
+        self.Validate(cleanStats=True)
 
     def CleanWaypoints(self):
         # Similarly, we sometimes get complete nonsense like negative distance
-        waypoints = self.GetFlatWaypoints()
-        for wp in waypoints:
-            if wp.Distance and wp.Distance < 0:
-                wp.Distance = 0
-            if wp.Speed and wp.Speed < 0:
-                wp.Speed = 0
-            if wp.Cadence and wp.Cadence < 0:
-                wp.Cadence = 0
-            if wp.RunCadence and wp.RunCadence < 0:
-                wp.RunCadence = 0
-            if wp.Power and wp.Power < 0:
-                wp.Power = 0
-            if wp.Calories and wp.Calories < 0:
-                wp.Calories = 0 # Are there any devices that track your caloric intake? Interesting idea...
-            if wp.HR and wp.HR < 0:
-                wp.HR = 0
+        self.Validate(cleanWaypoints=True)
 
     def __str__(self):
         return "Activity (" + self.Type + ") Start " + str(self.StartTime) + " " + str(self.TZ) + " End " + str(self.EndTime) + " stat " + str(self.Stationary)
@@ -377,16 +262,38 @@ class LapTriggerMethod:
     FitnessEquipment = 8
 
 class Lap:
-    def __init__(self, startTime=None, endTime=None, intensity=LapIntensity.Active, trigger=LapTriggerMethod.Manual, stats=None, waypointList=None):
+    def __init__(self, startTime=None, endTime=None, intensity=LapIntensity.Active, trigger=LapTriggerMethod.Manual, stats=None, waypointList=None, track=None):
         self.StartTime = startTime
         self.EndTime = endTime
         self.Trigger = trigger
         self.Intensity = intensity
         self.Stats = stats if stats else ActivityStatistics()
         self.Waypoints = waypointList if waypointList else []
+        # Parsers that know better can fill this in instead of Waypoints (see Track)
+        self.Track = track
+
+    @property
+    def Waypoints(self):
+        # Anything that wants Waypoint objects gets them - for good, since they might be modified
+        if self.Track is not None:
+            self._waypoints = self.Track.ToWaypoints()
+            self.Track = None
+        return self._waypoints
+
+    @Waypoints.setter
+    def Waypoints(self, waypoints):
+        self._waypoints = waypoints
+        self.Track = None
+
+    def CountWaypoints(self):
+        return len(self.Track) if self.Track is not None else len(self._waypoints)
+
+    def IterWaypoints(self):
+        # For read-only passes - doesn't turn a Track into a list of Waypoints (modifying what's yielded won't stick though)
+        return self.Track.IterWaypoints() if self.Track is not None else iter(self._waypoints)
 
     def __str__(self):
-        return str(self.StartTime) + "-" + str(self.EndTime) + " " + str(self.Intensity) + " (" + str(self.Trigger) + ") " + str(len(self.Waypoints)) + " wps"
+        return str(self.StartTime) + "-" + str(self.EndTime) + " " + str(self.Intensity) + " (" + str(self.Trigger) + ") " + str(self.CountWaypoints()) + " wps"
     __repr__ = __str__
 
 class ActivityStatistics:
@@ -429,6 +336,16 @@ class ActivityStatistics:
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def asUnits(self, units):
+        """ A copy with the statistics named in units (a dict of stat key -> unit) converted in one go - the rest are left as-is
+            e.g. lap.Stats.asUnits({"Distance": ActivityStatisticUnit.Meters, "Speed": ActivityStatisticUnit.MetersPerSecond})
+        """
+        stats = ActivityStatistics.__new__(ActivityStatistics)
+        for stat in ActivityStatistics._statKeys:
+            value = getattr(self, stat)
+            setattr(stats, stat, value.asUnits(units[stat]) if stat in units else value)
+        return stats
+
 
 class ActivityStatisticUnit:
     Seconds = "s"
@@ -481,7 +398,7 @@ class ActivityStatistic:
         self.Gain = gain
         self.Loss = loss
 
-        # Nothing outside of this class should be accessing _samples (though CleanStats gets a pass)
+        # Nothing outside of this class should be accessing _samples (though ActivityValidator, for CleanStats, gets a pass)
         self._samples = {}
         self._samples["Value"] = 1 if value is not None else 0
         self._samples["Average"] = 1 if avg is not None else 0
@@ -492,19 +409,34 @@ class ActivityStatistic:
 
         self.Units = units
 
+    # (from units, to units) -> function doing the conversion, see _conversionPlan
+    _conversionPlans = {}
+
     def asUnits(self, units):
         if units == self.Units:
             return self
         newStat = ActivityStatistic(units)
         newStat._samples = self._samples
         newStat.Units = units
+        convert = ActivityStatistic._conversionPlan(self.Units, units)
         for k in ActivityStatistic._typeKeys:
             old_value = getattr(self, k, None)
             if old_value is not None:
-                setattr(newStat, k, ActivityStatistic.convertValue(old_value, self.Units, units))
+                setattr(newStat, k, convert(old_value))
         return newStat
 
     def convertValue(value, from_units, to_units):
+        return ActivityStatistic._conversionPlan(from_units, to_units)(value)
+
+    def _conversionPlan(from_units, to_units):
+        # Finding the path through _conversions is by far the slowest part, so it's only done once for each pair of units
+        plan = ActivityStatistic._conversionPlans.get((from_units, to_units))
+        if plan is None:
+            plan = ActivityStatistic._conversionPlans[(from_units, to_units)] = ActivityStatistic._compileConversionPlan(from_units, to_units)
+        return plan
+
+    def _compileConversionPlan(from_units, to_units):
+        # Returns a function doing each step of the conversion in turn (or raising ValueError, if there's no way to do it)
         def recurseFindConversionPath(unit, target, stack):
             assert(unit != target)
             for transform in ActivityStatistic._conversions.keys():
@@ -521,28 +453,52 @@ class ActivityStatistic:
                             return result
             return None
 
+        def _fail(message):
+            def fail(value):
+                raise ValueError(message)
+            return fail
+
+        def _multiply(factor):
+            return lambda value: value * factor
+
+        def _divide(factor):
+            return lambda value: value / factor
+
+        if from_units == to_units:
+            return lambda value: value
+
         conversionPath = recurseFindConversionPath(from_units, to_units, [])
         if not conversionPath:
-            raise ValueError("No conversion from %s to %s" % (from_units, to_units))
+            return _fail("No conversion from %s to %s" % (from_units, to_units))
+        steps = []
+        current_units = from_units
         for transform in conversionPath:
-            if type(ActivityStatistic._conversions[transform]) is float or type(ActivityStatistic._conversions[transform]) is int:
-                if from_units == transform[0]:
-                    value = value * ActivityStatistic._conversions[transform]
-                    from_units = transform[1]
+            conversion = ActivityStatistic._conversions[transform]
+            if type(conversion) is float or type(conversion) is int:
+                if current_units == transform[0]:
+                    steps.append(_multiply(conversion))
+                    current_units = transform[1]
                 else:
-                    value = value / ActivityStatistic._conversions[transform]
-                    from_units = transform[0]
+                    steps.append(_divide(conversion))
+                    current_units = transform[0]
             else:
-                if from_units == transform[0]:
-                    func = ActivityStatistic._conversions[transform][0] if type(ActivityStatistic._conversions[transform]) is tuple else ActivityStatistic._conversions[transform]
-                    value = func(value)
-                    from_units = transform[1]
+                if current_units == transform[0]:
+                    steps.append(conversion[0] if type(conversion) is tuple else conversion)
+                    current_units = transform[1]
                 else:
-                    if type(ActivityStatistic._conversions[transform]) is not tuple:
-                        raise ValueError("No transform function for %s to %s" % (from_units, to_units))
-                    value = ActivityStatistic._conversions[transform][1](value)
-                    from_units = transform[0]
-        return value
+                    if type(conversion) is not tuple:
+                        return _fail("No transform function for %s to %s" % (current_units, to_units))
+                    steps.append(conversion[1])
+                    current_units = transform[0]
+
+        if len(steps) == 1:
+            return steps[0]
+
+        def convert(value):
+            for step in steps:
+                value = step(value)
+            return value
+        return convert
 
     def coalesceWith(self, stat):
         stat = stat.asUnits(self.Units)
@@ -654,3 +610,96 @@ class Location:
 
     def __ne__(self, other):
         return not self.__eq__(other)
+
+
+class Track:
+    """ A lap's worth of waypoints, stored a column per field instead of as Waypoint/Location objects - a fraction of the memory for long activities.
+
+    Timestamps are kept as seconds since StartTime, which carries the TZ - so setting or changing it (Localize/AsTimezone) doesn't touch every waypoint.
+    It's only applied to individual timestamps when they're asked for. Missing values are kept as NaN (see Valid).
+    Lap.Waypoints turns it back into Waypoint objects for everything that hasn't been taught about Tracks.
+    """
+    Columns = ("Latitude", "Longitude", "Altitude", "HR", "Calories", "Power", "Temp", "Cadence", "RunCadence", "Distance", "Speed")
+    LocationColumns = ("Latitude", "Longitude", "Altitude")
+
+    def __init__(self, startTime):
+        self.StartTime = startTime
+        self.Time = array("d")
+        self.Type = array("B")
+        # Whether the waypoint had a Location at all (even if all its values were None)
+        self.HasLocation = bytearray()
+        for column in Track.Columns:
+            setattr(self, column, array("d"))
+
+    def __len__(self):
+        return len(self.Time)
+
+    def Append(self, offset, ptType=WaypointType.Regular, hasLocation=None, **values):
+        # offset is in seconds from StartTime, values are by column name
+        nan = float("nan")
+        self.Time.append(offset)
+        self.Type.append(ptType)
+        if hasLocation is None:
+            hasLocation = any(values.get(column) is not None for column in Track.LocationColumns)
+        self.HasLocation.append(1 if hasLocation else 0)
+        for column in Track.Columns:
+            value = values.get(column)
+            getattr(self, column).append(nan if value is None else value)
+
+    def AppendWaypoint(self, wp):
+        if wp.Timestamp is None:
+            raise ValueError("Waypoint without timestamp")
+        if (wp.Timestamp.tzinfo is None) != (self.StartTime.tzinfo is None):
+            raise ValueError("Can't mix naive and TZ-aware waypoints in a track")
+        values = {column: getattr(wp, column) for column in Track.Columns if column not in Track.LocationColumns}
+        if wp.Location:
+            values.update({"Latitude": wp.Location.Latitude, "Longitude": wp.Location.Longitude, "Altitude": wp.Location.Altitude})
+        self.Append((wp.Timestamp - self.StartTime).total_seconds(), wp.Type, hasLocation=wp.Location is not None, **values)
+
+    def FromWaypoints(waypoints):
+        # Raises ValueError if they can't be represented (no timestamps, or a mixture of naive and TZ-aware ones)
+        # Aware timestamps all come back out in the first one's TZ
+        if not len(waypoints):
+            raise ValueError("No waypoints")
+        track = Track(waypoints[0].Timestamp)
+        for wp in waypoints:
+            track.AppendWaypoint(wp)
+        return track
+
+    def Valid(self, column):
+        # Validity mask for a column
+        return [not math.isnan(x) for x in getattr(self, column)]
+
+    def Timestamp(self, index):
+        timestamp = self.StartTime + timedelta(seconds=self.Time[index])
+        # pytz won't move the UTC offset across DST changes by itself
+        tz = timestamp.tzinfo
+        return tz.normalize(timestamp) if hasattr(tz, "normalize") else timestamp
+
+    def TimestampRange(self):
+        # The earliest and latest timestamps (not necessarily the first and last)
+        return self.StartTime + timedelta(seconds=min(self.Time)), self.StartTime + timedelta(seconds=max(self.Time))
+
+    def Localize(self, tz):
+        # For tracks with naive timestamps - the offsets are taken as elapsed time, whatever happens to the local time in between
+        if self.StartTime.tzinfo is None:
+            self.StartTime = tz.localize(self.StartTime)
+
+    def AsTimezone(self, tz):
+        self.StartTime = self.StartTime.astimezone(tz)
+
+    def Waypoint(self, index):
+        def _value(column):
+            value = getattr(self, column)[index]
+            return None if math.isnan(value) else value
+        wp = Waypoint(self.Timestamp(index), ptType=self.Type[index], hr=_value("HR"), power=_value("Power"), calories=_value("Calories"), cadence=_value("Cadence"), runCadence=_value("RunCadence"), temp=_value("Temp"), distance=_value("Distance"), speed=_value("Speed"))
+        if self.HasLocation[index]:
+            wp.Location = Location(_value("Latitude"), _value("Longitude"), _value("Altitude"))
+        return wp
+
+    def IterWaypoints(self):
+        for index in range(len(self)):
+            yield self.Waypoint(index)
+
+    def ToWaypoints(self):
+        return list(self.IterWaypoints())
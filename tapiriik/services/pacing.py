@@ -0,0 +1,73 @@
+from tapiriik.database import redis
+import fcntl
+import logging
+import tempfile
+import threading
+import time
+logger = logging.getLogger(__name__)
+
+# Hands out the next free slot for this scope, and moves it along by the period - returns how long (in ms) the caller has until its slot.
+# Going by Redis' clock, so it doesn't matter if the hosts' don't agree.
+_redisReserveScript = """
+redis.replicate_commands()
+local now_parts = redis.call("TIME")
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local period = tonumber(ARGV[1])
+local slot = math.max(tonumber(redis.call("GET", KEYS[1]) or "0"), now)
+redis.call("SET", KEYS[1], slot + period, "PX", slot + period - now + 60000)
+return slot - now
+"""
+_redisReserve = redis.register_script(_redisReserveScript) if redis else None
+
+class RequestPacer:
+    """ Keeps requests in the same scope (e.g. a service from one source address) at least min_period seconds apart, across every process and host.
+
+    Reserve() takes the next slot straight away and returns when it comes up, so the caller can get on with preparing the request in the meantime - Wait() then sleeps out whatever's left (Pace() does both at once).
+    Without Redis, it falls back to a lock file - which only covers this host, and has everyone queue up behind whoever's waiting.
+    """
+    def __init__(self, scope, min_period):
+        self._scope = scope
+        self._minPeriod = min_period
+        self._lockFile = None
+        self._threadLock = threading.Lock()
+
+    def Reserve(self):
+        # Returns the time.time() at which the request can go out
+        if _redisReserve:
+            try:
+                delay = _redisReserve(keys=["pacer:%s" % self._scope], args=[int(self._minPeriod * 1000)])
+            except Exception:
+                logger.exception("Redis pacing failed for %s, falling back to a lock file" % self._scope)
+            else:
+                return time.time() + delay / 1000
+        self._paceWithLockFile()
+        return time.time()
+
+    def Wait(self, slot):
+        time.sleep(max(0, slot - time.time()))
+
+    def Pace(self):
+        self.Wait(self.Reserve())
+
+    def _paceWithLockFile(self):
+        # flock() doesn't exclude threads sharing the same file, so those queue up here first
+        with self._threadLock:
+            if not self._lockFile:
+                lock_path = tempfile.gettempdir() + "/pacer.%s.lock" % self._scope
+                # Ensure the lock file exists (...the easy way)
+                open(lock_path, "a").close()
+                self._lockFile = open(lock_path, "r+")
+            fcntl.flock(self._lockFile, fcntl.LOCK_EX)
+            try:
+                self._lockFile.seek(0)
+                last_req_start = self._lockFile.read()
+                last_req_start = float(last_req_start) if last_req_start else 0
+
+                time.sleep(max(0, self._minPeriod - (time.time() - last_req_start)))
+
+                self._lockFile.seek(0)
+                self._lockFile.truncate()
+                self._lockFile.write(str(time.time()))
+                self._lockFile.flush()
+            finally:
+                fcntl.flock(self._lockFile, fcntl.LOCK_UN)
@@ -1,21 +1,70 @@
-from tapiriik.database import ratelimit as rl_db
+from tapiriik.database import ratelimit as rl_db, redis
 from pymongo.read_preferences import ReadPreference
 from datetime import datetime, timedelta
+import logging
 import math
+import time
+logger = logging.getLogger(__name__)
+
+# Takes `count` calls from every window, or none at all if that would put any of them over its limit - so it's a single round trip.
+# KEYS are the windows' counters, ARGV is the count then each window's (max, TTL)
+_redisLimitScript = """
+local count = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+	if tonumber(redis.call("GET", key) or "0") + count > tonumber(ARGV[i * 2]) then
+		return 0
+	end
+end
+for i, key in ipairs(KEYS) do
+	redis.call("INCRBY", key, count)
+	redis.call("EXPIRE", key, ARGV[i * 2 + 1])
+end
+return 1
+"""
+_redisLimit = redis.register_script(_redisLimitScript) if redis else None
 
 class RateLimitExceededException(Exception):
 	pass
 
 class RateLimit:
-	def Limit(key):
+	def Limit(key, limits=None, count=1):
+		# Limits is in the same format as for Refresh - when they're given (and there's Redis), they're enforced there, otherwise by the windows ratelimit_cron.py keeps in the DB
+		# count reserves that many calls at once
+		if limits is not None and not limits:
+			return # Nothing to enforce - no need to go to Redis or the DB
+		if limits is not None and _redisLimit:
+			try:
+				allowed = RateLimit._limitRedis(key, limits, count)
+			except Exception:
+				logger.exception("Redis rate limiting failed for %s, falling back to the DB" % key)
+			else:
+				if not allowed:
+					raise RateLimitExceededException()
+				return
+		RateLimit._limitDB(key, count)
+
+	def _limitRedis(key, limits, count):
+		# The windows are anchored at midnight (UTC), as with the DB
+		now = time.time()
+		midnight = now - now % 86400
+		keys = []
+		args = [count]
+		for timespan, max_count in limits:
+			duration = timespan.total_seconds()
+			window_start = midnight + math.floor((now - midnight) / duration) * duration
+			keys.append("ratelimit:%s:%d:%d" % (key, duration, window_start))
+			args += [max_count, math.ceil(window_start + duration - now) + 1]
+		return _redisLimit(keys=keys, args=args) == 1
+
+	def _limitDB(key, count):
 		current_limits = rl_db.limits.find({"Key": key}, {"Max": 1, "Count": 1})
 		for limit in current_limits:
-			if limit["Max"] < limit["Count"]:
+			if limit["Max"] < limit["Count"] + count - 1:
 				# We can't continue without exceeding this limit
 				# Don't want to halt the synchronization worker to wait for 15min-1 hour
 				# So...
 				raise RateLimitExceededException()
-		rl_db.limits.update({"Key": key}, {"$inc": {"Count": 1}}, multi=True)
+		rl_db.limits.update({"Key": key}, {"$inc": {"Count": count}}, multi=True)
 
 	def Refresh(key, limits):
 		# Limits is in format [(timespan, max-count),...]
@@ -0,0 +1,117 @@
+from tapiriik.services.http_metrics import HTTPMetrics
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import threading
+import time
+logger = logging.getLogger(__name__)
+
+class RetryPolicy:
+    """ When (and how long after) to retry a failed request - exponential backoff with jitter, unless the service says how long to wait.
+
+    Each service gets a budget of retries per budget_window (per process), so a partner API that's falling over isn't hammered by every sync at once.
+    Waits longer than max_wait aren't worth tying up a sync worker for - the response is handed back as-is, for the service to deal with.
+    """
+    # Requests that can't have done anything when they fail with these are safe to retry, whatever the method
+    RejectedStatuses = (429,)
+    # ...whereas these might have, so only idempotent requests are retried
+    ServerErrorStatuses = (500, 502, 503, 504)
+    IdempotentMethods = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+    def __init__(self, retries=3, backoff=1, max_backoff=30, max_wait=60, budget=30, budget_window=60, retry_statuses=None):
+        self.Retries = retries
+        self.Backoff = backoff
+        self.MaxBackoff = max_backoff
+        self.MaxWait = max_wait
+        self.Budget = budget
+        self.BudgetWindow = budget_window
+        self.RetryStatuses = retry_statuses
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def _shouldRetryStatus(self, method, status_code):
+        if self.RetryStatuses is not None:
+            return status_code in self.RetryStatuses
+        if status_code in self.RejectedStatuses:
+            return True
+        return status_code in self.ServerErrorStatuses and (method or "GET").upper() in self.IdempotentMethods
+
+    def Delay(self, response, attempt):
+        # What the service asked for, if anything - otherwise "full jitter" exponential backoff
+        requested = RetryPolicy.RequestedDelay(response)
+        if requested is not None:
+            return requested
+        return random.uniform(0, min(self.MaxBackoff, self.Backoff * (2 ** attempt)))
+
+    def RequestedDelay(response):
+        headers = response.headers
+        if headers.get("Retry-After"):
+            value = headers["Retry-After"].strip()
+            if value.isdigit():
+                return int(value)
+            try:
+                retry_at = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                pass
+            else:
+                if retry_at.tzinfo is None:
+                    retry_at = retry_at.replace(tzinfo=timezone.utc)
+                return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        if headers.get("X-RateLimit-Remaining", "").strip() == "0" and headers.get("X-RateLimit-Reset"):
+            try:
+                reset = float(headers["X-RateLimit-Reset"])
+            except ValueError:
+                return None
+            # Some give a timestamp, some give a number of seconds
+            return max(0, reset - time.time()) if reset > 1e9 else reset
+        if headers.get("X-RateLimit-Limit") and headers.get("X-RateLimit-Usage"):
+            # Strava-style - "15-minute,daily" limits and usage, the windows being aligned to the quarter-hour and to UTC midnight
+            try:
+                limits = [int(x) for x in headers["X-RateLimit-Limit"].split(",")]
+                usage = [int(x) for x in headers["X-RateLimit-Usage"].split(",")]
+            except ValueError:
+                return None
+            now = time.time()
+            if len(usage) > 1 and len(limits) > 1 and usage[1] >= limits[1]:
+                return 86400 - now % 86400
+            if usage and limits and usage[0] >= limits[0]:
+                return 900 - now % 900
+        return None
+
+    def _consumeBudget(self, service_id):
+        with self._lock:
+            now = time.time()
+            tokens, last = self._budgets.get(service_id, (self.Budget, now))
+            tokens = min(self.Budget, tokens + (now - last) * self.Budget / self.BudgetWindow)
+            if tokens < 1:
+                self._budgets[service_id] = (tokens, now)
+                return False
+            self._budgets[service_id] = (tokens - 1, now)
+            return True
+
+    def Wait(self, service_id, response, attempt):
+        # Sleeps and returns True if the request should be made again, False if the response should be dealt with as it is
+        method = response.request.method if response.request else None
+        if attempt >= self.Retries or not self._shouldRetryStatus(method, response.status_code):
+            return False
+        delay = self.Delay(response, attempt)
+        if delay > self.MaxWait:
+            logger.info("Not retrying %s %d - would have to wait %ds" % (service_id, response.status_code, delay))
+            return False
+        if not self._consumeBudget(service_id):
+            logger.info("Not retrying %s %d - retry budget exhausted" % (service_id, response.status_code))
+            return False
+        logger.debug("Retrying %s %d in %.1fs (attempt %d)" % (service_id, response.status_code, delay, attempt + 1))
+        HTTPMetrics.RecordRetry(service_id)
+        time.sleep(delay)
+        return True
+
+    def Request(self, service_id, request_fn):
+        # request_fn makes the request and returns the response
+        attempt = 0
+        while True:
+            response = request_fn()
+            if not self.Wait(service_id, response, attempt):
+                return response
+            attempt += 1
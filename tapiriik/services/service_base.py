@@ -1,5 +1,8 @@
 from tapiriik.services.ratelimiting import RateLimit, RateLimitExceededException
+from tapiriik.services.sessionpool import SessionPool
+from tapiriik.services.retry_policy import RetryPolicy
 from tapiriik.services.api import ServiceException, UserExceptionType, UserException
+from datetime import timedelta
 
 class ServiceAuthenticationType:
     OAuth = "oauth"
@@ -64,10 +67,17 @@ class ServiceBase:
     UploadRetryCount = 5
     DownloadRetryCount = 5
 
+    # Partial listings only need to go back as far as the newest activity already synchronized from the connection (see _listingHighWaterMark)
+    # ...less this much, to pick up activities that were uploaded late
+    ListingHighWaterMarkLeeway = timedelta(days=2)
+
     # Global rate limiting options
     # For when there's a limit on the API key itself
     GlobalRateLimits = []
 
+    # When calls made through _httpSession() are retried (the budget's kept per service)
+    HTTPRetryPolicy = RetryPolicy()
+
     @property
     def PartialSyncTriggerRequiresPolling(self):
         return self.PartialSyncRequiresTrigger and self.PartialSyncTriggerPollInterval
@@ -99,8 +109,21 @@ class ServiceBase:
     def RevokeAuthorization(self, serviceRecord):
         raise NotImplementedError
 
+    # Services with paginated listings can implement IterActivityList instead, and get this for free
     def DownloadActivityList(self, serviceRecord, exhaustive_start_date=None):
-        raise NotImplementedError
+        if type(self).IterActivityList is ServiceBase.IterActivityList:
+            raise NotImplementedError
+        activities = []
+        exclusions = []
+        for pageActivities, pageExclusions in self.IterActivityList(serviceRecord, exhaustive_start_date):
+            activities += pageActivities
+            exclusions += pageExclusions
+        return activities, exclusions
+
+    # Yields (activities, exclusions) a page at a time, so sync can start on the first page before the rest are requested (or skip them entirely)
+    # Services that only implement DownloadActivityList list everything as a single page
+    def IterActivityList(self, serviceRecord, exhaustive_start_date=None):
+        yield self.DownloadActivityList(serviceRecord, exhaustive_start_date)
 
     def DownloadActivity(self, serviceRecord, activity):
         raise NotImplementedError
@@ -149,9 +172,20 @@ class ServiceBase:
     def ConfigurationUpdating(self, serviceRecord, newConfig, oldConfig):
         pass
 
-    def _globalRateLimit(self):
+    def _listingHighWaterMark(self, serviceRecord, exhaustive=False):
+        # UTC datetime that a partial listing can stop at (or filter by, server-side), or None to list as usual
+        if exhaustive or not serviceRecord.ListingHighWaterMark:
+            return None
+        return serviceRecord.ListingHighWaterMark["StartTime"] - self.ListingHighWaterMarkLeeway
+
+    def _httpSession(self):
+        # Keep-alive session shared by all of this service's API calls in the process - not for anything that relies on cookies
+        return SessionPool.Get(self.ID, retry_policy=self.HTTPRetryPolicy)
+
+    def _globalRateLimit(self, count=1):
+        # count calls are taken from GlobalRateLimits at once (e.g. for a request that's always followed up by another)
         try:
-            RateLimit.Limit(self.ID)
+            RateLimit.Limit(self.ID, self.GlobalRateLimits, count=count)
         except RateLimitExceededException:
             raise ServiceException("Global rate limit reached", user_exception=UserException(UserExceptionType.RateLimited))
 
@@ -23,6 +23,7 @@ class ServiceRecord:
     ExcludedActivities = {}
     Config = {}
     PartialSyncTriggerSubscribed = False
+    ListingHighWaterMark = None # {"StartTime": (UTC), "UID": ...} of the newest activity in SynchronizedActivities
 
     @property
     def Service(self):
@@ -0,0 +1,45 @@
+from tapiriik import settings
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+
+class RetryingSession(requests.Session):
+    # Requests that fail in a way that's worth retrying are retried according to the service's RetryPolicy
+    def __init__(self, service_id, retry_policy=None):
+        super().__init__()
+        self.tapiriik_service = service_id # For HTTPMetrics
+        self.retry_policy = retry_policy
+
+    def request(self, method, url, *args, **kwargs):
+        if not self.retry_policy:
+            return super().request(method, url, *args, **kwargs)
+        return self.retry_policy.Request(self.tapiriik_service, lambda: super(RetryingSession, self).request(method, url, *args, **kwargs))
+
+class SessionPool:
+    """ One keep-alive requests.Session per service (and source address) in each process, reused for every user's calls to that service.
+
+    They're shared between users, so they don't hold on to any cookies - anything that needs a login session should make its own.
+    """
+    _sessions = {}
+    _lock = threading.Lock()
+
+    def Get(service_id, retry_policy=None):
+        # HTTP_SOURCE_ADDR is read at call time, since the sync workers pick theirs after startup
+        key = (service_id, str(settings.HTTP_SOURCE_ADDR))
+        session = SessionPool._sessions.get(key)
+        if session is None:
+            with SessionPool._lock:
+                session = SessionPool._sessions.get(key)
+                if session is None:
+                    session = SessionPool._sessions[key] = SessionPool._createSession(service_id, retry_policy)
+        return session
+
+    def _createSession(service_id, retry_policy):
+        session = RetryingSession(service_id, retry_policy)
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=settings.HTTP_POOL_CONNECTIONS, pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
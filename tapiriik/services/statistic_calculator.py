@@ -1,31 +1,119 @@
 from datetime import timedelta
 from .interchange import WaypointType
+import math
+import numpy as np
 
 class ActivityStatisticCalculator:
     ImplicitPauseTime = timedelta(minutes=1, seconds=5)
 
     def CalculateDistance(act, startWpt=None, endWpt=None):
-        import math
-        dist = 0
-        altHold = None  # seperate from the lastLoc variable, since we want to hold the altitude as long as required
-        lastTimestamp = lastLoc = None
+        columns = ActivityStatisticCalculator._columns(act, startWpt, endWpt)
+        if columns is not None:
+            return ActivityStatisticCalculator._distanceColumns(columns)
+        return ActivityStatisticCalculator._distanceWaypoints(ActivityStatisticCalculator._waypointRange(act, startWpt, endWpt))
+
+    def CalculateTimerTime(act, startWpt=None, endWpt=None):
+        columns = ActivityStatisticCalculator._columns(act, startWpt, endWpt)
+        if columns is not None:
+            duration = ActivityStatisticCalculator._timerTimeColumns(columns)
+        else:
+            duration = ActivityStatisticCalculator._timerTimeWaypoints(ActivityStatisticCalculator._waypointRange(act, startWpt, endWpt))
+        if duration.total_seconds() == 0 and startWpt is None and endWpt is None:
+            raise ValueError("Zero-duration activity")
+        return duration
+
+    def CalculateAverageMaxHR(act, startWpt=None, endWpt=None):
+        columns = ActivityStatisticCalculator._columns(act, startWpt, endWpt)
+        if columns is not None:
+            return ActivityStatisticCalculator._averageMaxHRColumns(columns)
+        return ActivityStatisticCalculator._averageMaxHRWaypoints(ActivityStatisticCalculator._waypointRange(act, startWpt, endWpt))
+
+    def CalculateElevationGainLoss(act, startWpt=None, endWpt=None):
+        # Both positive, in the units of the waypoints' altitudes (meters)
+        columns = ActivityStatisticCalculator._columns(act, startWpt, endWpt)
+        if columns is not None:
+            return ActivityStatisticCalculator._elevationGainLossColumns(columns)
+        return ActivityStatisticCalculator._elevationGainLossWaypoints(ActivityStatisticCalculator._waypointRange(act, startWpt, endWpt))
+
+    def _waypointRange(act, startWpt=None, endWpt=None):
+        if startWpt is None and endWpt is None:
+            # Without a range, there's no need to turn any Tracks into Waypoints for good
+            return [wp for lap in act.Laps for wp in lap.IterWaypoints()]
 
         flatWaypoints = act.GetFlatWaypoints()
 
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
+        def _indexOf(wpt):
+            # Waypoint.__eq__ compares every field - by identity is much quicker, and it's almost certainly one of these
+            for idx, wp in enumerate(flatWaypoints):
+                if wp is wpt:
+                    return idx
+            return flatWaypoints.index(wpt)
+
+        startIdx = _indexOf(startWpt) if startWpt is not None else 0
+        endIdx = _indexOf(endWpt) if endWpt is not None else len(flatWaypoints) - 1
+        return flatWaypoints[startIdx:endIdx + 1]
+
+    def _columns(act, startWpt=None, endWpt=None):
+        # The laps' Tracks as flat numpy arrays - times in seconds since the first waypoint, and NaN where values are missing
+        # None unless every lap has a Track - turning Waypoint objects into arrays costs as much as just looping over them
+        if startWpt is not None or endWpt is not None or not act.Laps or any(lap.Track is None for lap in act.Laps):
+            return None
+        tracks = [lap.Track for lap in act.Laps if len(lap.Track)]
+
+        columns = {"Time": [], "Type": [], "Latitude": [], "Longitude": [], "Altitude": [], "HR": []}
+        if not tracks:
+            return {name: np.array([], dtype=np.uint8 if name == "Type" else np.float64) for name in columns}
+
+        referenceTime = tracks[0].Timestamp(0)
+        for track in tracks:
+            # Already stored this way
+            columns["Time"].append(np.frombuffer(track.Time, dtype=np.float64) + (track.StartTime - referenceTime).total_seconds())
+            columns["Type"].append(np.frombuffer(track.Type, dtype=np.uint8))
+            for name in ("Latitude", "Longitude", "Altitude", "HR"):
+                columns[name].append(np.frombuffer(getattr(track, name), dtype=np.float64))
+        return {name: np.concatenate(values) for name, values in columns.items()}
+
+    def _distanceColumns(columns):
+        latitude, longitude, altitude = columns["Latitude"], columns["Longitude"], columns["Altitude"]
+        # Pauses (explicit or implicit) break the track - no distance is counted across them, or from the pause waypoint itself
+        breaks = columns["Type"] == WaypointType.Pause
+        breaks[1:] |= np.diff(columns["Time"]) > ActivityStatisticCalculator.ImplicitPauseTime.total_seconds()
+        # Waypoints without a location are skipped over (the TCX schema allows for them)
+        points = np.flatnonzero(~breaks & ~np.isnan(latitude) & ~np.isnan(longitude))
+        segments = np.cumsum(breaks)[points]
+        paired = segments[1:] == segments[:-1]
+        prev, cur = points[:-1][paired], points[1:][paired]
+        if not len(cur):
+            return 0
+
+        # The altitude is held from the last point that had one, as long as required
+        prevAltitude = altitude[prev]
+        held = np.maximum.accumulate(np.where(np.isnan(prevAltitude), -1, np.arange(len(prevAltitude))))
+        altHold = np.where(held >= 0, prevAltitude[held], np.nan)
+        dz = altitude[cur] - altHold
+        dz[np.isnan(dz)] = 0
+
+        latRads = latitude[cur] * math.pi / 180
+        meters_lat_degree = 1000 * 111.13292 + 1.175 * np.cos(4 * latRads) - 559.82 * np.cos(2 * latRads)
+        meters_lon_degree = 1000 * 111.41284 * np.cos(latRads) - 93.5 * np.cos(3 * latRads)
+        dx = (longitude[cur] - longitude[prev]) * meters_lon_degree
+        dy = (latitude[cur] - latitude[prev]) * meters_lat_degree
+        return float(np.sum(np.sqrt(dx ** 2 + dy ** 2 + dz ** 2)))
+
+    def _distanceWaypoints(flatWaypoints):
+        dist = 0
+        altHold = None  # seperate from the lastLoc variable, since we want to hold the altitude as long as required
+        lastTimestamp = lastLoc = None
 
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            timeDelta = flatWaypoints[x].Timestamp - lastTimestamp if lastTimestamp else None
-            lastTimestamp = flatWaypoints[x].Timestamp
+        for wpt in flatWaypoints:
+            timeDelta = wpt.Timestamp - lastTimestamp if lastTimestamp else None
+            lastTimestamp = wpt.Timestamp
 
-            if flatWaypoints[x].Type == WaypointType.Pause or (timeDelta and timeDelta > ActivityStatisticCalculator.ImplicitPauseTime):
+            if wpt.Type == WaypointType.Pause or (timeDelta and timeDelta > ActivityStatisticCalculator.ImplicitPauseTime):
                 lastLoc = None  # don't count distance while paused
                 continue
 
-            loc = flatWaypoints[x].Location
+            loc = wpt.Location
             if loc is None or loc.Longitude is None or loc.Latitude is None:
                 # Used to throw an exception in this case, but the TCX schema allows for location-free waypoints, so we'll just patch over it.
                 continue
@@ -46,49 +134,46 @@ class ActivityStatisticCalculator:
 
         return dist
 
-    def CalculateTimerTime(act, startWpt=None, endWpt=None):
-        flatWaypoints = []
-        for lap in act.Laps:
-            flatWaypoints.append(lap.Waypoints)
+    def _timerTimeColumns(columns):
+        if len(columns["Time"]) < 3:
+            # Either no waypoints, or one at the start and one at the end
+            raise ValueError("Not enough waypoints to calculate timer time")
+        deltas = np.diff(columns["Time"])
+        # Time from a pause waypoint to the next isn't counted, nor are gaps long enough to be implicit pauses
+        counted = (columns["Type"][:-1] != WaypointType.Pause) & (deltas <= ActivityStatisticCalculator.ImplicitPauseTime.total_seconds())
+        return timedelta(seconds=float(np.sum(deltas[counted])))
 
+    def _timerTimeWaypoints(flatWaypoints):
         if len(flatWaypoints) < 3:
             # Either no waypoints, or one at the start and one at the end
             raise ValueError("Not enough waypoints to calculate timer time")
         duration = timedelta(0)
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
         lastTimestamp = None
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            wpt = flatWaypoints[x]
+        for wpt in flatWaypoints:
             delta = wpt.Timestamp - lastTimestamp if lastTimestamp else None
             lastTimestamp = wpt.Timestamp
-            if wpt.Type is WaypointType.Pause:
+            if wpt.Type == WaypointType.Pause:
                 lastTimestamp = None
-            elif delta and delta > act.ImplicitPauseTime:
+            elif delta and delta > ActivityStatisticCalculator.ImplicitPauseTime:
                 delta = None  # Implicit pauses
             if delta:
                 duration += delta
-        if duration.total_seconds() == 0 and startWpt is None and endWpt is None:
-            raise ValueError("Zero-duration activity")
         return duration
 
-    def CalculateAverageMaxHR(act, startWpt=None, endWpt=None):
-        flatWaypoints = act.GetFlatWaypoints()
+    def _averageMaxHRColumns(columns):
+        hr = columns["HR"]
+        hr = hr[~np.isnan(hr) & (hr != 0)]
+        if not len(hr):
+            return None, None
+        return float(np.mean(hr)), float(np.max(hr))
 
+    def _averageMaxHRWaypoints(flatWaypoints):
         # Python can handle 600+ digit numbers, think it can handle this
         maxHR = 0
         cumulHR = 0
         samples = 0
 
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
-
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            wpt = flatWaypoints[x]
+        for wpt in flatWaypoints:
             if wpt.HR:
                 if wpt.HR > maxHR:
                     maxHR = wpt.HR
@@ -101,4 +186,21 @@ class ActivityStatisticCalculator:
         cumulHR = cumulHR / samples
         return cumulHR, maxHR
 
+    def _elevationGainLossColumns(columns):
+        altitude = columns["Altitude"]
+        deltas = np.diff(altitude[~np.isnan(altitude)])
+        return float(np.sum(deltas[deltas > 0])), float(-np.sum(deltas[deltas < 0]))
 
+    def _elevationGainLossWaypoints(flatWaypoints):
+        gain = loss = 0
+        lastAltitude = None
+        for wpt in flatWaypoints:
+            if wpt.Location is None or wpt.Location.Altitude is None:
+                continue
+            if lastAltitude is not None:
+                if wpt.Location.Altitude > lastAltitude:
+                    gain += wpt.Location.Altitude - lastAltitude
+                else:
+                    loss += lastAltitude - wpt.Location.Altitude
+            lastAltitude = wpt.Location.Altitude
+        return gain, loss
@@ -277,10 +277,11 @@ class TCXIO:
 
             xlap.attrib["StartTime"] = lap.StartTime.astimezone(UTC).strftime(dateFormat)
 
-            _writeStat(xlap, "TotalTimeSeconds", lap.Stats.TimerTime.asUnits(ActivityStatisticUnit.Seconds).Value if lap.Stats.TimerTime.Value else None, default=(lap.EndTime - lap.StartTime).total_seconds())
-            _writeStat(xlap, "DistanceMeters", lap.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value)
-            _writeStat(xlap, "MaximumSpeed", lap.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Max)
-            _writeStat(xlap, "Calories", lap.Stats.Energy.asUnits(ActivityStatisticUnit.Kilocalories).Value, default=0, naturalValue=True)
+            lapStats = lap.Stats.asUnits({"TimerTime": ActivityStatisticUnit.Seconds, "Distance": ActivityStatisticUnit.Meters, "Speed": ActivityStatisticUnit.MetersPerSecond, "Energy": ActivityStatisticUnit.Kilocalories, "Power": ActivityStatisticUnit.Watts})
+            _writeStat(xlap, "TotalTimeSeconds", lapStats.TimerTime.Value if lap.Stats.TimerTime.Value else None, default=(lap.EndTime - lap.StartTime).total_seconds())
+            _writeStat(xlap, "DistanceMeters", lapStats.Distance.Value)
+            _writeStat(xlap, "MaximumSpeed", lapStats.Speed.Max)
+            _writeStat(xlap, "Calories", lapStats.Energy.Value, default=0, naturalValue=True)
             _writeStat(xlap, "AverageHeartRateBpm", lap.Stats.HR.Average, naturalValue=True, wrapValue=True)
             _writeStat(xlap, "MaximumHeartRateBpm", lap.Stats.HR.Max, naturalValue=True, wrapValue=True)
 
@@ -309,9 +310,9 @@ class TCXIO:
                 _writeStat(lapext, "MaxRunCadence", lap.Stats.RunCadence.Max if lap.Stats.RunCadence.Max is not None else None, naturalValue=True)
                 _writeStat(lapext, "AvgRunCadence", lap.Stats.RunCadence.Average if lap.Stats.RunCadence.Average is not None else None, naturalValue=True)
                 _writeStat(lapext, "Steps", lap.Stats.Strides.Value, naturalValue=True)
-                _writeStat(lapext, "MaxWatts", lap.Stats.Power.asUnits(ActivityStatisticUnit.Watts).Max, naturalValue=True)
-                _writeStat(lapext, "AvgWatts", lap.Stats.Power.asUnits(ActivityStatisticUnit.Watts).Average, naturalValue=True)
-                _writeStat(lapext, "AvgSpeed", lap.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Average)
+                _writeStat(lapext, "MaxWatts", lapStats.Power.Max, naturalValue=True)
+                _writeStat(lapext, "AvgWatts", lapStats.Power.Average, naturalValue=True)
+                _writeStat(lapext, "AvgSpeed", lapStats.Speed.Average)
 
         inPause = False
         for lap in activity.Laps:
@@ -0,0 +1,291 @@
+from .interchange import WaypointType, ActivityStatisticUnit
+from datetime import datetime, timedelta
+
+class ValidationCheck:
+    Sanity = "sanity"
+    Timestamps = "timestamps"
+
+class ValidationViolation:
+    def __init__(self, check, message, lap=None, waypoint=None):
+        self.Check = check
+        self.Message = message
+        self.Lap = lap # Index into Activity.Laps, if it's down to a particular lap
+        self.Waypoint = waypoint # ...and into that lap's waypoints, if it's down to a particular waypoint
+
+    def Raise(self):
+        raise ValueError(self.Message)
+
+    def __str__(self):
+        location = ""
+        if self.Lap is not None:
+            location = " (lap %d" % self.Lap + (", waypoint %d)" % self.Waypoint if self.Waypoint is not None else ")")
+        return "%s: %s%s" % (self.Check, self.Message, location)
+    __repr__ = __str__
+
+class ActivityValidator:
+    """ Does the work of Activity.CheckSanity, CheckTimestampSanity, CleanStats and CleanWaypoints - whichever are asked for, in a single pass over the waypoints.
+
+    Rather than raising at the first problem, every violation is collected (only the first of each kind for the waypoints, though).
+    The clean-ups happen either way. Track laps are checked and cleaned without being turned into Waypoints.
+    """
+    StatRanges = {
+        "Power": (ActivityStatisticUnit.Watts, 0, 5000),
+        "Speed": (ActivityStatisticUnit.KilometersPerHour, 0, 150),
+        "Elevation": (ActivityStatisticUnit.Meters, -500, 8850), # Props for bringing your Forerunner up Everest
+        "HR": (ActivityStatisticUnit.BeatsPerMinute, 15, 300), # Please visit the ER before you email me about these limits
+        "Cadence": (ActivityStatisticUnit.RevolutionsPerMinute, 0, 255), # FIT
+        "RunCadence": (ActivityStatisticUnit.StepsPerMinute, 0, 255), # FIT
+        "Strides": (ActivityStatisticUnit.Strides, 1, 9999999),
+        "Temperature": (ActivityStatisticUnit.DegreesCelcius, -62, 50),
+        "Energy": (ActivityStatisticUnit.Kilocalories, 1, 65535), # FIT
+        "Distance": (ActivityStatisticUnit.Kilometers, 0, 1000) # You can let me know when you ride 1000 km and I'll up this.
+    }
+    StatFields = ("Average", "Max", "Min", "Value")
+    # Negative values of these are zeroed (are there any devices that track your caloric intake? Interesting idea...)
+    NonNegativeWaypointFields = ("Distance", "Speed", "Cadence", "RunCadence", "Power", "Calories", "HR")
+    TimestampLeeway = timedelta(minutes=10)
+
+    def __init__(self, activity, sanity=False, timestamps=False, cleanStats=False, cleanWaypoints=False):
+        self._act = activity
+        self._sanity = sanity
+        self._timestamps = timestamps
+        self._cleanStats = cleanStats
+        self._cleanWaypoints = cleanWaypoints
+        self._violations = []
+        self._reported = set()
+        # Once there's a TZ mismatch, there's no telling whether the timestamps can even be compared (naive vs. aware)
+        self._timestampsComparable = True
+
+    def _tzMismatch(self, message, lap=None, waypoint=None):
+        self._timestampsComparable = False
+        self._violation(ValidationCheck.Timestamps, message, lap=lap, waypoint=waypoint, once=True)
+
+    def _violation(self, check, message, lap=None, waypoint=None, once=False):
+        if once:
+            if (check, message) in self._reported:
+                return
+            self._reported.add((check, message))
+        self._violations.append(ValidationViolation(check, message, lap=lap, waypoint=waypoint))
+
+    def Run(self):
+        act = self._act
+        if self._sanity:
+            self._checkActivity()
+        if self._timestamps:
+            if act.StartTime.tzinfo != act.TZ:
+                self._tzMismatch("Activity StartTime TZ mismatch - %s master vs %s instance" % (act.TZ, act.StartTime.tzinfo))
+            if act.EndTime.tzinfo != act.TZ:
+                self._tzMismatch("Activity EndTime TZ mismatch - %s master vs %s instance" % (act.TZ, act.EndTime.tzinfo))
+
+        # Accumulated over all the waypoints, for the sanity checks
+        self._altLow = self._altHigh = None
+        self._pointsWithLocation = self._unpausedPoints = 0
+
+        if self._sanity or self._timestamps or self._cleanWaypoints:
+            for lapIdx, lap in enumerate(act.Laps):
+                self._processLap(lapIdx, lap)
+
+        if self._sanity:
+            if self._unpausedPoints == 1:
+                self._violation(ValidationCheck.Sanity, "0 < n <= 1 unpaused points in activity")
+            if self._pointsWithLocation == 1:
+                self._violation(ValidationCheck.Sanity, "0 < n <= 1 geographic points in activity") # Make RK happy
+            if self._altLow is not None and self._altLow == self._altHigh and self._altLow == 0:  # some activities have very sporadic altitude data, we'll let it be...
+                self._violation(ValidationCheck.Sanity, "Invalid altitudes / no change from " + str(self._altLow))
+
+        # After the sanity checks, since they look at the stats as they were
+        if self._cleanStats:
+            ActivityValidator._cleanStatsObj(act.Stats)
+            for lap in act.Laps:
+                ActivityValidator._cleanStatsObj(lap.Stats)
+
+        return self._violations
+
+    def _checkActivity(self):
+        act = self._act
+        check = ValidationCheck.Sanity
+        if len(act.Laps) == 0:
+            self._violation(check, "No laps")
+        wptCt = act.CountTotalWaypoints()
+        if act.Stationary is None:
+            self._violation(check, "Activity is undecidedly stationary")
+        if act.GPS is None:
+            self._violation(check, "Activity is undecidedly GPS-tracked")
+        if not act.Stationary:
+            if wptCt == 0:
+                self._violation(check, "Exactly 0 waypoints")
+            if wptCt == 1:
+                self._violation(check, "Only 1 waypoint")
+        if act.Stats.Distance.Value is not None and act.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value > 1000 * 1000:
+            self._violation(check, "Exceedingly long activity (distance)")
+        if act.StartTime.replace(tzinfo=None) > (datetime.now() + timedelta(days=5)):
+            self._violation(check, "Activity is from the future")
+        if act.StartTime.replace(tzinfo=None) < datetime(1995, 1, 1):
+            self._violation(check, "Activity falls implausibly far in the past")
+        if act.EndTime and act.EndTime.replace(tzinfo=None) > (datetime.now() + timedelta(days=5 + 5)): # Based on the 5-day activity length limit imposed later.
+            self._violation(check, "Activity ends in the future")
+
+        if act.StartTime and act.EndTime:
+            # We can only do these checks if the activity has both start and end times (Dropbox)
+            if (act.EndTime - act.StartTime).total_seconds() < 0:
+                self._violation(check, "Event finishes before it starts")
+            if (act.EndTime - act.StartTime).total_seconds() == 0:
+                self._violation(check, "0-duration activity")
+            if (act.EndTime - act.StartTime).total_seconds() > 60 * 60 * 24 * 5:
+                self._violation(check, "Exceedingly long activity (time)")
+
+        if len(act.Laps) == 1:
+            if act.Laps[0].Stats != act.Stats:
+                self._violation(check, "Activity with 1 lap has mismatching statistics between activity and lap")
+
+    def _processLap(self, lapIdx, lap):
+        act = self._act
+        if self._sanity:
+            if not lap.StartTime:
+                self._violation(ValidationCheck.Sanity, "Lap has no start time", lap=lapIdx)
+            if not lap.EndTime:
+                self._violation(ValidationCheck.Sanity, "Lap has no end time", lap=lapIdx)
+        if self._timestamps:
+            if lap.StartTime.tzinfo != act.TZ:
+                self._tzMismatch("Lap StartTime TZ mismatch - %s master vs %s instance" % (act.TZ, lap.StartTime.tzinfo), lap=lapIdx)
+            if lap.EndTime.tzinfo != act.TZ:
+                self._tzMismatch("Lap EndTime TZ mismatch - %s master vs %s instance" % (act.TZ, lap.EndTime.tzinfo), lap=lapIdx)
+
+        if lap.Track is not None:
+            extent = self._processTrack(lapIdx, lap.Track)
+        else:
+            extent = self._processWaypoints(lapIdx, lap.Waypoints)
+
+        if self._timestamps and self._timestampsComparable:
+            if extent:
+                # Only the earliest and latest waypoints could be out of bounds
+                earliest, latest = extent
+                if lap.StartTime - earliest > ActivityValidator.TimestampLeeway:
+                    self._violation(ValidationCheck.Timestamps, "Waypoint occurs too far before lap", lap=lapIdx)
+                if latest - lap.EndTime > ActivityValidator.TimestampLeeway:
+                    self._violation(ValidationCheck.Timestamps, "Waypoint occurs too far after lap", lap=lapIdx)
+                if act.StartTime - earliest > ActivityValidator.TimestampLeeway:
+                    self._violation(ValidationCheck.Timestamps, "Waypoint occurs too far before activity", lap=lapIdx)
+                if latest - act.EndTime > ActivityValidator.TimestampLeeway:
+                    self._violation(ValidationCheck.Timestamps, "Waypoint occurs too far after activity", lap=lapIdx)
+
+            if act.StartTime - lap.StartTime > ActivityValidator.TimestampLeeway:
+                self._violation(ValidationCheck.Timestamps, "Lap starts too far before activity", lap=lapIdx)
+            if lap.EndTime - act.EndTime > ActivityValidator.TimestampLeeway:
+                self._violation(ValidationCheck.Timestamps, "Lap ends too far after activity", lap=lapIdx)
+
+    def _processWaypoints(self, lapIdx, waypoints):
+        # Returns the earliest and latest timestamps, if checking those
+        # This is where all the time goes - hence the locals, and everything written out longhand
+        sanity, timestamps, cleanWaypoints = self._sanity, self._timestamps, self._cleanWaypoints
+        tz = self._act.TZ
+        pause = WaypointType.Pause
+        altLow, altHigh = self._altLow, self._altHigh
+        unpausedPoints = pointsWithLocation = 0
+        earliest = latest = None
+        for wpIdx, wp in enumerate(waypoints):
+            if sanity:
+                if wp.Type != pause:
+                    unpausedPoints += 1
+                loc = wp.Location
+                if loc:
+                    lat, lng, alt = loc.Latitude, loc.Longitude, loc.Altitude
+                    if lat == 0 and lng == 0:
+                        self._violation(ValidationCheck.Sanity, "Invalid lat/lng", lap=lapIdx, waypoint=wpIdx, once=True)
+                    if (lat is not None and (lat > 90 or lat < -90)) or (lng is not None and (lng > 180 or lng < -180)):
+                        self._violation(ValidationCheck.Sanity, "Out of range lat/lng", lap=lapIdx, waypoint=wpIdx, once=True)
+                    if alt is not None:
+                        if altLow is None or alt < altLow:
+                            altLow = alt
+                        if altHigh is None or alt > altHigh:
+                            altHigh = alt
+                    if lat is not None and lng is not None:
+                        pointsWithLocation += 1
+
+            if cleanWaypoints:
+                if wp.Distance and wp.Distance < 0:
+                    wp.Distance = 0
+                if wp.Speed and wp.Speed < 0:
+                    wp.Speed = 0
+                if wp.Cadence and wp.Cadence < 0:
+                    wp.Cadence = 0
+                if wp.RunCadence and wp.RunCadence < 0:
+                    wp.RunCadence = 0
+                if wp.Power and wp.Power < 0:
+                    wp.Power = 0
+                if wp.Calories and wp.Calories < 0:
+                    wp.Calories = 0
+                if wp.HR and wp.HR < 0:
+                    wp.HR = 0
+
+            if timestamps:
+                timestamp = wp.Timestamp
+                if timestamp.tzinfo != tz:
+                    self._tzMismatch("Waypoint TZ mismatch - %s master vs %s instance" % (tz, timestamp.tzinfo), lap=lapIdx, waypoint=wpIdx)
+                if not self._timestampsComparable:
+                    continue
+                if earliest is None or timestamp < earliest:
+                    earliest = timestamp
+                if latest is None or timestamp > latest:
+                    latest = timestamp
+
+        self._altLow, self._altHigh = altLow, altHigh
+        self._unpausedPoints += unpausedPoints
+        self._pointsWithLocation += pointsWithLocation
+        return (earliest, latest) if earliest is not None else None
+
+    def _processTrack(self, lapIdx, track):
+        # The same as _processWaypoints, straight off the Track's columns - NaN stands in for None (and conveniently fails every comparison)
+        # Scanning a column at a time with the builtins is far quicker than going point-by-point, so that's only done to find where a violation is
+        if self._sanity:
+            self._unpausedPoints += len(track) - track.Type.count(WaypointType.Pause)
+            located = [idx for idx, hasLocation in enumerate(track.HasLocation) if hasLocation] if track.HasLocation.count(0) else range(len(track))
+            lats = [track.Latitude[idx] for idx in located] if len(located) != len(track) else track.Latitude
+            lngs = [track.Longitude[idx] for idx in located] if len(located) != len(track) else track.Longitude
+            alts = [alt for alt in (track.Altitude[idx] for idx in located) if alt == alt]
+
+            if 0 in lats and 0 in lngs:
+                for idx, lat, lng in zip(located, lats, lngs):
+                    if lat == 0 and lng == 0:
+                        self._violation(ValidationCheck.Sanity, "Invalid lat/lng", lap=lapIdx, waypoint=idx, once=True)
+                        break
+            validLats = [lat for lat in lats if lat == lat]
+            validLngs = [lng for lng in lngs if lng == lng]
+            if (validLats and (max(validLats) > 90 or min(validLats) < -90)) or (validLngs and (max(validLngs) > 180 or min(validLngs) < -180)):
+                for idx, lat, lng in zip(located, lats, lngs):
+                    if lat > 90 or lat < -90 or lng > 180 or lng < -180:
+                        self._violation(ValidationCheck.Sanity, "Out of range lat/lng", lap=lapIdx, waypoint=idx, once=True)
+                        break
+            if alts:
+                self._altLow = min(alts) if self._altLow is None else min(self._altLow, min(alts))
+                self._altHigh = max(alts) if self._altHigh is None else max(self._altHigh, max(alts))
+            if len(validLats) == len(validLngs) == len(located):
+                self._pointsWithLocation += len(located)
+            else:
+                self._pointsWithLocation += sum(1 for lat, lng in zip(lats, lngs) if lat == lat and lng == lng)
+
+        if self._cleanWaypoints:
+            for field in ActivityValidator.NonNegativeWaypointFields:
+                column = getattr(track, field)
+                if any(map((0.0).__gt__, column)):
+                    for idx, value in enumerate(column):
+                        if value < 0:
+                            column[idx] = 0
+
+        if self._timestamps and len(track):
+            # There's just the one TZ
+            if track.StartTime.tzinfo != self._act.TZ:
+                self._tzMismatch("Waypoint TZ mismatch - %s master vs %s instance" % (self._act.TZ, track.StartTime.tzinfo), lap=lapIdx, waypoint=0)
+            return track.TimestampRange()
+        return None
+
+    def _cleanStatsObj(stats):
+        converted = stats.asUnits({key: units for key, (units, low, high) in ActivityValidator.StatRanges.items()})
+        for key, (units, low, high) in ActivityValidator.StatRanges.items():
+            raw_stat = getattr(stats, key)
+            stat = getattr(converted, key)
+            for field in ActivityValidator.StatFields:
+                value = getattr(stat, field)
+                if value is not None and (value < low or value > high):
+                    raw_stat._samples[field] = 0 # Need to update the original (raw_stat), not the asUnits copy (stat)
+                    setattr(raw_stat, field, None)
@@ -0,0 +1,149 @@
+from tapiriik.services.interchange import ActivityType
+from datetime import datetime, timedelta
+import bisect
+
+_epoch = datetime(1970, 1, 1)
+_microsecond = timedelta(microseconds=1)
+
+# Everything here is in integer microseconds, so the comparisons are exact.
+ACTIVITY_START_LEEWAY = 3 * 60 * 1000000
+ACTIVITY_START_TZ_OFFSET_LEEWAY = 60 * 1000000
+HALF_HOUR = 30 * 60 * 1000000
+TIMEZONE_ERROR_PERIOD = 38 * 60 * 60 * 1000000
+
+
+class _MatchKey:
+    """ The parts of an activity's start time that the duplicate checks look at, worked out once """
+    __slots__ = ("Naive", "UTC", "Day", "Minute", "WithinHour", "UID")
+
+    def __init__(self, activity):
+        start = activity.StartTime
+        naive = start.replace(tzinfo=None)
+        self.Naive = (naive - _epoch) // _microsecond
+        self.UTC = self.Naive - start.utcoffset() // _microsecond if start.tzinfo is not None else None
+        self.Day = naive.toordinal()
+        self.Minute = naive.minute
+        self.WithinHour = (naive.minute * 60 + naive.second) * 1000000 + naive.microsecond
+        self.UID = activity.UID
+
+
+class ActivityMatcher:
+    """ Finds the already-listed activity that an incoming one duplicates, if any.
+
+    This does the same thing as bisecting the most-recent-first activity list for a +/- 38 hour window and checking each activity in it
+    (it even takes the same path through the list when it's been knocked out of order by merges), but the start times are only taken apart once.
+    A UID map, a sorted index of start times, and (day, minute) buckets rule out most incoming activities without looking at the window at all.
+    """
+    def __init__(self, activities):
+        self.Activities = activities
+        self._keys = [_MatchKey(x) for x in activities]
+        # Negated so the list sorts the same way as the activities (most recent first)
+        self._order = [-x.Naive for x in self._keys]
+        self._naiveIndex = sorted(x.Naive for x in self._keys)
+        self._utcIndex = sorted(x.UTC for x in self._keys if x.UTC is not None)
+        self._uids = {}
+        self._buckets = {}
+        for key in self._keys:
+            self._indexKey(key)
+
+    def _indexKey(self, key):
+        self._uids[key.UID] = self._uids.get(key.UID, 0) + 1
+        bucket = (key.Day, key.Minute)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def _unindexKey(self, key):
+        self._uids[key.UID] -= 1
+        if not self._uids[key.UID]:
+            del self._uids[key.UID]
+        bucket = (key.Day, key.Minute)
+        self._buckets[bucket] -= 1
+        if not self._buckets[bucket]:
+            del self._buckets[bucket]
+
+    def _anyWithin(self, index, value, leeway):
+        pos = bisect.bisect_right(index, value - leeway)
+        return pos < len(index) and index[pos] < value + leeway
+
+    def _couldMatch(self, key):
+        if key.UID in self._uids:
+            return True
+        if self._anyWithin(self._naiveIndex, key.Naive, ACTIVITY_START_LEEWAY):
+            return True
+        if key.UTC is not None and self._anyWithin(self._utcIndex, key.UTC, ACTIVITY_START_LEEWAY):
+            return True
+        # Same mm:ss (give or take the leeway) on the same day, or 30 minutes off for half-hour time zones
+        for minute in (key.Minute - 1, key.Minute, key.Minute + 1, key.Minute - 31, key.Minute - 30, key.Minute - 29, key.Minute + 29, key.Minute + 30, key.Minute + 31):
+            if (key.Day, minute) in self._buckets:
+                return True
+        return False
+
+    def _keysMatch(self, key, existing):
+        # Identical
+        if existing.UID == key.UID:
+            return True
+        # Check to see if the activities are reasonably close together to be considered duplicate
+        # If only one is TZ-aware, compare the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
+        if (existing.UTC is None) == (key.UTC is None):
+            startDelta = key.UTC - existing.UTC if key.UTC is not None else key.Naive - existing.Naive
+        else:
+            startDelta = key.Naive - existing.Naive
+        if abs(startDelta) < ACTIVITY_START_LEEWAY:
+            return True
+        # Sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
+        # So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
+        #  (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
+        # There's a very low chance that two activities in this period would intersect and be merged together.
+        # But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
+        # (mm:ss is compared with the date attached, so these only ever match within the same day)
+        if existing.Day == key.Day and abs(key.Naive - existing.Naive) < TIMEZONE_ERROR_PERIOD:
+            offsetDelta = abs(key.WithinHour - existing.WithinHour)
+            if offsetDelta < ACTIVITY_START_TZ_OFFSET_LEEWAY:
+                return True
+            # Similarly, for half-hour time zones (there are a handful of quarter-hour ones, but I've got to draw a line somewhere, even if I revise it several times)
+            if HALF_HOUR - ACTIVITY_START_TZ_OFFSET_LEEWAY // 2 < offsetDelta < HALF_HOUR + ACTIVITY_START_TZ_OFFSET_LEEWAY // 2:
+                return True
+        return False
+
+    def FindMatch(self, activity):
+        """ Returns the index of the first activity in the list that the given activity duplicates, or None """
+        key = _MatchKey(activity)
+        if not self._couldMatch(key):
+            return None
+        start = bisect.bisect_left(self._order, -(key.Naive + TIMEZONE_ERROR_PERIOD))
+        end = bisect.bisect_right(self._order, -(key.Naive - TIMEZONE_ERROR_PERIOD), lo=start)
+        for idx in range(start, end):
+            if not self._keysMatch(key, self._keys[idx]):
+                continue
+            existing = self.Activities[idx]
+            # Prevents closely-spaced activities of known different type from being lumped together - esp. important for manually-enetered ones
+            if existing.Type == ActivityType.Other or activity.Type == ActivityType.Other or existing.Type == activity.Type or ActivityType.AreVariants([activity.Type, existing.Type]):
+                return idx
+        return None
+
+    def Insert(self, activity):
+        """ Adds the activity to the list, exactly where bisect.insort_left would have """
+        key = _MatchKey(activity)
+        idx = bisect.bisect_left(self._order, -key.Naive)
+        self.Activities.insert(idx, activity)
+        self._order.insert(idx, -key.Naive)
+        self._keys.insert(idx, key)
+        bisect.insort(self._naiveIndex, key.Naive)
+        if key.UTC is not None:
+            bisect.insort(self._utcIndex, key.UTC)
+        self._indexKey(key)
+
+    def Refresh(self, idx):
+        """ Re-reads the activity at the given index after it's been modified (i.e. merged with another) - it keeps its place in the list """
+        oldKey = self._keys[idx]
+        del self._naiveIndex[bisect.bisect_left(self._naiveIndex, oldKey.Naive)]
+        if oldKey.UTC is not None:
+            del self._utcIndex[bisect.bisect_left(self._utcIndex, oldKey.UTC)]
+        self._unindexKey(oldKey)
+
+        key = _MatchKey(self.Activities[idx])
+        self._keys[idx] = key
+        self._order[idx] = -key.Naive
+        bisect.insort(self._naiveIndex, key.Naive)
+        if key.UTC is not None:
+            bisect.insort(self._utcIndex, key.UTC)
+        self._indexKey(key)
@@ -1,6 +1,11 @@
 from datetime import datetime
+from tapiriik.database import db
 from tapiriik.services.interchange import ActivityStatisticUnit
 from tapiriik.services.api import UserException
+from tapiriik.settings import ACTIVITY_RECORDS_STORAGE
+from bson.objectid import ObjectId
+from pymongo.operations import ReplaceOne
+import pymongo
 
 class ActivityRecord:
     def __init__(self, dbRec=None):
@@ -109,3 +114,129 @@ class ActivityServicePrescence:
             raise ValueError("Provided UserException %s is not a UserException" % userException)
         self.UserException = userException
 
+
+class ActivityRecordStore:
+    """
+    Where a user's activity records live.
+
+    "document" - the original layout: one activity_records document per user, with every record in its Activities array, rewritten in full each sync.
+    "collection" - one activity_record_entries document per activity, and only the records touched during a sync are written back.
+
+    Users are moved from the former to the latter the first time they're synced in "collection" mode - and back again the first time they're synced in "document" mode, should it be switched back.
+    """
+    _indexesEnsured = False
+
+    def __init__(self, userId, storage=None):
+        self.UserID = userId
+        self.Storage = storage or ACTIVITY_RECORDS_STORAGE
+        if self.Storage not in ("document", "collection"):
+            raise ValueError("Unknown activity record storage %s" % self.Storage)
+        self._loadedIDs = set()
+        self._migrating = False
+
+    def _ensureIndexes():
+        if not ActivityRecordStore._indexesEnsured:
+            db.activity_record_entries.create_index([("UserID", pymongo.ASCENDING), ("StartTime", pymongo.DESCENDING)])
+            ActivityRecordStore._indexesEnsured = True
+
+    def _fetchDocument(userId, fields=None):
+        projection = dict([("Activities." + x, 1) for x in fields]) if fields else None
+        document = db.activity_records.find_one({"UserID": userId}, projection)
+        return document["Activities"] if document and "Activities" in document else None
+
+    def _fetchEntries(userId, fields=None):
+        projection = None
+        if fields:
+            projection = dict([(x, 1) for x in fields])
+            projection["_id"] = 1 if "_id" in fields else 0
+        entries = list(db.activity_record_entries.find({"UserID": userId}, projection).sort("StartTime", pymongo.DESCENDING))
+        return entries if entries else None
+
+    def Fetch(userId, fields=None, storage=None):
+        """ The raw records for a user (most recent first), wherever they're stored - fields limits what's returned """
+        storage = storage or ACTIVITY_RECORDS_STORAGE
+        if storage == "collection":
+            records = ActivityRecordStore._fetchEntries(userId, fields)
+            if records is None:
+                # This user hasn't been moved over yet.
+                records = ActivityRecordStore._fetchDocument(userId, fields)
+        else:
+            records = ActivityRecordStore._fetchDocument(userId, fields)
+            if records is None:
+                # ...or was moved over, before the storage was switched back.
+                records = ActivityRecordStore._fetchEntries(userId, fields)
+        return records if records else []
+
+    def ClearFailureCounts(userId, serviceId):
+        db.activity_record_entries.update({"UserID": userId, "FailureCounts." + serviceId: {"$exists": True}}, {"$unset": {"FailureCounts." + serviceId: ""}}, multi=True)
+        act_recs = db.activity_records.find_one({"UserID": userId})
+        if act_recs:
+            for act in act_recs["Activities"]:
+                if "FailureCounts" in act and serviceId in act["FailureCounts"]:
+                    del act["FailureCounts"][serviceId]
+            db.activity_records.save(act_recs)
+
+    def Load(self):
+        """ Returns the raw records to build ActivityRecords from - those in "collection" mode have an _id, which needs to stay with the record """
+        if self.Storage == "document":
+            records = ActivityRecordStore._fetchDocument(self.UserID)
+            if records is None:
+                records = ActivityRecordStore._fetchEntries(self.UserID)
+                if records is None:
+                    return []
+                # Moved back into the document on the next save
+                self._migrating = True
+            return records
+        records = ActivityRecordStore._fetchEntries(self.UserID)
+        if records is None:
+            records = ActivityRecordStore._fetchDocument(self.UserID)
+            if records is None:
+                return []
+            # Everything gets written out on the next save
+            self._migrating = True
+        self._loadedIDs = set(x["_id"] for x in records if "_id" in x)
+        return records
+
+    def Save(self, records, compose):
+        """ Writes back the given records (anything left out is removed), using compose(record) to build the document for each """
+        if self.Storage == "document":
+            records.sort(key=lambda x: x.StartTime.replace(tzinfo=None), reverse=True)
+            db.activity_records.update(
+                {"UserID": self.UserID},
+                {
+                    "$set": {
+                        "UserID": self.UserID,
+                        "Activities": [compose(x) for x in records]
+                    }
+                },
+                upsert=True
+            )
+            if self._migrating:
+                # Only now that everything is safely in the document
+                db.activity_record_entries.remove({"UserID": self.UserID})
+                self._migrating = False
+            return
+
+        ActivityRecordStore._ensureIndexes()
+        writes = []
+        for record in records:
+            if not self._migrating and not getattr(record, "Touched", True) and "_id" in record.__dict__:
+                continue # Nothing could have changed
+            if "_id" not in record.__dict__:
+                record._id = ObjectId()
+            document = compose(record)
+            document["_id"] = record._id
+            document["UserID"] = self.UserID
+            writes.append(ReplaceOne({"_id": record._id}, document, upsert=True))
+        if writes:
+            db.activity_record_entries.bulk_write(writes, ordered=False)
+
+        droppedIDs = self._loadedIDs - set(x._id for x in records)
+        if droppedIDs:
+            db.activity_record_entries.remove({"_id": {"$in": list(droppedIDs)}})
+        self._loadedIDs = set(x._id for x in records)
+
+        if self._migrating:
+            # Only now that everything is safely in the collection
+            db.activity_records.remove({"UserID": self.UserID})
+            self._migrating = False
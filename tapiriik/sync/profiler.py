@@ -0,0 +1,64 @@
+from tapiriik.database import db
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import time
+
+# So the odd enormous exhaustive sync doesn't produce an enormous stats record
+MAX_SAMPLES_PER_SPAN = 100
+
+
+class SyncProfiler:
+    """ Adds up how long each phase of a sync spends in each service (or in the database, etc.) - written to sync_timing_stats when the sync's done.
+
+    stats_cron.py works out the percentiles per phase and service from there, for the diagnostics dashboard.
+    """
+    def __init__(self):
+        self._spans = {}
+        self._lock = threading.Lock()
+        self._step = None
+        self._stepStart = None
+
+    def BeginStep(self, step):
+        # Steps run one after another, so each one ends when the next begins (or at EndStep)
+        self.EndStep()
+        self._step = step
+        self._stepStart = time.time()
+
+    def EndStep(self):
+        if self._step is not None:
+            self.Record(self._step, None, time.time() - self._stepStart)
+        self._step = None
+
+    @contextmanager
+    def Span(self, phase, service=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.Record(phase, service, time.time() - start)
+
+    def Record(self, phase, service, duration):
+        with self._lock:
+            span = self._spans.setdefault((phase, service), {"Phase": phase, "Service": service, "Count": 0, "Time": 0, "Durations": []})
+            span["Count"] += 1
+            span["Time"] += duration
+            if len(span["Durations"]) < MAX_SAMPLES_PER_SPAN:
+                span["Durations"].append(duration)
+
+    def Spans(self):
+        with self._lock:
+            return sorted(self._spans.values(), key=lambda span: (span["Phase"], span["Service"] or ""))
+
+    def Persist(self, user_id, worker=None, host=None):
+        spans = self.Spans()
+        if spans:
+            db.sync_timing_stats.insert({"Timestamp": datetime.utcnow(), "User": user_id, "Worker": worker, "Host": host, "Spans": spans})
+
+
+def percentile(values, fraction):
+    # Nearest-rank - plenty for a dashboard
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
@@ -1,8 +1,12 @@
 from tapiriik.database import db, cachedb, redis
+from tapiriik.database.write_buffer import WriteBuffer
 from tapiriik.messagequeue import mq
 from tapiriik.services import Service, ServiceRecord, APIExcludeActivity, ServiceException, ServiceExceptionScope, ServiceWarning, UserException, UserExceptionType
-from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES, WITHDRAWN_SERVICES
-from .activity_record import ActivityRecord, ActivityServicePrescence
+from tapiriik.services.http_metrics import HTTPMetrics
+from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES, WITHDRAWN_SERVICES, SYNC_ACTIVITY_CONCURRENCY, SYNC_SERVICE_CONCURRENCY, SYNC_LISTING_CONCURRENCY, SYNC_WRITE_BUFFER_MAX_OPERATIONS, SYNC_WRITE_BUFFER_FLUSH_ON_UPLOAD, SYNC_PRIORITY_WEIGHTS, SYNC_ADAPTIVE_INTERVAL_WINDOW_DAYS, SYNC_ADAPTIVE_INTERVAL_MAX_HOURS, SYNC_ADAPTIVE_INTERVAL_CHECKS_PER_ACTIVITY, USER_SYNC_LOG_FLUSH_BYTES, SYNC_IDLE_POLL_MAX_SECONDS
+from .activity_record import ActivityRecord, ActivityServicePrescence, ActivityRecordStore
+from .activity_matcher import ActivityMatcher
+from .profiler import SyncProfiler
 from datetime import datetime, timedelta
 from tapiriik.services.RunnersConnect import RunnersConnectService
 
@@ -15,11 +19,15 @@ import pprint
 import copy
 import random
 import logging
-import logging.handlers
 import pytz
 import kombu
+import pymongo
 import json
-import bisect
+import threading
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # Set this up separate from the logger used in this scope, so services logging messages are caught and logged into user's files.
 _global_logger = logging.getLogger("tapiriik")
@@ -36,6 +44,23 @@ if hasattr(sys.stdout, "buffer"):
 
 logger = logging.getLogger("tapiriik.sync.worker")
 
+# Which sync the current thread is working on - so when several users are synchronized at once, each sync's log only gets its own messages.
+_syncLogContext = threading.local()
+
+class _SyncLogSink(logging.Handler):
+    # One handler for every sync in the process - it collects messages into the current sync's buffer, which is appended to the user's log file as it fills up and when the sync finishes.
+    # (rather than adding, rolling over, and removing a file handler on the global logger for each sync)
+    def emit(self, record):
+        task = getattr(_syncLogContext, "task", None)
+        if task is None or task._logBuffer is None:
+            return
+        try:
+            task._appendUserLog(task._logFormatter.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+_global_logger.addHandler(_SyncLogSink())
+
 def _formatExc():
     try:
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -91,15 +116,62 @@ class Sync:
     MinimumSyncInterval = timedelta(seconds=30)
     MaximumIntervalBeforeExhaustiveSync = timedelta(days=3)  # Based on the general page size of 50 activites, this would be >3/day...
 
-    def ScheduleImmediateSync(user, exhaustive=None):
-        if exhaustive is None:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow()}})
-        else:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow(), "NextSyncIsExhaustive": exhaustive}})
+    def ScheduleImmediateSync(user, exhaustive=None, priority=None):
+        # These are almost always someone waiting on the other end, so they skip ahead of the periodic syncs (see SyncPriority)
+        update = {"NextSynchronization": datetime.utcnow(), "NextSyncPriority": priority if priority else SyncPriority.Manual}
+        if exhaustive is not None:
+            update["NextSyncIsExhaustive"] = exhaustive
+        db.users.update({"_id": user["_id"]}, {"$set": update})
+
+    def AdaptiveSyncInterval(activityStartTimes, now=None):
+        # Users who record a lot are synchronized every SyncInterval, those who rarely do are checked less often (up to SYNC_ADAPTIVE_INTERVAL_MAX_HOURS)
+        #  - aiming for SYNC_ADAPTIVE_INTERVAL_CHECKS_PER_ACTIVITY syncs in the typical gap between their recent activities.
+        # Partial sync triggers and manual syncs still bring the next sync forward to right away.
+        now = now if now else datetime.utcnow()
+        window = timedelta(days=SYNC_ADAPTIVE_INTERVAL_WINDOW_DAYS)
+        maxInterval = timedelta(hours=SYNC_ADAPTIVE_INTERVAL_MAX_HOURS)
+        recentActivities = 0
+        for startTime in activityStartTimes:
+            if startTime is None:
+                continue
+            if startTime.tzinfo:
+                startTime = startTime.astimezone(pytz.utc).replace(tzinfo=None)
+            if now - window <= startTime <= now:
+                recentActivities += 1
+        if not recentActivities:
+            return max(Sync.SyncInterval, maxInterval)
+        interval = window / recentActivities / SYNC_ADAPTIVE_INTERVAL_CHECKS_PER_ACTIVITY
+        return max(Sync.SyncInterval, min(maxInterval, interval))
 
     def SetNextSyncIsExhaustive(user, exhaustive=False):
         db.users.update({"_id": user["_id"]}, {"$set": {"NextSyncIsExhaustive": exhaustive}})
 
+    def IsNextSyncExhaustive(user):
+        # Always to an exhaustive sync if there were errors
+        #   Sometimes services report that uploads failed even when they succeeded.
+        #   If a partial sync was done, we'd be assuming that the accounts were consistent past the first page
+        #       e.g. If an activity failed to upload far in the past, it would never be attempted again.
+        #   So we need to verify the full state of the accounts.
+        # But, we can still do a partial sync if there are *only* blocking errors
+        #   In these cases, the block will protect that service from being improperly manipulated (though tbqh I can't come up with a situation where this would happen, it's more of a performance thing).
+        #   And, when the block is cleared, NextSyncIsExhaustive is set.
+
+        exhaustive = "NextSyncIsExhaustive" in user and user["NextSyncIsExhaustive"] is True
+        if  ("ForcingExhaustiveSyncErrorCount" not in user and "NonblockingSyncErrorCount" in user and user["NonblockingSyncErrorCount"] > 0) or \
+            ("ForcingExhaustiveSyncErrorCount" in user and user["ForcingExhaustiveSyncErrorCount"] > 0):
+            exhaustive = True
+        return exhaustive
+
+    def NextSyncPriority(user):
+        # Used by sync_scheduler.py to pick the queue - so the user record needs NextSyncPriority and the fields IsNextSyncExhaustive looks at
+        if "NextSyncPriority" in user and user["NextSyncPriority"]:
+            return user["NextSyncPriority"]
+        return SyncPriority.Exhaustive if Sync.IsNextSyncExhaustive(user) else SyncPriority.Periodic
+
+    def RoutingKey(priority):
+        # Periodic syncs keep using the original queue
+        return "" if priority == SyncPriority.Periodic else "priority-%s" % priority
+
     def InitializeWorkerBindings():
         Sync._channel = mq.channel()
         Sync._exchange = kombu.Exchange("tapiriik-users", type="direct")(Sync._channel)
@@ -111,40 +183,131 @@ class Sync:
         # Bind to worker-specific and general routing keys
         Sync._global_queue.bind_to(exchange="tapiriik-users", routing_key="")
         Sync._host_queue.bind_to(exchange="tapiriik-users", routing_key=socket.gethostname())
+        # ...and a queue for each priority lane
+        Sync._priority_queues = {SyncPriority.Periodic: Sync._global_queue}
+        for priority in SyncPriority.All:
+            if priority not in Sync._priority_queues:
+                Sync._priority_queues[priority] = kombu.Queue("tapiriik-users-%s" % priority)(Sync._channel)
+                Sync._priority_queues[priority].declare()
+                Sync._priority_queues[priority].bind_to(exchange="tapiriik-users", routing_key=Sync.RoutingKey(priority))
+
+    def _priorityQueueOrder(credits):
+        # Smooth weighted round-robin: every lane gets served in proportion to its weight (so nothing starves), but the heavier ones go first more often.
+        # The lane that's up is tried first, then the rest by priority - so an empty lane doesn't waste a turn.
+        for priority in SyncPriority.All:
+            credits[priority] += SYNC_PRIORITY_WEIGHTS[priority]
+        chosen = max(SyncPriority.All, key=lambda priority: credits[priority])
+        credits[chosen] -= sum(SYNC_PRIORITY_WEIGHTS[priority] for priority in SyncPriority.All)
+        return [chosen] + [priority for priority in SyncPriority.All if priority != chosen]
+
+    def _nextSyncTaskMessage(credits):
+        # Host-restricted users can't be picked up anywhere else
+        message = Sync._host_queue.get(no_ack=False)
+        if message:
+            return message
+        for priority in Sync._priorityQueueOrder(credits):
+            message = Sync._priority_queues[priority].get(no_ack=False)
+            if message:
+                return message
+        return None
 
-    def PerformGlobalSync(heartbeat_callback=None, version=None, max_users=None):
-        def _callback(body, message):
-            Sync._consumeSyncTask(body, message, heartbeat_callback, version)
-
-        Sync._consumer = kombu.Consumer(
-            channel=Sync._channel,
-            queues=[Sync._host_queue, Sync._global_queue],
-            callbacks=[_callback],
-            auto_declare=False
-        )
+    def PerformGlobalSync(heartbeat_callback=None, version=None, max_users=None, concurrency=1, recycle_check=None):
+        # Up to `concurrency` users are synchronized at once, each on its own thread (and in its own heartbeat slot).
+        # The kombu channel isn't thread-safe, so messages are only ever fetched and acknowledged from this thread.
+        # Messages are pulled (with basic_get) from the priority lanes in weighted turns, only when there's a free slot for them.
+        # Each check is a round trip per queue, so the wait between them doubles (up to SYNC_IDLE_POLL_MAX_SECONDS) for as long as the queues stay empty.
+        # Stops taking new users once max_users have been started, or recycle_check() returns True - then finishes the ones in progress.
+        pool = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+        completed = queue.Queue()
+        free_slots = list(range(concurrency))
+        in_flight = {}
+        credits = dict((priority, 0) for priority in SyncPriority.All)
+        state = {"started": 0, "stopping": False, "failure": None, "heartbeat": datetime.utcnow(), "idle_wait": 1}
+
+        def _run(body, message, slot):
+            try:
+                if pool:
+                    Sync._consumeSyncTask(body, lambda step, user=None: heartbeat_callback(step, user, slot=slot), version)
+                else:
+                    Sync._consumeSyncTask(body, heartbeat_callback, version)
+            except Exception as e:
+                completed.put((message, slot, e))
+            else:
+                completed.put((message, slot, None))
 
-        Sync._consumer.qos(prefetch_count=1, apply_global=False)
+        def _collect(timeout=None):
+            while True:
+                try:
+                    message, slot, failure = completed.get(timeout=timeout) if timeout else completed.get_nowait()
+                except queue.Empty:
+                    return
+                timeout = None
+                del in_flight[slot]
+                free_slots.append(slot)
+                if failure:
+                    # Left unacknowledged, so the user is picked up again once this worker has gone away
+                    logger.error("Sync task failed in slot %d: %s" % (slot, failure))
+                    state["failure"] = state["failure"] or failure
+                    state["stopping"] = True
+                else:
+                    message.ack()
+                if pool and heartbeat_callback:
+                    heartbeat_callback("ready", None, slot=slot)
 
-        Sync._consumer.consume()
+        try:
+            while True:
+                _collect()
+                if not state["stopping"] and ((max_users and state["started"] >= max_users) or (recycle_check and recycle_check())):
+                    state["stopping"] = True
+                if state["stopping"] and not in_flight:
+                    break
+                polling = free_slots and not state["stopping"]
+                message = Sync._nextSyncTaskMessage(credits) if polling else None
+                if message:
+                    state["idle_wait"] = 1
+                    state["started"] += 1
+                    slot = free_slots.pop(0)
+                    in_flight[slot] = message
+                    if pool:
+                        pool.submit(_run, message.payload, message, slot)
+                    else:
+                        _run(message.payload, message, slot)
+                else:
+                    wait = 1
+                    if polling:
+                        # Nothing queued
+                        wait = state["idle_wait"]
+                        state["idle_wait"] = min(wait * 2, SYNC_IDLE_POLL_MAX_SECONDS)
+                    if in_flight:
+                        _collect(timeout=wait) # Returns as soon as a slot frees up
+                    else:
+                        time.sleep(wait)
+                # The slots heartbeat themselves while they're working, this is for the process as a whole
+                if pool and heartbeat_callback and datetime.utcnow() - state["heartbeat"] > timedelta(seconds=30):
+                    heartbeat_callback("ready")
+                    state["heartbeat"] = datetime.utcnow()
+        finally:
+            if pool:
+                pool.shutdown(wait=True)
+                _collect()
 
-        for _ in kombu.eventloop(mq, limit=max_users):
-            pass
+        if state["failure"]:
+            raise state["failure"]
 
-    def _consumeSyncTask(body, message, heartbeat_callback_direct, version):
+    def _consumeSyncTask(body, heartbeat_callback_direct, version):
+        # The message is acknowledged by PerformGlobalSync once this returns
         from tapiriik.auth import User
 
         user_id = body["user_id"]
         user = User.Get(user_id)
         if user is None:
-            logger.warning("Could not find user %s - bailing" % user_id)
-            message.ack() # Otherwise the entire thing grinds to a halt
+            logger.warning("Could not find user %s - bailing" % user_id) # (still acknowledged, otherwise the entire thing grinds to a halt)
             return
         if body["generation"] != user.get("QueuedGeneration", None):
             # QueuedGeneration being different means they've gone through sync_scheduler since this particular message was queued
             # So, discard this and wait for that message to surface
             # Should only happen when I manually requeue people
             logger.warning("Queue generation mismatch for %s - bailing" % user_id)
-            message.ack()
             return
 
         def heartbeat_callback(state):
@@ -152,30 +315,20 @@ class Sync:
 
         syncStart = datetime.utcnow()
 
-        # Always to an exhaustive sync if there were errors
-        #   Sometimes services report that uploads failed even when they succeeded.
-        #   If a partial sync was done, we'd be assuming that the accounts were consistent past the first page
-        #       e.g. If an activity failed to upload far in the past, it would never be attempted again.
-        #   So we need to verify the full state of the accounts.
-        # But, we can still do a partial sync if there are *only* blocking errors
-        #   In these cases, the block will protect that service from being improperly manipulated (though tbqh I can't come up with a situation where this would happen, it's more of a performance thing).
-        #   And, when the block is cleared, NextSyncIsExhaustive is set.
-
-        exhaustive = "NextSyncIsExhaustive" in user and user["NextSyncIsExhaustive"] is True
-        if  ("ForcingExhaustiveSyncErrorCount" not in user and "NonblockingSyncErrorCount" in user and user["NonblockingSyncErrorCount"] > 0) or \
-            ("ForcingExhaustiveSyncErrorCount" in user and user["ForcingExhaustiveSyncErrorCount"] > 0):
-            exhaustive = True
+        exhaustive = Sync.IsNextSyncExhaustive(user)
 
+        task = SynchronizationTask(user)
         result = None
         try:
-            result = Sync.PerformUserSync(user, exhaustive, heartbeat_callback=heartbeat_callback)
+            result = task.Run(exhaustive=exhaustive, heartbeat_callback=heartbeat_callback, defer_log_write=True)
         finally:
             nextSync = None
             if User.HasActivePayment(user):
                 if User.GetConfiguration(user)["suppress_auto_sync"]:
                     logger.info("Not scheduling auto sync for paid user")
                 else:
-                    nextSync = datetime.utcnow() + Sync.SyncInterval + timedelta(seconds=random.randint(-Sync.SyncIntervalJitter.total_seconds(), Sync.SyncIntervalJitter.total_seconds()))
+                    interval = Sync.AdaptiveSyncInterval([x.StartTime for x in task._activityRecords]) if task._activityRecords is not None else Sync.SyncInterval
+                    nextSync = datetime.utcnow() + interval + timedelta(seconds=random.randint(-Sync.SyncIntervalJitter.total_seconds(), Sync.SyncIntervalJitter.total_seconds()))
             if result:
                 if result.ForceNextSync:
                     logger.info("Forcing next sync at %s" % result.ForceNextSync)
@@ -186,7 +339,8 @@ class Sync:
                     "LastSynchronization": datetime.utcnow(),
                     "LastSynchronizationVersion": version
                 }, "$unset": {
-                    "QueuedAt": None # Set by sync_scheduler when the record enters the MQ
+                    "QueuedAt": None, # Set by sync_scheduler when the record enters the MQ
+                    "NextSyncPriority": None # Any manual/triggered sync requested in the meantime is covered by this one
                 }
             }
             #NOTE: this is breaking worker
@@ -202,17 +356,12 @@ class Sync:
                 }, reschedule_update)
             reschedule_confirm_message = "User reschedule for %s returned %s" % (nextSync, scheduling_result)
 
-            # Tack this on the end of the log file since otherwise it's lost for good (blegh, but nicer than moving logging out of the sync task?)
-            user_log = open(USER_SYNC_LOGS + str(user["_id"]) + ".log", "a+")
-            user_log.write("\n%s\n" % reschedule_confirm_message)
-            user_log.close()
-
-            logger.debug(reschedule_confirm_message)
+            # Tack this on the end of the sync's log since otherwise it's lost for good
+            task._withLogContext(logger.debug, reschedule_confirm_message)
+            task._writeUserLog()
             syncTime = (datetime.utcnow() - syncStart).total_seconds()
             db.sync_worker_stats.insert({"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime})
 
-        message.ack()
-
     def PerformUserSync(user, exhaustive=False, heartbeat_callback=None):
         return SynchronizationTask(user).Run(exhaustive=exhaustive, heartbeat_callback=heartbeat_callback)
 
@@ -223,38 +372,169 @@ class SynchronizationTask:
 
     def __init__(self, user):
         self.user = user
+        # When activities are processed concurrently, the sync state (_syncErrors, exclusions, activity records, etc.) is guarded by _stateLock.
+        # It's held for everything except the actual calls out to the services, so the bookkeeping code can stay as it always was.
+        self._concurrent = False
+        self._stateLock = threading.Lock()
+        self._serviceSemaphores = {}
+        self._activityPool = None
+        self._activityFutures = []
+        self._listingPool = None
+        self._connectionIndex = {}
+        self._connectionIndexSource = None
+        # Kept up to date as activities are merged in, for as long as _activities isn't swapped out - see _accumulateActivities()
+        self._activityMatcher = None
+        # Per-activity bookkeeping writes are batched up in here - see _flushWrites()
+        self._writeBuffer = WriteBuffer(max_operations=SYNC_WRITE_BUFFER_MAX_OPERATIONS)
+        self._synchronizedActivitiesErrorHandlers = {}
+        self._logBuffer = None
+        # Reentrant, since a failure writing the log is itself logged
+        self._logLock = threading.RLock()
+        self._activityRecords = None
+        # Where the time goes - written to sync_timing_stats at the end of Run()
+        self._profiler = SyncProfiler()
+
+    def _acquireState(self):
+        if self._concurrent:
+            self._stateLock.acquire()
+
+    def _releaseState(self):
+        if self._concurrent:
+            self._stateLock.release()
+
+    @contextmanager
+    def _serviceCall(self, serviceRecord):
+        # Any HTTP requests made in here are counted against this service (see HTTPMetrics)
+        with HTTPMetrics.ServiceContext(serviceRecord.Service.ID):
+            if not self._concurrent:
+                yield
+                return
+            with self._concurrentServiceCall(serviceRecord):
+                yield
+
+    @contextmanager
+    def _concurrentServiceCall(self, serviceRecord):
+        # Lets other activities proceed while we wait on this service, subject to its concurrency cap.
+        semaphore = self._serviceSemaphores.get(serviceRecord.Service.ID)
+        self._stateLock.release()
+        try:
+            if semaphore:
+                semaphore.acquire()
+            try:
+                yield
+            finally:
+                if semaphore:
+                    semaphore.release()
+        finally:
+            self._stateLock.acquire()
 
     def _lockUser(self):
         db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationStartTime": datetime.utcnow()}})
 
     def _unlockUser(self):
-        unlock_result = db.users.update(
-            {
-                "_id": self.user["_id"]
-            }, {
-                "$unset": {
-                    "SynchronizationWorker": None
-                }
-            })
+        with self._profiler.Span("UnlockUser"):
+            unlock_result = db.users.update(
+                {
+                    "_id": self.user["_id"]
+                }, {
+                    "$unset": {
+                        "SynchronizationWorker": None
+                    }
+                })
         logger.debug("User unlock returned %s" % unlock_result)
 
     def _loadServiceData(self):
         self._connectedServiceIds = [x["ID"] for x in self.user["ConnectedServices"]]
         self._serviceConnections = [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": self._connectedServiceIds}})]
+        for conn in self._serviceConnections:
+            # These are checked for each activity and can get very long - and they're never written back wholesale.
+            if hasattr(conn, "SynchronizedActivities"):
+                conn.SynchronizedActivities = set(conn.SynchronizedActivities)
+
+    def _connectionByID(self, connId):
+        # Rebuilt whenever _serviceConnections is swapped out (or grows) from under us.
+        if self._connectionIndexSource is not self._serviceConnections or len(self._connectionIndex) != len(self._serviceConnections):
+            self._connectionIndex = dict((x._id, x) for x in self._serviceConnections)
+            self._connectionIndexSource = self._serviceConnections
+        return self._connectionIndex[connId]
 
     def _updateSyncProgress(self, step, progress):
-        db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationProgress": progress, "SynchronizationStep": step}})
+        # Only the latest progress update in the buffer is actually written.
+        self._writeBuffer.Update(db.users, {"_id": self.user["_id"]}, {"$set": {"SynchronizationProgress": progress, "SynchronizationStep": step}}, key="progress")
+
+    def _flushWrites(self):
+        # Called at checkpoints (after each service's listing, after each upload, before unlocking, ...)
+        # Everything in the buffer can be redone by the next sync, other than the record of successful uploads - which is why those are flushed right away by default.
+        if len(self._writeBuffer):
+            with self._profiler.Span("FlushWrites"):
+                self._writeBuffer.Flush()
+
+    def _markSynchronizedActivities(self, connId, activity):
+        # One handler per connection, so it isn't run once per merged update
+        if connId not in self._synchronizedActivitiesErrorHandlers:
+            self._synchronizedActivitiesErrorHandlers[connId] = lambda error: self._handleSynchronizedActivitiesWriteError(connId, error)
+        update = {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}}
+        # Partial listings can stop short of this (see ServiceBase._listingHighWaterMark)
+        conn = self._connectionByID(connId)
+        startTime = activity.StartTime.astimezone(pytz.utc).replace(tzinfo=None) if activity.StartTime.tzinfo else activity.StartTime
+        if not conn.ListingHighWaterMark or startTime > conn.ListingHighWaterMark["StartTime"]:
+            conn.ListingHighWaterMark = {"StartTime": startTime, "UID": activity.UID}
+            update["$set"] = {"ListingHighWaterMark": conn.ListingHighWaterMark}
+        self._writeBuffer.Update(db.connections, {"_id": connId}, update, key=("SynchronizedActivities", connId), on_error=self._synchronizedActivitiesErrorHandlers[connId])
+
+    def _handleSynchronizedActivitiesWriteError(self, connId, error):
+        if error["code"] == 17419: # Update makes document too large.
+            # Throw them all out - exhaustive sync will recover.
+            # I should probably check that this is actually due to transient issues - otherwise it'll keep happening.
+            db.connections.update({"_id": connId}, {"$unset": {"SynchronizedActivities": "", "ListingHighWaterMark": ""}})
+            self._sync_result.ForceExhaustive = True
+            return True
+        return False
 
     def _initializeUserLogging(self):
-        self._logging_file_handler = logging.handlers.RotatingFileHandler(USER_SYNC_LOGS + str(self.user["_id"]) + ".log", maxBytes=0, backupCount=5, encoding="utf-8")
-        self._logging_file_handler.setFormatter(logging.Formatter(self._logFormat, self._logDateFormat))
-        self._logging_file_handler.doRollover()
-        _global_logger.addHandler(self._logging_file_handler)
-
-    def _closeUserLogging(self):
-        _global_logger.removeHandler(self._logging_file_handler)
-        self._logging_file_handler.flush()
-        self._logging_file_handler.close()
+        self._logFormatter = logging.Formatter(self._logFormat, self._logDateFormat)
+        self._logBuffer = io.StringIO()
+        _syncLogContext.task = self
+
+    def _closeUserLogging(self, write=True):
+        _syncLogContext.task = None
+        if write:
+            self._writeUserLog()
+
+    def _appendUserLog(self, text):
+        with self._logLock:
+            if self._logBuffer is None:
+                return
+            self._logBuffer.write(text)
+            if self._logBuffer.tell() >= USER_SYNC_LOG_FLUSH_BYTES:
+                self._flushUserLog()
+
+    def _flushUserLog(self):
+        # Appends what's been logged so far to the user's log file, so a worker that's killed mid-sync doesn't take the whole log with it.
+        # Called every USER_SYNC_LOG_FLUSH_BYTES and between sync steps - sync_log_janitor.py rotates the files once they've grown large enough.
+        with self._logLock:
+            if self._logBuffer is None or not self._logBuffer.tell():
+                return
+            text = self._logBuffer.getvalue()
+            self._logBuffer = io.StringIO()
+            try:
+                with open(USER_SYNC_LOGS + str(self.user["_id"]) + ".log", "a", encoding="utf-8") as user_log:
+                    user_log.write(text)
+            except Exception:
+                logger.exception("Could not write sync log")
+
+    def _writeUserLog(self):
+        with self._logLock:
+            self._flushUserLog()
+            self._logBuffer = None
+
+    def _withLogContext(self, fn, *args):
+        # For work handed off to the listing/activity pools, so it still ends up in this sync's log
+        _syncLogContext.task = self
+        try:
+            return fn(*args)
+        finally:
+            _syncLogContext.task = None
 
     def _loadExtendedAuthData(self):
         self._extendedAuthDetails = list(cachedb.extendedAuthDetails.find({"ID": {"$in": self._connectedServiceIds}}))
@@ -324,9 +604,8 @@ class SynchronizationTask:
                     "Exception": _packUserException(presc.UserException)
                 }) for svcId, presc in prescences.items()])
 
-        self._activityRecords.sort(key=lambda x: x.StartTime.replace(tzinfo=None), reverse=True)
-        composed_records = [
-            {
+        def _composeRecord(x):
+            return {
                 "StartTime": x.StartTime,
                 "EndTime": x.EndTime,
                 "Type": x.Type,
@@ -340,27 +619,18 @@ class SynchronizationTask:
                 "Abscence": _activityPrescences(x.NotPresentOnServices),
                 "FailureCounts": x.FailureCounts
             }
-            for x in self._activityRecords
-        ]
 
-        db.activity_records.update(
-            {"UserID": self.user["_id"]},
-            {
-                "$set": {
-                    "UserID": self.user["_id"],
-                    "Activities": composed_records
-                }
-            },
-            upsert=True
-        )
+        self._activityRecordStore.Save(self._activityRecords, _composeRecord)
+        self._indexActivityRecords() # The store may have reordered them
 
     def _initializeActivityRecords(self):
-        raw_records = db.activity_records.find_one({"UserID": self.user["_id"]})
+        self._activityRecordStore = ActivityRecordStore(self.user["_id"])
+        raw_records = self._activityRecordStore.Load()
         self._activityRecords = []
+        self._indexActivityRecords()
         if not raw_records:
             return
         else:
-            raw_records = raw_records["Activities"]
             for raw_record in raw_records:
                 if "UIDs" not in raw_record:
                     continue # From the few days where this was rolled out without this key...
@@ -375,19 +645,41 @@ class SynchronizationTask:
                 del rec.Abscence
                 rec.Touched = False
                 self._activityRecords.append(rec)
+                self._indexActivityRecord(rec)
 
-    def _findOrCreateActivityRecord(self, activity):
+    def _indexActivityRecords(self):
+        # UID -> the records that have it, so we don't scan every record the user has ever had for each activity.
+        self._activityRecordIndex = {}
+        self._activityRecordPositions = {}
         for record in self._activityRecords:
-            if record.UIDs & activity.UIDs:
-                record.Touched = True
-                return record
+            self._indexActivityRecord(record)
+
+    def _indexActivityRecord(self, record):
+        # Records only ever get appended, so the order they're first indexed in is their order in the list.
+        if id(record) not in self._activityRecordPositions:
+            self._activityRecordPositions[id(record)] = len(self._activityRecordPositions)
+        for uid in record.UIDs:
+            indexedRecords = self._activityRecordIndex.setdefault(uid, [])
+            if not any(x is record for x in indexedRecords):
+                indexedRecords.append(record)
+
+    def _findOrCreateActivityRecord(self, activity):
+        # The index can hold UIDs that a record no longer has (SetActivity replaces them), so these are double-checked.
+        # If several records match, the one earliest in the list wins, as it always has.
+        matchingRecords = [record for uid in activity.UIDs for record in self._activityRecordIndex.get(uid, []) if record.UIDs & activity.UIDs]
+        if matchingRecords:
+            record = min(matchingRecords, key=lambda x: self._activityRecordPositions[id(x)])
+            record.Touched = True
+            return record
         record = ActivityRecord.FromActivity(activity)
         record.Touched = True
         self._activityRecords.append(record)
+        self._indexActivityRecord(record)
         return record
 
     def _dropUntouchedActivityRecords(self):
         self._activityRecords[:] = [x for x in self._activityRecords if x.Touched]
+        self._indexActivityRecords()
 
     def _persistServiceTrigger(self, serviceRecord):
         self._persistTriggerServices[serviceRecord._id] = True
@@ -413,7 +705,7 @@ class SynchronizationTask:
             if conn._id in activity.ServiceDataCollection:
                 # The activity record is updated earlier for these, blegh.
                 continue
-            elif hasattr(conn, "SynchronizedActivities") and len([x for x in activity.UIDs if x in conn.SynchronizedActivities]):
+            elif hasattr(conn, "SynchronizedActivities") and not activity.UIDs.isdisjoint(conn.SynchronizedActivities):
                 continue
             elif activity.Type not in conn.Service.SupportedActivities:
                 logger.debug("\t...%s doesn't support type %s" % (conn.Service.ID, activity.Type))
@@ -442,11 +734,12 @@ class SynchronizationTask:
             return a
 
     def _accumulateActivities(self, conn, svcActivities, no_add=False):
-        # Yep, abs() works on timedeltas
-        activityStartLeeway = timedelta(minutes=3)
-        activityStartTZOffsetLeeway = timedelta(minutes=1)
-        timezoneErrorPeriod = timedelta(hours=38)
         from tapiriik.services.interchange import ActivityType
+        # self._activities is sorted most recent first - the matcher keeps it that way as activities are added.
+        # Every change made here goes through the matcher (Insert/Refresh), so it only needs to be built again if the list is replaced.
+        if self._activityMatcher is None or self._activityMatcher.Activities is not self._activities:
+            self._activityMatcher = ActivityMatcher(self._activities)
+        matcher = self._activityMatcher
         for act in svcActivities:
             act.UIDs = set([act.UID])
             if not hasattr(act, "ServiceDataCollection"):
@@ -459,59 +752,10 @@ class SynchronizationTask:
             if act.TZ and not hasattr(act.TZ, "localize"):
                 raise ValueError("Got activity with TZ type " + str(type(act.TZ)) + " instead of a pytz timezone")
             # Used to ensureTZ() right here - doubt it's needed any more?
-            # Binsearch to find which activities actually need individual attention.
+            # The matcher takes care of finding which activities actually need individual attention.
             # Otherwise it's O(mn^2).
-            # self._activities is sorted most recent first
-            relevantActivitiesStart = bisect.bisect_left(self._activities, act.StartTime + timezoneErrorPeriod)
-            relevantActivitiesEnd = bisect.bisect_right(self._activities, act.StartTime - timezoneErrorPeriod, lo=relevantActivitiesStart)
-            extantActIter = (
-                              x for x in (self._activities[idx] for idx in range(relevantActivitiesStart, relevantActivitiesEnd)) if
-                              (
-                                  # Identical
-                                  x.UID == act.UID
-                                  or
-                                  # Check to see if the self._activities are reasonably close together to be considered duplicate
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   (act.StartTime.tzinfo is not None) == (x.StartTime.tzinfo is not None) and
-                                   abs(act.StartTime-x.StartTime) < activityStartLeeway
-                                  )
-                                  or
-                                  # Try comparing the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   (act.StartTime.tzinfo is not None) != (x.StartTime.tzinfo is not None) and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < activityStartLeeway
-                                  )
-                                  or
-                                  # Sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
-                                  # So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
-                                  #  (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
-                                  # There's a very low chance that two activities in this period would intersect and be merged together.
-                                  # But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < activityStartTZOffsetLeeway
-                                   )
-                                  or
-                                  # Similarly, for half-hour time zones (there are a handful of quarter-hour ones, but I've got to draw a line somewhere, even if I revise it several times)
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) > timedelta(minutes=30) - (activityStartTZOffsetLeeway / 2) and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < timedelta(minutes=30) + (activityStartTZOffsetLeeway / 2)
-                                   )
-                               )
-                                and
-                                # Prevents closely-spaced activities of known different type from being lumped together - esp. important for manually-enetered ones
-                                (x.Type == ActivityType.Other or act.Type == ActivityType.Other or x.Type == act.Type or ActivityType.AreVariants([act.Type, x.Type]))
-                              )
-
-            try:
-                existingActivity = next(extantActIter)
-            except StopIteration:
-                existingActivity = None
+            existingIndex = matcher.FindMatch(act)
+            existingActivity = self._activities[existingIndex] if existingIndex is not None else None
 
             if existingActivity:
                 # we don't merge the exclude values here, since at this stage the services have the option of just not returning those activities
@@ -550,9 +794,10 @@ class SynchronizationTask:
 
                 existingActivity.UIDs |= act.UIDs  # I think this is merited
                 act.UIDs = existingActivity.UIDs  # stop the circular inclusion, not that it matters
+                matcher.Refresh(existingIndex)
                 continue
             if not no_add:
-                bisect.insort_left(self._activities, act)
+                matcher.Insert(act)
 
     def _determineEligibleRecipientServices(self, activity, recipientServices):
         from tapiriik.auth import User
@@ -564,7 +809,7 @@ class SynchronizationTask:
                 continue  # we don't know for sure if it needs to be uploaded, hold off for now
             flowException = True
 
-            sources = [[y for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()]
+            sources = [self._connectionByID(x) for x in activity.ServiceDataCollection.keys()]
             for src in sources:
                 if src.Service.ID in WITHDRAWN_SERVICES:
                     continue # They can't see this service to change the configuration.
@@ -633,7 +878,43 @@ class SynchronizationTask:
                 # The connection never gets saved in full again, so we can sub these in here at no risk.
                 conn.ExtendedAuthorization = extAuthDetails[0]
 
-    def _downloadActivityList(self, conn, exhaustive, no_add=False):
+    def _isListingDeferred(self, conn, exhaustive):
+        return not exhaustive and conn.Service.PartialSyncRequiresTrigger and "TriggerPartialSync" not in conn.__dict__ and not conn.Service.ShouldForcePartialSyncTrigger(conn)
+
+    def _prefetchActivityLists(self, conns, exhaustive):
+        # Start listing every connection we know will be listed with the same arguments as in the serial path.
+        # The results are still merged one at a time, in order, by _downloadActivityList.
+        # Services without exhaustive listing are left out of exhaustive syncs, as they need the bounds from everybody else.
+        prefetchConns = []
+        for conn in conns:
+            if exhaustive and not conn.Service.SupportsExhaustiveListing:
+                continue
+            if self._isListingDeferred(conn, exhaustive):
+                continue
+            if conn.Service.ID in DISABLED_SERVICES or conn.Service.ID in WITHDRAWN_SERVICES or [x for x in self._syncErrors[conn._id] if x["Scope"] in (ServiceExceptionScope.Account, ServiceExceptionScope.Service)]:
+                continue # These get sorted out in _downloadActivityList
+            self._primeExtendedAuthDetails(conn)
+            if conn.Service.RequiresExtendedAuthorizationDetails and not conn.ExtendedAuthorization:
+                continue
+            prefetchConns.append(conn)
+
+        if len(prefetchConns) < 2:
+            return {}
+
+        logger.info("Prefetching lists from %s" % [x.Service.ID for x in prefetchConns])
+        self._listingPool = ThreadPoolExecutor(max_workers=min(SYNC_LISTING_CONCURRENCY, len(prefetchConns)))
+        return {conn._id: self._listingPool.submit(self._withLogContext, self._prefetchActivityList, conn, exhaustive) for conn in prefetchConns}
+
+    def _prefetchActivityList(self, conn, exhaustive):
+        with HTTPMetrics.ServiceContext(conn.Service.ID):
+            return conn.Service.DownloadActivityList(conn, exhaustive)
+
+    def _shutdownListingPool(self):
+        if self._listingPool:
+            self._listingPool.shutdown(wait=True)
+            self._listingPool = None
+
+    def _downloadActivityList(self, conn, exhaustive, no_add=False, prefetched=None):
         svc = conn.Service
         # Bail out as appropriate for the entire account (_syncErrors contains only blocking errors at this point)
         if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Account]:
@@ -662,35 +943,52 @@ class SynchronizationTask:
                 self._excludeService(conn, UserException(UserExceptionType.MissingCredentials))
                 return
 
-        try:
-            logger.info("\tRetrieving list from " + svc.ID)
-            if not exhaustive or not self._activities:
-                svcActivities, svcExclusions = svc.DownloadActivityList(conn, exhaustive)
-            else:
-                svcActivities, svcExclusions = svc.DownloadActivityList(conn, min((x.StartTime.replace(tzinfo=None) for x in self._activities)))
-        except (ServiceException, ServiceWarning) as e:
-            # Special-case rate limiting errors thrown during listing
-            # Otherwise, things will melt down when the limit is reached
-            # (lots of users will hit this error, then be marked for full synchronization later)
-            # (but that's not really required)
-            # Though we don't want to play with things if this exception needs to take the place of an earlier, more significant one
-            #
-            # I had previously removed this because I forgot that TriggerExhaustive defaults to true - this exception was *un*setting it
-            # The issue prompting that change stemmed more from the fact that the rate-limiting errors were being marked as blocking,
-            # ...not that they were getting marked as *not* triggering exhaustive synchronization
-
-            if e.UserException and e.UserException.Type == UserExceptionType.RateLimited:
-                e.TriggerExhaustive = conn._id in self._hasTransientSyncErrors and self._hasTransientSyncErrors[conn._id]
-            self._syncErrors[conn._id].append(_packServiceException(SyncStep.List, e))
-            self._excludeService(conn, e.UserException)
-            if not _isWarning(e):
+        logger.info("\tRetrieving list from " + svc.ID)
+        if prefetched:
+            # Any exception from the listing is re-raised from result(), so it's handled exactly as if we'd made the call ourselves
+            pages = (future.result() for future in [prefetched])
+        elif not exhaustive or not self._activities:
+            pages = svc.IterActivityList(conn, exhaustive)
+        else:
+            listStart = min((x.StartTime.replace(tzinfo=None) for x in self._activities))
+            pages = svc.IterActivityList(conn, listStart)
+
+        # The pages are held until the listing's complete - if a later page fails, none of the earlier ones should have been merged in
+        listedActivities = []
+        listedExclusions = []
+        while True:
+            try:
+                with self._serviceCall(conn), self._profiler.Span("DownloadActivityList", svc.ID):
+                    page = next(pages, None)
+            except (ServiceException, ServiceWarning) as e:
+                # Special-case rate limiting errors thrown during listing
+                # Otherwise, things will melt down when the limit is reached
+                # (lots of users will hit this error, then be marked for full synchronization later)
+                # (but that's not really required)
+                # Though we don't want to play with things if this exception needs to take the place of an earlier, more significant one
+                #
+                # I had previously removed this because I forgot that TriggerExhaustive defaults to true - this exception was *un*setting it
+                # The issue prompting that change stemmed more from the fact that the rate-limiting errors were being marked as blocking,
+                # ...not that they were getting marked as *not* triggering exhaustive synchronization
+
+                if e.UserException and e.UserException.Type == UserExceptionType.RateLimited:
+                    e.TriggerExhaustive = conn._id in self._hasTransientSyncErrors and self._hasTransientSyncErrors[conn._id]
+                self._syncErrors[conn._id].append(_packServiceException(SyncStep.List, e))
+                self._excludeService(conn, e.UserException)
+                if not _isWarning(e):
+                    return
+                break
+            except Exception as e:
+                self._syncErrors[conn._id].append(_packException(SyncStep.List))
+                self._excludeService(conn, UserException(UserExceptionType.ListingError))
                 return
-        except Exception as e:
-            self._syncErrors[conn._id].append(_packException(SyncStep.List))
-            self._excludeService(conn, UserException(UserExceptionType.ListingError))
-            return
-        self._accumulateExclusions(conn, svcExclusions)
-        self._accumulateActivities(conn, svcActivities, no_add=no_add)
+            if page is None:
+                break
+            svcActivities, svcExclusions = page
+            listedActivities += svcActivities
+            listedExclusions += svcExclusions
+        self._accumulateExclusions(conn, listedExclusions)
+        self._accumulateActivities(conn, listedActivities, no_add=no_add)
 
     def _estimateFallbackTZ(self, activities):
         from collections import Counter
@@ -717,32 +1015,22 @@ class SynchronizationTask:
         #   Before, I had moved this under all the eligibility/recipient checks, but that could cause persistent duplicate self._activities when the user had already manually uploaded the same activity to multiple sites.
         updateServicesWithExistingActivity = False
         for serviceWithExistingActivityId in activity.ServiceDataCollection.keys():
-            serviceWithExistingActivity = [x for x in self._serviceConnections if x._id == serviceWithExistingActivityId][0]
-            if not hasattr(serviceWithExistingActivity, "SynchronizedActivities") or not (activity.UIDs <= set(serviceWithExistingActivity.SynchronizedActivities)):
+            serviceWithExistingActivity = self._connectionByID(serviceWithExistingActivityId)
+            if not hasattr(serviceWithExistingActivity, "SynchronizedActivities") or not activity.UIDs.issubset(serviceWithExistingActivity.SynchronizedActivities):
                 updateServicesWithExistingActivity = True
                 break
 
         if updateServicesWithExistingActivity:
             logger.debug("\t\tUpdating SynchronizedActivities")
-            try:
-                db.connections.update({"_id": {"$in": list(activity.ServiceDataCollection.keys())}},
-                                      {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}},
-                                      multi=True)
-            except pymongo.errors.WriteError as e:
-                if e.code == 17419: # Update makes document too large.
-                    # Throw them all out - exhaustive sync will recover.
-                    # I should probably check that this is actually due to transient issues - otherwise it'll keep happening.
-                    db.connections.update({"_id": {"$in": list(activity.ServiceDataCollection.keys())}}, {"$unset": {"SynchronizedActivities": ""}})
-                    self._sync_result.ForceExhaustive = True
-                else:
-                    raise
+            for connId in activity.ServiceDataCollection.keys():
+                self._markSynchronizedActivities(connId, activity)
 
     def _updateActivityRecordInitialPrescence(self, activity):
         for connWithExistingActivityId in activity.ServiceDataCollection.keys():
-            connWithExistingActivity = [x for x in self._serviceConnections if x._id == connWithExistingActivityId][0]
+            connWithExistingActivity = self._connectionByID(connWithExistingActivityId)
             activity.Record.MarkAsPresentOn(connWithExistingActivity)
         for conn in self._serviceConnections:
-            if hasattr(conn, "SynchronizedActivities") and len([x for x in activity.UIDs if x in conn.SynchronizedActivities]):
+            if hasattr(conn, "SynchronizedActivities") and not activity.UIDs.isdisjoint(conn.SynchronizedActivities):
                 activity.Record.MarkAsPresentOn(conn)
 
     def _syncActivityRedisKey(user):
@@ -759,7 +1047,7 @@ class SynchronizationTask:
     def _downloadActivity(self, activity):
         act = None
         actAvailableFromSvcIds = activity.ServiceDataCollection.keys()
-        actAvailableFromSvcs = [[x for x in self._serviceConnections if x._id == dlSvcRecId][0] for dlSvcRecId in actAvailableFromSvcIds]
+        actAvailableFromSvcs = [self._connectionByID(dlSvcRecId) for dlSvcRecId in actAvailableFromSvcIds]
 
         servicePriorityList = Service.PreferredDownloadPriorityList()
         actAvailableFromSvcs.sort(key=lambda x: servicePriorityList.index(x.Service))
@@ -793,7 +1081,8 @@ class SynchronizationTask:
             # Load in the service data in the same place they left it.
             workingCopy.ServiceData = workingCopy.ServiceDataCollection[dlSvcRecord._id] if dlSvcRecord._id in workingCopy.ServiceDataCollection else None
             try:
-                workingCopy = dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
+                with self._serviceCall(dlSvcRecord), self._profiler.Span("DownloadActivity", dlSvc.ID):
+                    workingCopy = dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
             except (ServiceException, ServiceWarning) as e:
                 if not _isWarning(e):
                     # Persist the exception if we just exceeded the failure count
@@ -836,7 +1125,10 @@ class SynchronizationTask:
                 activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.Private))
                 continue
             try:
-                workingCopy.CheckSanity()
+                # The clean-ups come along for the ride, rather than each taking another pass over the waypoints later
+                violations = workingCopy.Validate(sanity=True, cleanStats=True, cleanWaypoints=True)
+                if violations:
+                    violations[0].Raise()
             except:
                 logger.info("\t\t...failed sanity check")
                 self._accumulateExclusions(dlSvcRecord, APIExcludeActivity("Sanity check failed " + _formatExc(), activity=workingCopy, user_exception=UserException(UserExceptionType.SanityError)))
@@ -853,7 +1145,8 @@ class SynchronizationTask:
         destSvc = destinationServiceRec.Service
 
         try:
-            return destSvc.UploadActivity(destinationServiceRec, activity, activitySource)
+            with self._serviceCall(destinationServiceRec), self._profiler.Span("UploadActivity", destSvc.ID):
+                return destSvc.UploadActivity(destinationServiceRec, activity, activitySource)
         except (ServiceException, ServiceWarning) as e:
             if not _isWarning(e):
                 activity.Record.IncrementFailureCount(destinationServiceRec)
@@ -883,7 +1176,105 @@ class SynchronizationTask:
 
         activity.Record.ResetFailureCount(destinationServiceRec)
 
-    def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None):
+    def _synchronizeActivity(self, activity, eligibleServices, heartbeat_callback=None):
+        from tapiriik.services.interchange import ActivityStatisticUnit
+
+        # Download the full activity record
+        full_activity, activitySource = self._downloadActivity(activity)
+
+        if full_activity is None:  # couldn't download it from anywhere, or the places that had it said it was broken
+            # The activity record gets updated in _downloadActivity
+            self._processedActivities += 1  # we tried
+            raise ActivityShouldNotSynchronizeException()
+
+        try:
+            with self._profiler.Span("EnsureTZ", activitySource.ID):
+                full_activity.EnsureTZ()
+        except Exception as e:
+            logger.error("\tCould not determine TZ %s" % e)
+            self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
+            activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.UnknownTZ))
+            raise ActivityShouldNotSynchronizeException()
+        else:
+            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
+
+        try:
+            full_activity.CheckTimestampSanity()
+        except ValueError as e:
+            logger.warning("\t\t...failed timestamp sanity check - %s" % e)
+            # self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Timestamp sanity check failed", activity=full_activity, permanent=True))
+            # activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
+            # raise ActivityShouldNotSynchronizeException()
+
+        activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
+        self._indexActivityRecord(activity.Record)
+
+        full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
+
+        successful_destination_service_ids = []
+
+        for destinationSvcRecord in eligibleServices:
+            if heartbeat_callback:
+                heartbeat_callback(SyncStep.Upload)
+            destSvc = destinationSvcRecord.Service
+            if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
+                logger.info("\t\t...marked as stationary during download")
+                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.StationaryUnsupported))
+                continue
+            if not full_activity.Stationary:
+                if not (destSvc.ReceivesNonGPSActivitiesWithOtherSensorData or full_activity.GPS):
+                    logger.info("\t\t...marked as non-GPS during download")
+                    activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.NonGPSUnsupported))
+                    continue
+
+            uploaded_external_id = None
+            logger.info("\t  Uploading to " + destSvc.ID)
+            logger.info(type(destinationSvcRecord))
+            try:
+                uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord, activitySource)
+            except UploadException:
+                continue # At this point it's already been added to the error collection, so we can just bail.
+            logger.info("\t  Uploaded")
+
+            activity.Record.MarkAsSynchronizedTo(destinationSvcRecord)
+            successful_destination_service_ids.append(destSvc.ID)
+
+            if uploaded_external_id:
+                # record external ID, for posterity (and later debugging)
+                self._writeBuffer.Insert(db.uploaded_activities, {"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
+            # flag as successful
+            self._markSynchronizedActivities(destinationSvcRecord._id, activity)
+
+            self._writeBuffer.Update(db.sync_stats, {"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True, key=activity.UID)
+
+            if SYNC_WRITE_BUFFER_FLUSH_ON_UPLOAD:
+                # Otherwise, if we crash before the next flush, the next sync would upload it again.
+                self._flushWrites()
+
+        if len(successful_destination_service_ids):
+            self._pushRecentSyncActivity(full_activity, successful_destination_service_ids)
+        del full_activity
+        self._processedActivities += 1
+
+    def _synchronizeActivityConcurrently(self, activity, eligibleServices, heartbeat_callback=None):
+        with self._stateLock:
+            try:
+                self._synchronizeActivity(activity, eligibleServices, heartbeat_callback)
+            except ActivityShouldNotSynchronizeException:
+                pass
+
+    def _finishActivityPool(self):
+        if not self._activityPool:
+            return
+        self._activityPool.shutdown(wait=True)
+        self._activityPool = None
+        self._concurrent = False
+        # Anything that escaped an activity would have aborted the serial sync too.
+        for future in self._activityFutures:
+            future.result()
+        self._activityFutures = []
+
+    def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None, defer_log_write=False):
         from tapiriik.auth import User
         from tapiriik.services.interchange import ActivityStatisticUnit
 
@@ -914,6 +1305,7 @@ class SynchronizationTask:
         self._excludedServices = {}
         self._deferredServices = []
         self._persistTriggerServices = {}
+        prefetchedLists = {}
 
         self._initializePersistedSyncErrorsAndExclusions()
 
@@ -924,9 +1316,16 @@ class SynchronizationTask:
                 # Sort services that don't support exhaustive listing last.
                 # That way, we can provide them with the proper bounds for listing based
                 # on activities from other services.
-                for conn in sorted(self._serviceConnections,
-                                   key=lambda x: x.Service.SupportsExhaustiveListing,
-                                   reverse=True):
+                listingConns = sorted(self._serviceConnections,
+                                      key=lambda x: x.Service.SupportsExhaustiveListing,
+                                      reverse=True)
+
+                self._profiler.BeginStep(SyncStep.List)
+
+                if SYNC_LISTING_CONCURRENCY > 1:
+                    prefetchedLists = self._prefetchActivityLists(listingConns, exhaustive)
+
+                for conn in listingConns:
                     # If we're not going to be doing anything anyways, stop now
                     if len(self._serviceConnections) - len(self._excludedServices) <= 1:
                         raise SynchronizationCompleteException()
@@ -936,7 +1335,7 @@ class SynchronizationTask:
                     logger.info("Ensuring partial sync poll subscription")
                     self._ensurePartialSyncPollingSubscription(conn)
 
-                    if not exhaustive and conn.Service.PartialSyncRequiresTrigger and "TriggerPartialSync" not in conn.__dict__ and not conn.Service.ShouldForcePartialSyncTrigger(conn):
+                    if self._isListingDeferred(conn, exhaustive):
                         logger.info("Service %s has not been triggered" % conn.Service.ID)
                         self._deferredServices.append(conn._id)
                         continue
@@ -945,27 +1344,41 @@ class SynchronizationTask:
                         heartbeat_callback(SyncStep.List)
 
                     self._updateSyncProgress(SyncStep.List, conn.Service.ID)
-                    self._downloadActivityList(conn, exhaustive)
+                    self._downloadActivityList(conn, exhaustive, prefetched=prefetchedLists.get(conn._id))
+                    self._flushWrites()
+
+                self._shutdownListingPool()
 
                 self._applyFallbackTZ()
 
                 # Makes reading the logs much easier.
                 self._activities = sorted(self._activities, key=lambda v: v.StartTime.replace(tzinfo=None), reverse=True)
 
-                totalActivities = len(self._activities)
-                processedActivities = 0
+                self._totalActivities = len(self._activities)
+                self._processedActivities = 0
+
+                if SYNC_ACTIVITY_CONCURRENCY > 1:
+                    # Listing and the checks below stay on this thread; the download/upload of each activity is handed off to the pool.
+                    self._concurrent = True
+                    self._serviceSemaphores = {svcId: threading.BoundedSemaphore(limit) for svcId, limit in SYNC_SERVICE_CONCURRENCY.items()}
+                    self._activityPool = ThreadPoolExecutor(max_workers=SYNC_ACTIVITY_CONCURRENCY)
+                self._activityFutures = []
 
+                self._flushUserLog()
+                self._profiler.BeginStep(SyncStep.Download)
                 for activity in self._activities:
-                    logger.info(str(activity) + " " + str(activity.UID[:3]) + " from " + str([[y.Service.ID for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()]))
-                    logger.info(" Name: %s Notes: %s Distance: %s%s" % (activity.Name[:15] if activity.Name else "", activity.Notes[:15] if activity.Notes else "", activity.Stats.Distance.Value, activity.Stats.Distance.Units))
+                    self._acquireState()
+                    # Nothing between the acquire and the try, or a failure there would leave the state locked for good
                     try:
+                        logger.info(str(activity) + " " + str(activity.UID[:3]) + " from " + str([self._connectionByID(x).Service.ID for x in activity.ServiceDataCollection.keys()]))
+                        logger.info(" Name: %s Notes: %s Distance: %s%s" % (activity.Name[:15] if activity.Name else "", activity.Notes[:15] if activity.Notes else "", activity.Stats.Distance.Value, activity.Stats.Distance.Units))
                         activity.Record = self._findOrCreateActivityRecord(activity) # Make it a member of the activity, to avoid passing it around as a seperate parameter everywhere.
 
                         self._updateSynchronizedActivities(activity)
                         self._updateActivityRecordInitialPrescence(activity)
 
                         actAvailableFromConnIds = activity.ServiceDataCollection.keys()
-                        actAvailableFromConns = [[x for x in self._serviceConnections if x._id == dlSvcRecId][0] for dlSvcRecId in actAvailableFromConnIds]
+                        actAvailableFromConns = [self._connectionByID(dlSvcRecId) for dlSvcRecId in actAvailableFromConnIds]
 
                         # Check if this is too soon to synchronize
                         if self._user_config["sync_upload_delay"]:
@@ -1019,7 +1432,7 @@ class SynchronizationTask:
                             # recipientServices are services that don't already have this activity
                             recipientServices = self._determineRecipientServices(activity)
                             if len(recipientServices) == 0:
-                                totalActivities -= 1  # doesn't count
+                                self._totalActivities -= 1  # doesn't count
                                 raise ActivityShouldNotSynchronizeException()
 
                             # eligibleServices are services that are permitted to receive this activity - taking into account flow exceptions, excluded services, unfufilled configuration requirements, etc.
@@ -1027,7 +1440,7 @@ class SynchronizationTask:
 
                             if not len(eligibleServices):
                                 logger.info("\t\t...has no eligible destinations")
-                                totalActivities -= 1  # Again, doesn't really count.
+                                self._totalActivities -= 1  # Again, doesn't really count.
                                 raise ActivityShouldNotSynchronizeException()
 
                             has_deferred = False
@@ -1051,102 +1464,41 @@ class SynchronizationTask:
                         if heartbeat_callback:
                             heartbeat_callback(SyncStep.Download)
 
-                        if processedActivities == 0:
+                        if self._processedActivities == 0:
                             syncProgress = 0
-                        elif totalActivities <= 0:
+                        elif self._totalActivities <= 0:
                             syncProgress = 1
                         else:
-                            syncProgress = max(0, min(1, processedActivities / totalActivities))
+                            syncProgress = max(0, min(1, self._processedActivities / self._totalActivities))
                         self._updateSyncProgress(SyncStep.Download, syncProgress)
 
                         # The second most important line of logging in the application...
                         logger.info("\t\t...to " + str([x.Service.ID for x in recipientServices]))
 
-                        # Download the full activity record
-                        full_activity, activitySource = self._downloadActivity(activity)
-
-                        if full_activity is None:  # couldn't download it from anywhere, or the places that had it said it was broken
-                            # The activity record gets updated in _downloadActivity
-                            processedActivities += 1  # we tried
-                            raise ActivityShouldNotSynchronizeException()
-
-                        full_activity.CleanStats()
-                        full_activity.CleanWaypoints()
-
-                        try:
-                            full_activity.EnsureTZ()
-                        except Exception as e:
-                            logger.error("\tCould not determine TZ %s" % e)
-                            self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
-                            activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.UnknownTZ))
-                            raise ActivityShouldNotSynchronizeException()
+                        if self._activityPool:
+                            self._activityFutures.append(self._activityPool.submit(self._withLogContext, self._synchronizeActivityConcurrently, activity, eligibleServices, heartbeat_callback))
                         else:
-                            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
-
-                        try:
-                            full_activity.CheckTimestampSanity()
-                        except ValueError as e:
-                            logger.warning("\t\t...failed timestamp sanity check - %s" % e)
-                            # self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Timestamp sanity check failed", activity=full_activity, permanent=True))
-                            # activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
-                            # raise ActivityShouldNotSynchronizeException()
-
-                        activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
-
-                        full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
-
-                        successful_destination_service_ids = []
-
-                        for destinationSvcRecord in eligibleServices:
-                            if heartbeat_callback:
-                                heartbeat_callback(SyncStep.Upload)
-                            destSvc = destinationSvcRecord.Service
-                            if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
-                                logger.info("\t\t...marked as stationary during download")
-                                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.StationaryUnsupported))
-                                continue
-                            if not full_activity.Stationary:
-                                if not (destSvc.ReceivesNonGPSActivitiesWithOtherSensorData or full_activity.GPS):
-                                    logger.info("\t\t...marked as non-GPS during download")
-                                    activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.NonGPSUnsupported))
-                                    continue
-
-                            uploaded_external_id = None
-                            logger.info("\t  Uploading to " + destSvc.ID)
-                            logger.info(type(destinationSvcRecord))
-                            try:
-                                uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord, activitySource)
-                            except UploadException:
-                                continue # At this point it's already been added to the error collection, so we can just bail.
-                            logger.info("\t  Uploaded")
-
-                            activity.Record.MarkAsSynchronizedTo(destinationSvcRecord)
-                            successful_destination_service_ids.append(destSvc.ID)
-
-                            if uploaded_external_id:
-                                # record external ID, for posterity (and later debugging)
-                                db.uploaded_activities.insert({"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
-                            # flag as successful
-                            db.connections.update({"_id": destinationSvcRecord._id},
-                                                  {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}})
-
-                            db.sync_stats.update({"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True)
-
-                        if len(successful_destination_service_ids):
-                            self._pushRecentSyncActivity(full_activity, successful_destination_service_ids)
-                        del full_activity
-                        processedActivities += 1
+                            self._synchronizeActivity(activity, eligibleServices, heartbeat_callback)
                     except ActivityShouldNotSynchronizeException:
                         continue
                     finally:
+                        self._releaseState()
                         del activity
 
+                self._finishActivityPool()
+                self._flushWrites()
+
             except SynchronizationCompleteException:
                 # This gets thrown when there is obviously nothing left to do - but we still need to clean things up.
                 logger.info("SynchronizationCompleteException thrown")
 
+            self._profiler.EndStep()
+            self._flushUserLog()
+
             logger.info("Writing back service data")
-            self._writeBackSyncErrorsAndExclusions()
+            self._flushWrites()
+            with self._profiler.Span("WriteBackSyncErrorsAndExclusions"):
+                self._writeBackSyncErrorsAndExclusions()
 
             if exhaustive:
                 # Clean up potentially orphaned records, since we know everything is here.
@@ -1154,7 +1506,8 @@ class SynchronizationTask:
                 self._dropUntouchedActivityRecords()
 
             logger.info("Writing back activity records")
-            self._writeBackActivityRecords()
+            with self._profiler.Span("WriteBackActivityRecords"):
+                self._writeBackActivityRecords()
 
             logger.info("Finalizing")
             # Clear non-persisted extended auth details.
@@ -1162,16 +1515,37 @@ class SynchronizationTask:
 
             logger.info("Unlocking user")
             # Unlock the user.
+            self._flushWrites()
             self._unlockUser()
 
         except:
             # oops.
             logger.exception("Core sync exception")
+            # Hold on to whatever we got done before bailing out
+            try:
+                self._flushWrites()
+            except:
+                logger.exception("Could not flush buffered writes")
             raise
         else:
             logger.info("Finished sync for %s (worker %d)" % (self.user["_id"], os.getpid()))
         finally:
-            self._closeUserLogging()
+            if self._listingPool:
+                for future in prefetchedLists.values():
+                    future.cancel()
+                self._shutdownListingPool()
+            if self._activityPool:
+                # Don't leave threads behind if we bailed out of the activity loop.
+                self._activityPool.shutdown(wait=True)
+                self._activityPool = None
+            self._concurrent = False
+            self._profiler.EndStep()
+            try:
+                self._profiler.Persist(self.user["_id"], worker=os.getpid(), host=socket.gethostname())
+            except Exception:
+                logger.exception("Could not record sync timings")
+            # The caller can add to the log (with _withLogContext) before it's written out with _writeUserLog
+            self._closeUserLogging(write=not defer_log_write)
 
         return sync_result
 
@@ -1194,6 +1568,14 @@ class ActivityShouldNotSynchronizeException(Exception):
 class SynchronizationCompleteException(Exception):
     pass
 
+class SyncPriority:
+    # Each gets its own queue - see Sync.PerformGlobalSync and SYNC_PRIORITY_WEIGHTS
+    Manual = "manual" # Sync.ScheduleImmediateSync
+    Triggered = "triggered" # Partial sync triggers
+    Periodic = "periodic"
+    Exhaustive = "exhaustive"
+    All = [Manual, Triggered, Periodic, Exhaustive]
+
 class SyncStep:
     List = "list"
     Download = "download"
@@ -2,3 +2,5 @@ from .sync import *
 from .interchange import *
 from .gpx import *
 from .statistics import *
+from .database import *
+from .services import *
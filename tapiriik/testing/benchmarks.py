@@ -0,0 +1,250 @@
+# Rough timings for the hot spots of a sync - not part of the test suite.
+# python -m tapiriik.testing.benchmarks [name ...]
+from tapiriik.testing.testtools import TestTools
+from tapiriik.sync import SynchronizationTask
+from tapiriik.sync.activity_record import ActivityRecord
+from tapiriik.services.interchange import Activity, Lap, Track, Waypoint, WaypointType, Location
+from tapiriik.services.validation import ActivityValidator
+
+from datetime import datetime, timedelta
+import pytz
+import random
+import copy
+import time
+import sys
+
+benchmarks = []
+
+
+def benchmark(fn):
+    benchmarks.append(fn)
+    return fn
+
+
+def create_activity_history(svc, count, rng, start=datetime(2010, 1, 1), templates=50):
+    ''' creates an account's worth of activities, a few hours to a few days apart '''
+    # Building waypoints for thousands of activities takes far longer than anything being timed, so a handful are shared
+    templates = [TestTools.create_random_activity(svc, tz=rng.choice([False, True])) for x in range(templates)]
+    activities = []
+    startTime = start
+    for x in range(count):
+        act = copy.copy(rng.choice(templates))
+        startTime += timedelta(seconds=rng.randint(3600 * 4, 86400 * 3))
+        act.StartTime = act.TZ.localize(startTime) if act.TZ else startTime
+        act.EndTime = act.StartTime + timedelta(hours=1)
+        act.ServiceDataCollection = TestTools.create_mock_servicedatacollection(svc)
+        act.CalculateUID()
+        activities.append(act)
+    return activities
+
+
+def copy_activity_history(activities, svc, rng, jitter=timedelta(seconds=30)):
+    ''' the same activities as another service would list them - slightly different start times and all '''
+    copies = []
+    for act in activities:
+        act = copy.copy(act)
+        act.StartTime += timedelta(seconds=rng.randint(-jitter.seconds, jitter.seconds))
+        act.ServiceDataCollection = TestTools.create_mock_servicedatacollection(svc)
+        act.CalculateUID()
+        copies.append(act)
+    return copies
+
+
+def create_long_activity(points, laps=5, track=False):
+    ''' a few hours of 1-second recording, as Waypoints or as Tracks '''
+    start = pytz.utc.localize(datetime(2015, 6, 1, 12, 0, 0))
+    act = Activity()
+    act.StartTime = start
+    act.EndTime = start + timedelta(seconds=points)
+    act.Stationary = False
+    act.GPS = True
+    act.TZ = pytz.utc
+    act.Laps = []
+    perLap = points // laps
+    for lapIdx in range(laps):
+        lapStart = start + timedelta(seconds=lapIdx * perLap)
+        lap = Lap(startTime=lapStart, endTime=lapStart + timedelta(seconds=perLap))
+        if track:
+            lap.Track = Track(lapStart)
+        for x in range(perLap):
+            values = {"Latitude": 45 + x / 100000, "Longitude": -75 + x / 100000, "Altitude": 100 + x % 50, "HR": 120 + x % 40, "Cadence": 80, "Power": 200, "Distance": x * 3}
+            if track:
+                lap.Track.Append(x, **values)
+            else:
+                lap.Waypoints.append(Waypoint(lapStart + timedelta(seconds=x), location=Location(values["Latitude"], values["Longitude"], values["Altitude"]), hr=values["HR"], cadence=values["Cadence"], power=values["Power"], distance=values["Distance"]))
+        act.Laps.append(lap)
+    return act
+
+
+def timed(label, fn, *args):
+    startTime = time.time()
+    fn(*args)
+    elapsed = time.time() - startTime
+    print("\t%s: %.3fs" % (label, elapsed))
+    return elapsed
+
+
+@benchmark
+def accumulate_activities(count=10000):
+    ''' _accumulateActivities for an exhaustive sync of a 3-service account '''
+    rng = random.Random(0)
+    svcA, svcB = TestTools.create_mock_services()
+    svcC = TestTools.create_mock_service("mockC")
+    recA, recB, recC = [TestTools.create_mock_svc_record(x) for x in (svcA, svcB, svcC)]
+
+    activitiesA = create_activity_history(svcA, count, rng)
+    activitiesB = copy_activity_history(activitiesA, svcB, rng)
+    activitiesC = copy_activity_history(activitiesA[::2], svcC, rng) + create_activity_history(svcC, count // 2, rng)
+
+    s = SynchronizationTask(None)
+    s._activities = []
+    timed("%d new" % len(activitiesA), s._accumulateActivities, recA, activitiesA)
+    timed("%d duplicates" % len(activitiesB), s._accumulateActivities, recB, activitiesB)
+    timed("%d mixed" % len(activitiesC), s._accumulateActivities, recC, activitiesC)
+    print("\t%d activities after deduplication" % len(s._activities))
+
+
+@benchmark
+def find_activity_records(counts=(5000, 50000), lookups=5000):
+    ''' _findOrCreateActivityRecord against a long-tenured user's activity records '''
+    rng = random.Random(0)
+    for count in counts:
+        s = SynchronizationTask(None)
+        s._activityRecords = []
+        for x in range(count):
+            rec = ActivityRecord()
+            rec.UIDs = set(["%d-%d" % (x, y) for y in range(2)])
+            s._activityRecords.append(rec)
+        s._indexActivityRecords()
+
+        activities = []
+        for x in range(lookups):
+            act = Activity()
+            act.UIDs = set(["%d-1" % rng.randrange(count)])
+            activities.append(act)
+
+        def linear_scan():
+            for act in activities:
+                next(record for record in s._activityRecords if record.UIDs & act.UIDs)
+
+        def indexed():
+            for act in activities:
+                s._findOrCreateActivityRecord(act)
+
+        print("\t%d records, %d lookups" % (count, lookups))
+        timed("linear scan", linear_scan)
+        timed("indexed", indexed)
+
+
+def _separate_passes(act):
+    ''' CheckSanity, CleanStats, CleanWaypoints and CheckTimestampSanity as they were before Validate - a pass over the waypoints apiece '''
+    def check_sanity():
+        if len(act.Laps) == 0:
+            raise ValueError("No laps")
+        wptCt = sum([len(x.Waypoints) for x in act.Laps])
+        if not act.Stationary and wptCt <= 1:
+            raise ValueError("%d waypoints" % wptCt)
+        altLow = None
+        altHigh = None
+        pointsWithLocation = 0
+        unpausedPoints = 0
+        for lap in act.Laps:
+            if not lap.StartTime:
+                raise ValueError("Lap has no start time")
+            if not lap.EndTime:
+                raise ValueError("Lap has no end time")
+            for wp in lap.Waypoints:
+                if wp.Type != WaypointType.Pause:
+                    unpausedPoints += 1
+                if wp.Location:
+                    if wp.Location.Latitude == 0 and wp.Location.Longitude == 0:
+                        raise ValueError("Invalid lat/lng")
+                    if (wp.Location.Latitude is not None and (wp.Location.Latitude > 90 or wp.Location.Latitude < -90)) or (wp.Location.Longitude is not None and (wp.Location.Longitude > 180 or wp.Location.Longitude < -180)):
+                        raise ValueError("Out of range lat/lng")
+                    if wp.Location.Altitude is not None and (altLow is None or wp.Location.Altitude < altLow):
+                        altLow = wp.Location.Altitude
+                    if wp.Location.Altitude is not None and (altHigh is None or wp.Location.Altitude > altHigh):
+                        altHigh = wp.Location.Altitude
+                if wp.Location and wp.Location.Latitude is not None and wp.Location.Longitude is not None:
+                    pointsWithLocation += 1
+        if unpausedPoints == 1 or pointsWithLocation == 1:
+            raise ValueError("0 < n <= 1 points in activity")
+        if altLow is not None and altLow == altHigh and altLow == 0:
+            raise ValueError("Invalid altitudes / no change from " + str(altLow))
+
+    def clean_stats():
+        for stats in [act.Stats] + [lap.Stats for lap in act.Laps]:
+            for key, (unit, low, high) in ActivityValidator.StatRanges.items():
+                raw_stat = getattr(stats, key)
+                stat = raw_stat.asUnits(unit)
+                for field in ActivityValidator.StatFields:
+                    value = getattr(stat, field)
+                    if value is not None and (value < low or value > high):
+                        raw_stat._samples[field] = 0
+                        setattr(raw_stat, field, None)
+
+    def clean_waypoints():
+        for wp in act.GetFlatWaypoints():
+            if wp.Distance and wp.Distance < 0:
+                wp.Distance = 0
+            if wp.Speed and wp.Speed < 0:
+                wp.Speed = 0
+            if wp.Cadence and wp.Cadence < 0:
+                wp.Cadence = 0
+            if wp.RunCadence and wp.RunCadence < 0:
+                wp.RunCadence = 0
+            if wp.Power and wp.Power < 0:
+                wp.Power = 0
+            if wp.Calories and wp.Calories < 0:
+                wp.Calories = 0
+            if wp.HR and wp.HR < 0:
+                wp.HR = 0
+
+    def check_timestamp_sanity():
+        leeway = timedelta(minutes=10)
+        for lap in act.Laps:
+            for wp in lap.Waypoints:
+                if wp.Timestamp.tzinfo != act.TZ:
+                    raise ValueError("Waypoint TZ mismatch")
+                if lap.StartTime - wp.Timestamp > leeway or wp.Timestamp - lap.EndTime > leeway:
+                    raise ValueError("Waypoint outside lap")
+                if act.StartTime - wp.Timestamp > leeway or wp.Timestamp - act.EndTime > leeway:
+                    raise ValueError("Waypoint outside activity")
+
+    check_sanity()
+    clean_stats()
+    clean_waypoints()
+    check_timestamp_sanity()
+
+
+@benchmark
+def validate_activity(points=50000, repeat=5):
+    ''' Activity.Validate with every check, against the separate passes it replaced - over Waypoint laps and over Track laps '''
+    for track in (False, True):
+        label = "%d %s, x%d" % (points, "points in Tracks" if track else "Waypoints", repeat)
+        # Each gets its own copy - the separate passes turn Tracks into Waypoints (only the first time round, so that's in there once)
+        act = create_long_activity(points, track=track)
+        baselineAct = create_long_activity(points, track=track)
+
+        def validate():
+            for x in range(repeat):
+                act.Validate(sanity=True, timestamps=True, cleanStats=True, cleanWaypoints=True)
+
+        def separate_passes():
+            for x in range(repeat):
+                _separate_passes(baselineAct)
+
+        print("\t%s" % label)
+        baselineTime = timed("separate passes", separate_passes)
+        validateTime = timed("Validate", validate)
+        print("\t%.1fx faster" % (baselineTime / validateTime))
+        if track:
+            print("\t(still a Track afterwards: %s)" % all(lap.Track is not None for lap in act.Laps))
+
+
+if __name__ == "__main__":
+    for fn in benchmarks:
+        if len(sys.argv) > 1 and fn.__name__ not in sys.argv[1:]:
+            continue
+        print("%s - %s" % (fn.__name__, fn.__doc__.strip()))
+        fn()
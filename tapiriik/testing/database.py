@@ -0,0 +1,109 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+
+from tapiriik.database import db
+from tapiriik.database.write_buffer import WriteBuffer
+from tapiriik.sync.activity_record import ActivityRecord, ActivityRecordStore
+
+from datetime import datetime
+
+
+class WriteBufferTests(TapiriikTestCase):
+    def setUp(self):
+        db.write_buffer_test.remove({})
+
+    def test_buffered_until_flush(self):
+        buffer = WriteBuffer(max_operations=100)
+        buffer.Insert(db.write_buffer_test, {"_id": 1})
+        buffer.Update(db.write_buffer_test, {"_id": 2}, {"$set": {"Value": 1}}, upsert=True)
+        self.assertEqual(db.write_buffer_test.count(), 0)
+        buffer.Flush()
+        self.assertEqual(db.write_buffer_test.count(), 2)
+        self.assertEqual(len(buffer), 0)
+
+    def test_flush_when_full(self):
+        buffer = WriteBuffer(max_operations=3)
+        for x in range(4):
+            buffer.Insert(db.write_buffer_test, {"_id": x})
+        self.assertEqual(db.write_buffer_test.count(), 3)
+        self.assertEqual(len(buffer), 1)
+
+    def test_keyed_updates_merged(self):
+        buffer = WriteBuffer(max_operations=100)
+        buffer.Update(db.write_buffer_test, {"_id": 1}, {"$set": {"Step": "list", "Progress": 0}}, upsert=True, key="progress")
+        buffer.Update(db.write_buffer_test, {"_id": 1}, {"$set": {"Progress": 0.5}, "$addToSet": {"UIDs": "a"}}, upsert=True, key="progress")
+        buffer.Update(db.write_buffer_test, {"_id": 1}, {"$addToSet": {"UIDs": {"$each": ["a", "b"]}}}, upsert=True, key="progress")
+        self.assertEqual(len(buffer), 1)
+        buffer.Flush()
+        doc = db.write_buffer_test.find_one({"_id": 1})
+        self.assertEqual(doc["Step"], "list")
+        self.assertEqual(doc["Progress"], 0.5)
+        self.assertEqual(sorted(doc["UIDs"]), ["a", "b"])
+
+
+class ActivityRecordStoreTests(TapiriikTestCase):
+    def setUp(self):
+        self.user_id = "activity-record-store-test"
+        db.activity_records.remove({"UserID": self.user_id})
+        db.activity_record_entries.remove({"UserID": self.user_id})
+
+    def _records(self, count):
+        records = []
+        for x in range(count):
+            rec = ActivityRecord()
+            rec.StartTime = datetime(2015, 1, x + 1)
+            rec.UIDs = set([str(x)])
+            rec.Touched = True
+            records.append(rec)
+        return records
+
+    def _compose(self, rec):
+        return {"StartTime": rec.StartTime, "UIDs": list(rec.UIDs), "Distance": len(rec.UIDs)}
+
+    def test_migrate_to_collection(self):
+        ActivityRecordStore(self.user_id, storage="document").Save(self._records(3), self._compose)
+        self.assertEqual(len(ActivityRecordStore.Fetch(self.user_id, storage="collection")), 3)
+
+        store = ActivityRecordStore(self.user_id, storage="collection")
+        records = [ActivityRecord(x) for x in store.Load()]
+        for rec in records:
+            rec.Touched = False
+        store.Save(records, self._compose)
+
+        self.assertEqual(db.activity_records.find({"UserID": self.user_id}).count(), 0)
+        self.assertEqual(db.activity_record_entries.find({"UserID": self.user_id}).count(), 3)
+        fetched = ActivityRecordStore.Fetch(self.user_id, ["StartTime"], storage="collection")
+        self.assertEqual([x["StartTime"] for x in fetched], [datetime(2015, 1, 3), datetime(2015, 1, 2), datetime(2015, 1, 1)])
+        self.assertNotIn("_id", fetched[0])
+
+    def test_migrate_back_to_document(self):
+        store = ActivityRecordStore(self.user_id, storage="collection")
+        store.Save(self._records(3), self._compose)
+        self.assertEqual(db.activity_records.find({"UserID": self.user_id}).count(), 0)
+
+        # The storage is switched back - the records are still there...
+        fetched = ActivityRecordStore.Fetch(self.user_id, ["StartTime"], storage="document")
+        self.assertEqual([x["StartTime"] for x in fetched], [datetime(2015, 1, 3), datetime(2015, 1, 2), datetime(2015, 1, 1)])
+        store = ActivityRecordStore(self.user_id, storage="document")
+        records = [ActivityRecord(x) for x in store.Load()]
+        self.assertEqual(len(records), 3)
+        store.Save(records, self._compose)
+
+        # ...and end up back in the document
+        self.assertEqual(db.activity_record_entries.find({"UserID": self.user_id}).count(), 0)
+        self.assertEqual(len(db.activity_records.find_one({"UserID": self.user_id})["Activities"]), 3)
+        self.assertEqual(len(ActivityRecordStore.Fetch(self.user_id, storage="document")), 3)
+
+    def test_collection_writes_touched_only(self):
+        store = ActivityRecordStore(self.user_id, storage="collection")
+        store.Save(self._records(3), self._compose)
+
+        store = ActivityRecordStore(self.user_id, storage="collection")
+        records = [ActivityRecord(x) for x in store.Load()]
+        for rec in records:
+            rec.Touched = False
+            rec.UIDs = set(rec.UIDs) | set(["new"])
+        records[0].Touched = True
+        store.Save(records[:2], self._compose) # ...and the last one is dropped
+
+        distances = sorted(x["Distance"] for x in ActivityRecordStore.Fetch(self.user_id, ["Distance"], storage="collection"))
+        self.assertEqual(distances, [1, 2])
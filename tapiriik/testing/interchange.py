@@ -1,9 +1,10 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
 from tapiriik.services import Service
-from tapiriik.services.interchange import Activity, ActivityType
+from tapiriik.services.interchange import Activity, ActivityType, Lap, Track, Waypoint, WaypointType, Location
 
 from datetime import datetime, timedelta
+import pytz
 
 
 class InterchangeTests(TapiriikTestCase):
@@ -63,3 +64,95 @@ class InterchangeTests(TapiriikTestCase):
 
         # Normal w/ Other + None
         self.assertEqual(ActivityType.PickMostSpecific([ActivityType.Other, ActivityType.Cycling, None, ActivityType.MountainBiking]), ActivityType.MountainBiking)
+
+    def test_track_round_trip(self):
+        ''' Waypoints stored in a Track should come back out the same '''
+        start = pytz.utc.localize(datetime(2015, 6, 1, 12, 0, 0))
+        wps = [
+            Waypoint(start, ptType=WaypointType.Start, location=Location(45.1, -75.2, 100), hr=120),
+            Waypoint(start + timedelta(seconds=1.5), location=Location(45.2, -75.3, None), cadence=80, distance=10),
+            Waypoint(start + timedelta(seconds=3), ptType=WaypointType.Pause, location=Location(None, None, None)),
+            Waypoint(start + timedelta(seconds=10), ptType=WaypointType.End, power=250, temp=-5),
+        ]
+        track = Track.FromWaypoints(wps)
+        self.assertEqual(len(track), len(wps))
+        self.assertEqual(track.ToWaypoints(), wps)
+        self.assertEqual(track.Waypoint(1).Timestamp, wps[1].Timestamp)
+        self.assertIsNone(track.Waypoint(3).Location)
+        self.assertEqual(track.Valid("HR"), [True, False, False, False])
+
+        # Naive and aware timestamps can't be mixed
+        self.assertRaises(ValueError, Track.FromWaypoints, [wps[0], Waypoint(datetime(2015, 6, 1, 12, 0, 5))])
+
+    def test_lap_track_compatibility(self):
+        ''' Code that only knows about Lap.Waypoints shouldn't notice a Track '''
+        start = pytz.utc.localize(datetime(2015, 6, 1, 12, 0, 0))
+        track = Track(start)
+        for x in range(5):
+            track.Append(x, HR=100 + x, Latitude=45 + x / 1000, Longitude=-75)
+        lap = Lap(startTime=start, endTime=start + timedelta(seconds=4), track=track)
+        act = Activity()
+        act.Laps = [lap]
+
+        self.assertEqual(act.CountTotalWaypoints(), 5)
+        self.assertEqual(act.GetFirstWaypointWithLocation().Latitude, 45)
+        self.assertEqual([wp.HR for wp in lap.IterWaypoints()], [100, 101, 102, 103, 104])
+        self.assertIsNotNone(lap.Track)
+
+        # Asking for the Waypoints swaps the Track out for them, so changes stick
+        lap.Waypoints[0].HR = 90
+        self.assertIsNone(lap.Track)
+        self.assertEqual(lap.Waypoints[0].HR, 90)
+        self.assertEqual(lap.Waypoints[4].Timestamp, start + timedelta(seconds=4))
+
+    def test_track_tz(self):
+        ''' Changing a Track's TZ shouldn't move its waypoints, and should still follow DST '''
+        start = pytz.utc.localize(datetime(2015, 3, 8, 6, 0, 0)) # 1AM EST, an hour before the change
+        track = Track(start)
+        for x in range(3):
+            track.Append(x * 3600)
+        act = Activity()
+        act.StartTime = start
+        act.EndTime = start + timedelta(hours=2)
+        act.Laps = [Lap(startTime=act.StartTime, endTime=act.EndTime, track=track)]
+        act.TZ = pytz.timezone("America/New_York")
+        act.AdjustTZ()
+
+        self.assertIsNotNone(act.Laps[0].Track)
+        timestamps = [wp.Timestamp for wp in act.Laps[0].IterWaypoints()]
+        self.assertEqual(timestamps, [start + timedelta(hours=x) for x in range(3)])
+        self.assertEqual([x.hour for x in timestamps], [1, 3, 4])
+
+        act.TZ = pytz.FixedOffset(-300)
+        act.AdjustTZ()
+        act.CheckTimestampSanity()
+        act.Laps[0].Track.Append(3600 * 5)
+        self.assertRaises(ValueError, act.CheckTimestampSanity)
+
+    def test_validation(self):
+        ''' One pass collects every (kind of) violation, and cleans up Track and Waypoint laps alike '''
+        start = pytz.utc.localize(datetime(2015, 6, 1, 12, 0, 0))
+        track = Track(start)
+        for x in range(10):
+            track.Append(x, Latitude=0 if x in (3, 4) else 45, Longitude=0 if x in (3, 4) else -75, Altitude=100, HR=-1 if x == 5 else 120)
+        lapStart = start + timedelta(seconds=10)
+        wps = [Waypoint(lapStart + timedelta(seconds=x), location=Location(45, -75, 100), power=-5 if x == 2 else 200) for x in range(10)]
+        wps[5].Location = Location(95, -75, 100)
+        act = Activity()
+        act.StartTime = start
+        act.EndTime = lapStart + timedelta(seconds=10)
+        act.Stationary = False
+        act.GPS = True
+        act.TZ = pytz.utc
+        act.Laps = [Lap(startTime=start, endTime=lapStart, track=track), Lap(startTime=lapStart, endTime=act.EndTime, waypointList=wps)]
+
+        violations = act.Validate(sanity=True, timestamps=True, cleanWaypoints=True)
+        self.assertEqual([(x.Message, x.Lap, x.Waypoint) for x in violations], [("Invalid lat/lng", 0, 3), ("Out of range lat/lng", 1, 5)])
+        self.assertIsNotNone(act.Laps[0].Track)
+        self.assertEqual(act.Laps[0].Track.HR[5], 0)
+        self.assertEqual(wps[2].Power, 0)
+
+        # The old methods raise the first one
+        with self.assertRaisesRegex(ValueError, "Invalid lat/lng"):
+            act.CheckSanity()
+        act.CheckTimestampSanity()
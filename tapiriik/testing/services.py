@@ -0,0 +1,229 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+
+from tapiriik.database import ratelimit as rl_db, redis
+from tapiriik.services.pacing import RequestPacer
+from tapiriik.services.ratelimiting import RateLimit, RateLimitExceededException
+from tapiriik.services.retry_policy import RetryPolicy
+
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest import mock
+import os
+import threading
+import time
+import unittest
+
+
+class StubRequest:
+    def __init__(self, method):
+        self.method = method
+
+
+class StubResponse:
+    def __init__(self, status_code=200, headers=None, method="GET"):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.request = StubRequest(method)
+
+
+class RetryPolicyTests(TapiriikTestCase):
+    def _requestedDelay(self, headers, now=1400000000):
+        with mock.patch("tapiriik.services.retry_policy.time") as time:
+            time.time.return_value = now
+            return RetryPolicy.RequestedDelay(StubResponse(429, headers))
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(self._requestedDelay({"Retry-After": "120"}), 120)
+        self.assertEqual(self._requestedDelay({"Retry-After": " 5 "}), 5)
+
+    def test_retry_after_date(self):
+        retryAt = datetime.now(timezone.utc) + timedelta(seconds=90)
+        self.assertAlmostEqual(self._requestedDelay({"Retry-After": format_datetime(retryAt, usegmt=True)}), 90, delta=2)
+        retryAt = datetime.now(timezone.utc) - timedelta(seconds=90)
+        self.assertEqual(self._requestedDelay({"Retry-After": format_datetime(retryAt, usegmt=True)}), 0)
+        # Neither a number nor a date - falls through to the other headers
+        self.assertEqual(self._requestedDelay({"Retry-After": "soon"}), None)
+
+    def test_ratelimit_reset(self):
+        # As a timestamp...
+        self.assertEqual(self._requestedDelay({"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "1400000030"}), 30)
+        self.assertEqual(self._requestedDelay({"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "1399999990"}), 0)
+        # ...or a number of seconds
+        self.assertEqual(self._requestedDelay({"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "45"}), 45)
+        # Only once the limit's actually been reached
+        self.assertEqual(self._requestedDelay({"X-RateLimit-Remaining": "3", "X-RateLimit-Reset": "45"}), None)
+        self.assertEqual(self._requestedDelay({"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "never"}), None)
+
+    def test_ratelimit_usage_windows(self):
+        now = 1400000000 # 16:53:20 UTC
+        # The 15-minute window resets on the quarter-hour
+        self.assertEqual(self._requestedDelay({"X-RateLimit-Limit": "600,30000", "X-RateLimit-Usage": "600,1000"}, now=now), 400)
+        # The daily one at UTC midnight - which takes precedence
+        self.assertEqual(self._requestedDelay({"X-RateLimit-Limit": "600,30000", "X-RateLimit-Usage": "600,30000"}, now=now), 25600)
+        self.assertEqual(self._requestedDelay({"X-RateLimit-Limit": "600,30000", "X-RateLimit-Usage": "10,30000"}, now=now), 25600)
+        self.assertEqual(self._requestedDelay({"X-RateLimit-Limit": "600,30000", "X-RateLimit-Usage": "599,29999"}, now=now), None)
+        self.assertEqual(self._requestedDelay({"X-RateLimit-Limit": "600,30000", "X-RateLimit-Usage": "lots"}, now=now), None)
+
+    def test_no_requested_delay(self):
+        self.assertEqual(self._requestedDelay({}), None)
+
+    def test_budget(self):
+        policy = RetryPolicy(budget=2, budget_window=60)
+        with mock.patch("tapiriik.services.retry_policy.time") as time:
+            time.time.return_value = 1000
+            self.assertTrue(policy._consumeBudget("a"))
+            self.assertTrue(policy._consumeBudget("a"))
+            self.assertFalse(policy._consumeBudget("a"))
+            # Each service has its own
+            self.assertTrue(policy._consumeBudget("b"))
+            # Refilled at budget/budget_window per second
+            time.time.return_value = 1030
+            self.assertTrue(policy._consumeBudget("a"))
+            self.assertFalse(policy._consumeBudget("a"))
+            # ...but never beyond the budget
+            time.time.return_value = 2000
+            self.assertTrue(policy._consumeBudget("a"))
+            self.assertTrue(policy._consumeBudget("a"))
+            self.assertFalse(policy._consumeBudget("a"))
+
+    def _wait(self, policy, response, attempt=0):
+        with mock.patch("tapiriik.services.retry_policy.time") as time:
+            time.time.return_value = 1400000000
+            retry = policy.Wait("test", response, attempt)
+            return retry, [call[0][0] for call in time.sleep.call_args_list]
+
+    def test_idempotent_retries(self):
+        policy = RetryPolicy(backoff=1, max_backoff=4)
+        # Server errors are only retried for requests that could safely have been made twice
+        self.assertEqual(self._wait(policy, StubResponse(500, method="POST")), (False, []))
+        retry, sleeps = self._wait(policy, StubResponse(503, method="PUT"))
+        self.assertTrue(retry)
+        self.assertEqual(len(sleeps), 1)
+        self.assertTrue(0 <= sleeps[0] <= 1)
+        # Rejected requests can't have done anything, whatever the method
+        self.assertEqual(self._wait(policy, StubResponse(429, {"Retry-After": "3"}, method="POST")), (True, [3]))
+        # Other failures aren't retried at all
+        self.assertEqual(self._wait(policy, StubResponse(404)), (False, []))
+        self.assertEqual(self._wait(policy, StubResponse(400, method="POST")), (False, []))
+
+    def test_retry_statuses_override(self):
+        policy = RetryPolicy(retry_statuses=(500,))
+        self.assertTrue(self._wait(policy, StubResponse(500, method="POST"))[0])
+        self.assertFalse(self._wait(policy, StubResponse(429))[0])
+
+    def test_retry_limits(self):
+        policy = RetryPolicy(retries=2, max_wait=60)
+        self.assertTrue(self._wait(policy, StubResponse(429, {"Retry-After": "1"}), attempt=1)[0])
+        self.assertEqual(self._wait(policy, StubResponse(429, {"Retry-After": "1"}), attempt=2), (False, []))
+        # Not worth waiting that long - the response is handed back
+        self.assertEqual(self._wait(policy, StubResponse(429, {"Retry-After": "61"})), (False, []))
+        policy = RetryPolicy(budget=1)
+        self.assertTrue(self._wait(policy, StubResponse(429, {"Retry-After": "1"}))[0])
+        self.assertEqual(self._wait(policy, StubResponse(429, {"Retry-After": "1"})), (False, []))
+
+    def test_request(self):
+        policy = RetryPolicy(retries=3)
+        responses = [StubResponse(503), StubResponse(503), StubResponse(200)]
+        with mock.patch("tapiriik.services.retry_policy.time") as time:
+            time.time.return_value = 1400000000
+            self.assertEqual(policy.Request("test", lambda: responses.pop(0)).status_code, 200)
+        self.assertEqual(responses, [])
+
+
+class RateLimitTests(TapiriikTestCase):
+    key = "ratelimit-test"
+
+    def setUp(self):
+        rl_db.limits.remove({"Key": self.key})
+        if redis:
+            for key in redis.keys("ratelimit:%s:*" % self.key):
+                redis.delete(key)
+
+    def _dbCounts(self):
+        return sorted(x["Count"] for x in rl_db.limits.find({"Key": self.key}))
+
+    def _redisCounts(self):
+        return sorted(int(redis.get(key)) for key in redis.keys("ratelimit:%s:*" % self.key))
+
+    def test_no_limits(self):
+        # Services without global limits shouldn't cost a round trip per request, with or without Redis
+        with mock.patch("tapiriik.services.ratelimiting.rl_db") as db, mock.patch("tapiriik.services.ratelimiting._redisLimit") as script:
+            RateLimit.Limit(self.key, [], count=5)
+        self.assertEqual(db.mock_calls, [])
+        self.assertFalse(script.called)
+        with mock.patch("tapiriik.services.ratelimiting.rl_db") as db, mock.patch("tapiriik.services.ratelimiting._redisLimit", None):
+            RateLimit.Limit(self.key, [], count=5)
+        self.assertEqual(db.mock_calls, [])
+
+    @unittest.skipIf(not redis, "Redis isn't configured")
+    def test_redis_all_or_nothing(self):
+        limits = [(timedelta(minutes=15), 5), (timedelta(days=1), 3)]
+        with mock.patch("tapiriik.services.ratelimiting.time") as time:
+            time.time.return_value = 1400000000
+            RateLimit.Limit(self.key, limits, count=2)
+            self.assertEqual(self._redisCounts(), [2, 2])
+            # The daily window would go over - so the 15-minute one isn't touched either
+            self.assertRaises(RateLimitExceededException, RateLimit.Limit, self.key, limits, count=2)
+            self.assertEqual(self._redisCounts(), [2, 2])
+            RateLimit.Limit(self.key, limits)
+            self.assertRaises(RateLimitExceededException, RateLimit.Limit, self.key, limits)
+            self.assertEqual(self._redisCounts(), [3, 3])
+        # The DB's windows aren't involved
+        self.assertEqual(self._dbCounts(), [])
+
+    def test_db_limits(self):
+        RateLimit.Refresh(self.key, [(timedelta(minutes=15), 3), (timedelta(days=1), 10)])
+        RateLimit.Limit(self.key, count=3)
+        self.assertRaises(RateLimitExceededException, RateLimit.Limit, self.key, count=2)
+        self.assertEqual(self._dbCounts(), [3, 3])
+
+    def test_redis_fallback(self):
+        limits = [(timedelta(minutes=15), 3)]
+        RateLimit.Refresh(self.key, limits)
+        # If Redis isn't answering, the DB's windows are used instead
+        with mock.patch("tapiriik.services.ratelimiting._redisLimit", side_effect=ConnectionError("Redis is down")):
+            RateLimit.Limit(self.key, limits, count=3)
+            self.assertRaises(RateLimitExceededException, RateLimit.Limit, self.key, limits, count=2)
+        self.assertEqual(self._dbCounts(), [3])
+        # ...as they are when it isn't configured
+        with mock.patch("tapiriik.services.ratelimiting._redisLimit", None):
+            self.assertRaises(RateLimitExceededException, RateLimit.Limit, self.key, limits, count=2)
+        self.assertEqual(self._dbCounts(), [3])
+
+
+class RequestPacerTests(TapiriikTestCase):
+    def test_lock_file_pacing(self):
+        pacer = RequestPacer("test-%d" % os.getpid(), min_period=0.05)
+        started = []
+        real_open = open
+
+        def _pace():
+            pacer.Pace()
+            started.append(time.time())
+
+        with mock.patch("tapiriik.services.pacing._redisReserve", None), mock.patch("tapiriik.services.pacing.open", create=True, side_effect=real_open) as opened:
+            threads = [threading.Thread(target=_pace) for x in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        pacer._lockFile.close()
+        # The lock file's only opened by the first thread through (once to create it, once to use it)
+        self.assertEqual(opened.call_count, 2)
+        started.sort()
+        for prev, cur in zip(started, started[1:]):
+            self.assertGreaterEqual(cur - prev, 0.045)
+
+    @unittest.skipIf(not redis, "Redis isn't configured")
+    def test_redis_reserve(self):
+        scope = "test-%d" % os.getpid()
+        redis.delete("pacer:%s" % scope)
+        pacer = RequestPacer(scope, min_period=1)
+        with mock.patch("tapiriik.services.pacing.time.sleep") as sleep:
+            slots = [pacer.Reserve() for x in range(3)]
+        # Each caller's handed the next free slot without being made to wait for it
+        self.assertFalse(sleep.called)
+        self.assertLessEqual(slots[0], time.time())
+        for prev, cur in zip(slots, slots[1:]):
+            self.assertAlmostEqual(cur - prev, 1, delta=0.1)
+        redis.delete("pacer:%s" % scope)
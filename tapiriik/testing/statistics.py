@@ -1,6 +1,11 @@
 from tapiriik.testing.testtools import TapiriikTestCase
 
-from tapiriik.services.interchange import ActivityStatistic, ActivityStatisticUnit
+from tapiriik.services.interchange import Activity, ActivityStatistic, ActivityStatistics, ActivityStatisticUnit, Lap, Track, Waypoint, WaypointType
+from tapiriik.services.statistic_calculator import ActivityStatisticCalculator
+
+from datetime import datetime, timedelta
+import math
+import pytz
 
 
 class StatisticTests(TapiriikTestCase):
@@ -181,3 +186,76 @@ class StatisticTests(TapiriikTestCase):
         self.assertEqual(stat1.Value, 2)
         self.assertEqual(stat1.Max, 2)
         self.assertEqual(stat1.Gain, 3)
+
+
+    def test_unitconv_batch(self):
+        stats = ActivityStatistics(distance=1500, avg_speed=36, max_hr=180)
+        converted = stats.asUnits({"Distance": ActivityStatisticUnit.Kilometers, "Speed": ActivityStatisticUnit.MetersPerSecond})
+        self.assertEqual(converted.Distance.Value, 1.5)
+        self.assertEqual(converted.Speed.Average, 10)
+        self.assertEqual(converted.Speed.Units, ActivityStatisticUnit.MetersPerSecond)
+        self.assertIs(converted.HR, stats.HR) # Left alone
+        self.assertEqual(stats.Distance.Value, 1500) # Not touched
+
+    def test_unitconv_plan_cached(self):
+        plan = ActivityStatistic._conversionPlan(ActivityStatisticUnit.Miles, ActivityStatisticUnit.Kilometers)
+        self.assertIs(ActivityStatistic._conversionPlan(ActivityStatisticUnit.Miles, ActivityStatisticUnit.Kilometers), plan)
+        self.assertAlmostEqual(ActivityStatistic.convertValue(1, ActivityStatisticUnit.Miles, ActivityStatisticUnit.Kilometers), 1.609, places=3)
+        # Still fails every time when there's no way to convert
+        for x in range(2):
+            self.assertRaises(ValueError, ActivityStatistic.convertValue, 1, ActivityStatisticUnit.Miles, ActivityStatisticUnit.Seconds)
+
+
+class StatisticCalculatorTests(TapiriikTestCase):
+
+    def _activity(self, waypointLap=False):
+        # Two laps as Tracks (or the second as Waypoints) - with pauses (explicit & implicit), and gaps in location, altitude and HR
+        start = pytz.utc.localize(datetime(2015, 6, 1, 12, 0, 0))
+        track = Track(start)
+        for x in range(500):
+            offset = x * 2 + (120 if x > 300 else 0) # Implicit pause partway through
+            track.Append(offset, ptType=WaypointType.Pause if x == 150 else WaypointType.Regular,
+                         Latitude=None if x % 37 == 0 else 45 + math.sin(x / 50) / 100, Longitude=-75 + x / 5000,
+                         Altitude=None if x % 11 == 0 else 100 + 10 * math.cos(x / 20), HR=0 if x % 13 == 0 else 120 + x % 40)
+        lapStart = start + timedelta(seconds=track.Time[-1] + 3)
+        secondTrack = Track(lapStart)
+        for x in range(200):
+            secondTrack.Append(x, ptType=WaypointType.Pause if x == 100 else WaypointType.Regular,
+                               Latitude=46 - x / 4000 if x % 17 else None, Longitude=-74.9 if x % 17 else None,
+                               Altitude=None if x % 7 == 0 or not x % 17 else 50 + x / 10, HR=None if x % 3 else 150)
+        act = Activity()
+        act.Laps = [Lap(startTime=start, endTime=lapStart, track=track), Lap(startTime=lapStart, endTime=secondTrack.Timestamp(len(secondTrack) - 1), track=secondTrack)]
+        if waypointLap:
+            act.Laps[1].Waypoints = secondTrack.ToWaypoints()
+        return act
+
+    def test_columns_match_waypoints(self):
+        act = self._activity()
+        columns = ActivityStatisticCalculator._columns(act)
+        wps = ActivityStatisticCalculator._waypointRange(act)
+        self.assertIsNotNone(act.Laps[0].Track) # Shouldn't have been turned into Waypoints
+
+        self.assertAlmostEqual(ActivityStatisticCalculator._distanceColumns(columns), ActivityStatisticCalculator._distanceWaypoints(wps), places=6)
+        self.assertAlmostEqual(ActivityStatisticCalculator._timerTimeColumns(columns).total_seconds(), ActivityStatisticCalculator._timerTimeWaypoints(wps).total_seconds(), places=3)
+        for columnsValue, waypointsValue in zip(ActivityStatisticCalculator._averageMaxHRColumns(columns), ActivityStatisticCalculator._averageMaxHRWaypoints(wps)):
+            self.assertAlmostEqual(columnsValue, waypointsValue, places=6)
+        for columnsValue, waypointsValue in zip(ActivityStatisticCalculator._elevationGainLossColumns(columns), ActivityStatisticCalculator._elevationGainLossWaypoints(wps)):
+            self.assertAlmostEqual(columnsValue, waypointsValue, places=6)
+
+        # Waypoint laps, and ranges, are just looped over
+        self.assertIsNone(ActivityStatisticCalculator._columns(self._activity(waypointLap=True)))
+        flat = act.GetFlatWaypoints()
+        self.assertIsNone(ActivityStatisticCalculator._columns(act, flat[100], flat[600]))
+        self.assertEqual(len(ActivityStatisticCalculator._waypointRange(act, flat[100], flat[600])), 501)
+
+        mixed = self._activity(waypointLap=True)
+        self.assertAlmostEqual(ActivityStatisticCalculator.CalculateDistance(mixed), ActivityStatisticCalculator.CalculateDistance(self._activity()), places=6)
+
+    def test_timer_time(self):
+        start = pytz.utc.localize(datetime(2015, 6, 1, 12, 0, 0))
+        offsets = [0, 10, 20, 30, 200, 210, 220, 300, 310]
+        wps = [Waypoint(start + timedelta(seconds=x), ptType=WaypointType.Pause if x == 220 else WaypointType.Regular) for x in offsets]
+        act = Activity()
+        act.Laps = [Lap(startTime=start, endTime=wps[-1].Timestamp, waypointList=wps)]
+        # 30s, then an implicit pause, 20s, then a pause
+        self.assertEqual(ActivityStatisticCalculator.CalculateTimerTime(act), timedelta(seconds=60))
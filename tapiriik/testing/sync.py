@@ -1,15 +1,33 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
-from tapiriik.sync import SynchronizationTask
+from tapiriik.sync import Sync, SynchronizationTask, SyncPriority
 from tapiriik.sync.activity_record import ActivityRecord
-from tapiriik.services import UserException, UserExceptionType
-from tapiriik.services.api import APIExcludeActivity
+from tapiriik.sync.activity_matcher import ActivityMatcher
+from tapiriik.sync.profiler import SyncProfiler, percentile
+from tapiriik.services import Service, ServiceBase, UserException, UserExceptionType
+from tapiriik.services.api import APIException, APIExcludeActivity
 from tapiriik.services.interchange import Activity, ActivityType
 from tapiriik.auth import User
+from tapiriik.settings import SYNC_PRIORITY_WEIGHTS, SYNC_ADAPTIVE_INTERVAL_MAX_HOURS
 
 from datetime import datetime, timedelta, tzinfo
 import pytz
 import copy
+import bisect
+import random
+
+
+class MockPagedService(ServiceBase):
+    ID = "mockPaged"
+    SupportedActivities = [ActivityType.Rowing]
+
+    def IterActivityList(self, serviceRecord, exhaustive=False):
+        self.PagesListed = 0
+        for page in self.Pages:
+            self.PagesListed += 1
+            if isinstance(page, Exception):
+                raise page
+            yield page, []
 
 
 class UTC(tzinfo):
@@ -324,6 +342,61 @@ class SyncTests(TapiriikTestCase):
 
         self.assertEqual(len(s._activities), 2)
 
+    def test_activity_matcher_equivalence(self):
+        ''' ensure that the activity matcher picks exactly the same existing activities as a scan over the +/- 38hr window '''
+        def reference_match(activities, act):
+            activityStartLeeway = timedelta(minutes=3)
+            activityStartTZOffsetLeeway = timedelta(minutes=1)
+            timezoneErrorPeriod = timedelta(hours=38)
+            start = bisect.bisect_left(activities, act.StartTime + timezoneErrorPeriod)
+            end = bisect.bisect_right(activities, act.StartTime - timezoneErrorPeriod, lo=start)
+            for idx in range(start, end):
+                x = activities[idx]
+                naiveDelta = abs(act.StartTime.replace(tzinfo=None) - x.StartTime.replace(tzinfo=None))
+                hourDelta = abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0))
+                if (x.UID == act.UID or
+                    ((act.StartTime.tzinfo is not None) == (x.StartTime.tzinfo is not None) and abs(act.StartTime - x.StartTime) < activityStartLeeway) or
+                    ((act.StartTime.tzinfo is not None) != (x.StartTime.tzinfo is not None) and naiveDelta < activityStartLeeway) or
+                    (naiveDelta < timezoneErrorPeriod and hourDelta < activityStartTZOffsetLeeway) or
+                    (naiveDelta < timezoneErrorPeriod and timedelta(minutes=30) - (activityStartTZOffsetLeeway / 2) < hourDelta < timedelta(minutes=30) + (activityStartTZOffsetLeeway / 2))) and \
+                   (x.Type == ActivityType.Other or act.Type == ActivityType.Other or x.Type == act.Type or ActivityType.AreVariants([act.Type, x.Type])):
+                    return idx
+            return None
+
+        rng = random.Random(42) # Not the global one - that'd change what every test after this one gets
+        timezones = [None, pytz.utc, pytz.timezone("America/Denver"), pytz.timezone("Asia/Kolkata")]
+        types = [ActivityType.Other, ActivityType.Running, ActivityType.Cycling, ActivityType.MountainBiking]
+
+        def make_activity(startTime):
+            tz = rng.choice(timezones)
+            act = TestTools.create_blank_activity(actType=rng.choice(types))
+            act.StartTime = tz.localize(startTime.replace(tzinfo=None)) if tz else startTime.replace(tzinfo=None)
+            act.CalculateUID()
+            return act
+
+        activities = []
+        reference_activities = []
+        matcher = ActivityMatcher(activities)
+        for x in range(2000):
+            if activities and rng.random() < 0.4:
+                # Something close to an existing activity - a few seconds/minutes off, TZ errors, half-hour TZs, etc.
+                offset = rng.choice([timedelta(seconds=rng.randint(-200, 200)), timedelta(hours=rng.randint(-40, 40)), timedelta(hours=rng.randint(-5, 5), minutes=30, seconds=rng.randint(-40, 40))])
+                act = make_activity(rng.choice(activities).StartTime + offset)
+            else:
+                act = make_activity(datetime(2014, 1, 1) + timedelta(seconds=rng.randint(0, 86400 * 365)))
+
+            expected = reference_match(reference_activities, act)
+            self.assertEqual(matcher.FindMatch(act), expected)
+            if expected is None:
+                bisect.insort_left(reference_activities, act)
+                matcher.Insert(act)
+            else:
+                # Modified the same way for both, since they're the same objects
+                activities[expected].Type = ActivityType.PickMostSpecific([activities[expected].Type, act.Type])
+                matcher.Refresh(expected)
+
+        self.assertEqual([id(x) for x in activities], [id(x) for x in reference_activities])
+
     def test_activity_coalesce(self):
         ''' ensure that activity data is getting coalesced by _accumulateActivities '''
         svcA, svcB = TestTools.create_mock_services()
@@ -396,6 +469,148 @@ class SyncTests(TapiriikTestCase):
         self.assertEqual(s._activities[0].Type, actB.Type)
         self.assertEqual(s._activities[1].Type, actA.Type)
 
+    def test_activity_record_lookup(self):
+        ''' ensure that activity records are found by any of an activity's UIDs, with the earliest record winning '''
+        s = SynchronizationTask(None)
+        s._activityRecords = []
+        for uids in [["a"], ["b", "c"], ["c", "d"]]:
+            rec = ActivityRecord()
+            rec.UIDs = set(uids)
+            s._activityRecords.append(rec)
+        s._indexActivityRecords()
+
+        act = TestTools.create_blank_activity()
+        act.UIDs = set(["x", "d"])
+        self.assertIs(s._findOrCreateActivityRecord(act), s._activityRecords[2])
+        act.UIDs = set(["d", "c"])
+        self.assertIs(s._findOrCreateActivityRecord(act), s._activityRecords[1])
+        self.assertTrue(s._activityRecords[1].Touched)
+
+        # New records are created, and found next time around
+        act.UIDs = set(["e"])
+        rec = s._findOrCreateActivityRecord(act)
+        self.assertEqual(len(s._activityRecords), 4)
+        self.assertIs(s._findOrCreateActivityRecord(act), rec)
+
+        # Records are looked up by their current UIDs after being updated
+        act.UIDs = set(["a", "f"])
+        rec = s._findOrCreateActivityRecord(act)
+        rec.SetActivity(act)
+        s._indexActivityRecord(rec)
+        act.UIDs = set(["f"])
+        self.assertIs(s._findOrCreateActivityRecord(act), s._activityRecords[0])
+        act.UIDs = set(["a"])
+        self.assertIs(s._findOrCreateActivityRecord(act), s._activityRecords[0])
+        self.assertEqual(len(s._activityRecords), 4)
+
+    def test_paged_activity_list(self):
+        ''' ensure that paged listings are only merged once complete - where partial listings stop is up to the service (see ServiceBase._listingHighWaterMark) '''
+        svc = MockPagedService()
+        Service._serviceMappings[svc.ID] = svc
+        rec = TestTools.create_mock_svc_record(svc)
+        svc.Pages = [[], [], []]
+        for x in range(6):
+            act = TestTools.create_blank_activity(svc, ActivityType.Rowing, record=rec)
+            act.StartTime = datetime(2014, 1, 10) - timedelta(days=x)
+            act.EndTime = act.StartTime + timedelta(hours=1)
+            act.CalculateUID()
+            svc.Pages[x // 2].append(act)
+
+        activities, exclusions = svc.DownloadActivityList(rec, True)
+        self.assertEqual(activities, svc.Pages[0] + svc.Pages[1] + svc.Pages[2])
+
+        def list_activities(exhaustive):
+            s = SynchronizationTask(None)
+            s._activities = []
+            s._syncErrors = {rec._id: []}
+            s._syncExclusions = {rec._id: {}}
+            s._excludedServices = {}
+            s._downloadActivityList(rec, exhaustive)
+            return s._activities
+
+        rec.SynchronizedActivities = set([act.UID for act in svc.Pages[1]])
+        self.assertEqual(len(list_activities(True)), 6)
+        self.assertEqual(svc.PagesListed, 3)
+        self.assertEqual(len(list_activities(False)), 6)
+        self.assertEqual(svc.PagesListed, 3)
+
+        # Nothing from a listing that fails part-way through
+        svc.Pages.append(APIException("Listing failed"))
+        self.assertEqual(len(list_activities(True)), 0)
+        self.assertEqual(svc.PagesListed, 4)
+
+    def test_listing_high_water_mark(self):
+        ''' ensure that the listing high-water mark only moves forward, and is ignored by exhaustive listings '''
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        s = SynchronizationTask(None)
+        s._serviceConnections = [recA]
+
+        for startTime in [datetime(2014, 1, 2), pytz.timezone("America/Atikokan").localize(datetime(2014, 1, 3)), datetime(2014, 1, 1)]:
+            act = TestTools.create_blank_activity(svcA, record=recA)
+            act.StartTime = startTime
+            act.CalculateUID()
+            act.UIDs = set([act.UID]) # As _accumulateActivities would have
+            s._markSynchronizedActivities(recA._id, act)
+        self.assertEqual(recA.ListingHighWaterMark["StartTime"], datetime(2014, 1, 3, 5))
+
+        self.assertEqual(svcA._listingHighWaterMark(recA), datetime(2014, 1, 3, 5) - svcA.ListingHighWaterMarkLeeway)
+        self.assertEqual(svcA._listingHighWaterMark(recA, exhaustive=True), None)
+        self.assertEqual(svcA._listingHighWaterMark(TestTools.create_mock_svc_record(svcA)), None)
+
+    def test_sync_priority_lanes(self):
+        ''' ensure that each priority lane is tried first in proportion to its weight, and the rest follow in priority order '''
+        credits = dict((priority, 0) for priority in SyncPriority.All)
+        turns = sum(SYNC_PRIORITY_WEIGHTS.values())
+        firstChoices = dict((priority, 0) for priority in SyncPriority.All)
+        for x in range(turns * 3):
+            order = Sync._priorityQueueOrder(credits)
+            self.assertEqual(sorted(order), sorted(SyncPriority.All))
+            self.assertEqual(order[1:], [priority for priority in SyncPriority.All if priority != order[0]])
+            firstChoices[order[0]] += 1
+        for priority in SyncPriority.All:
+            self.assertEqual(firstChoices[priority], SYNC_PRIORITY_WEIGHTS[priority] * 3)
+
+        self.assertEqual(Sync.NextSyncPriority({"NextSyncPriority": SyncPriority.Manual, "NextSyncIsExhaustive": True}), SyncPriority.Manual)
+        self.assertEqual(Sync.NextSyncPriority({"NextSyncIsExhaustive": True}), SyncPriority.Exhaustive)
+        self.assertEqual(Sync.NextSyncPriority({"NonblockingSyncErrorCount": 1}), SyncPriority.Exhaustive)
+        self.assertEqual(Sync.NextSyncPriority({}), SyncPriority.Periodic)
+
+    def test_adaptive_sync_interval(self):
+        ''' ensure that users who record less often are synchronized less often, within bounds '''
+        now = datetime(2014, 6, 1)
+        maxInterval = timedelta(hours=SYNC_ADAPTIVE_INTERVAL_MAX_HOURS)
+        self.assertEqual(Sync.AdaptiveSyncInterval([], now=now), maxInterval)
+        # Only recent activities count
+        self.assertEqual(Sync.AdaptiveSyncInterval([now - timedelta(days=400), None], now=now), maxInterval)
+
+        daily = Sync.AdaptiveSyncInterval([now - timedelta(days=x) for x in range(30)], now=now)
+        twiceDaily = Sync.AdaptiveSyncInterval([now - timedelta(hours=12 * x) for x in range(60)], now=now)
+        weekly = Sync.AdaptiveSyncInterval([pytz.utc.localize(now - timedelta(days=7 * x)) for x in range(5)], now=now)
+        self.assertTrue(Sync.SyncInterval <= twiceDaily <= daily <= weekly <= maxInterval)
+        self.assertTrue(twiceDaily < weekly)
+        self.assertEqual(Sync.AdaptiveSyncInterval([now - timedelta(minutes=x) for x in range(1000)], now=now), Sync.SyncInterval)
+
+    def test_sync_profiler(self):
+        ''' ensure sync timings are added up per phase and service '''
+        profiler = SyncProfiler()
+        for duration in [1, 2, 3, 4]:
+            profiler.Record("DownloadActivity", "mockA", duration)
+        profiler.Record("DownloadActivity", "mockB", 5)
+        with profiler.Span("FlushWrites"):
+            pass
+        profiler.BeginStep("list")
+        profiler.BeginStep("download")
+        profiler.EndStep()
+
+        spans = dict(((x["Phase"], x["Service"]), x) for x in profiler.Spans())
+        self.assertEqual(set(spans.keys()), set([("DownloadActivity", "mockA"), ("DownloadActivity", "mockB"), ("FlushWrites", None), ("list", None), ("download", None)]))
+        self.assertEqual(spans[("DownloadActivity", "mockA")]["Count"], 4)
+        self.assertEqual(spans[("DownloadActivity", "mockA")]["Time"], 10)
+        self.assertEqual(percentile(spans[("DownloadActivity", "mockA")]["Durations"], 0.5), 3)
+        self.assertEqual(percentile(spans[("DownloadActivity", "mockA")]["Durations"], 0.95), 4)
+        self.assertEqual(percentile([], 0.5), None)
+
     def test_eligibility_excluded(self):
         user = TestTools.create_mock_user()
         svcA, svcB = TestTools.create_mock_services()
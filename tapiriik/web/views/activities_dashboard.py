@@ -1,6 +1,6 @@
 from django.shortcuts import render, redirect
 from django.http import HttpResponse
-from tapiriik.database import db
+from tapiriik.sync.activity_record import ActivityRecordStore
 from tapiriik.settings import WITHDRAWN_SERVICES
 import json
 import datetime
@@ -15,21 +15,21 @@ def activities_fetch_json(req):
         return HttpResponse(status=403)
 
     retrieve_fields = [
-        "Activities.Prescence",
-        "Activities.Abscence",
-        "Activities.Type",
-        "Activities.Name",
-        "Activities.StartTime",
-        "Activities.EndTime",
-        "Activities.Private",
-        "Activities.Stationary",
-        "Activities.FailureCounts"
+        "Prescence",
+        "Abscence",
+        "Type",
+        "Name",
+        "StartTime",
+        "EndTime",
+        "Private",
+        "Stationary",
+        "FailureCounts"
     ]
-    activityRecords = db.activity_records.find_one({"UserID": req.user["_id"]}, dict([(x, 1) for x in retrieve_fields]))
+    activityRecords = ActivityRecordStore.Fetch(req.user["_id"], retrieve_fields)
     if not activityRecords:
         return HttpResponse("[]", content_type="application/json")
     cleanedRecords = []
-    for activity in activityRecords["Activities"]:
+    for activity in activityRecords:
         # Strip down the record since most of this info isn't displayed
         for presence in activity["Prescence"]:
             del activity["Prescence"][presence]["Exception"]
@@ -3,6 +3,7 @@ from django.http import HttpResponse
 from tapiriik.settings import DIAG_AUTH_TOTP_SECRET, DIAG_AUTH_PASSWORD, SITE_VER
 from tapiriik.database import db
 from tapiriik.sync import Sync
+from tapiriik.sync.activity_record import ActivityRecordStore
 from tapiriik.auth import TOTP, DiagnosticsUser, User
 from bson.objectid import ObjectId
 import hashlib
@@ -68,6 +69,10 @@ def diag_queue_dashboard(req):
     context["stalledWorkers"] = [x for x in context["allWorkers"] if x["Heartbeat"] < datetime.utcnow() - stall_timeout]
     context["stalledWorkerPIDs"] = [x["Process"] for x in context["stalledWorkers"]]
 
+    # p50/p95 per sync phase and service over the last hour, from stats_cron.py
+    context["syncTimings"] = stats.get("SyncTimings", []) if stats else []
+    context["httpServices"] = stats.get("HTTPServices", []) if stats else []
+
     delta = False
     if "deleteStalledWorker" in req.POST:
         db.sync_workers.remove({"Process": int(req.POST["pid"])})
@@ -185,7 +190,7 @@ def diag_user(req, user):
     elif "svc_clearexc" in req.POST:
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"ExcludedActivities": 1}})
     elif "svc_clearacts" in req.POST:
-        db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"SynchronizedActivities": 1}})
+        db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"SynchronizedActivities": 1, "ListingHighWaterMark": 1}})
         Sync.SetNextSyncIsExhaustive(userRec, True)
     elif "svc_toggle_poll_sub" in req.POST:
         from tapiriik.services import Service
@@ -199,11 +204,7 @@ def diag_user(req, user):
         from tapiriik.services import Service
         svcRec = Service.GetServiceRecordByID(req.POST["id"])
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$pull": {"SyncErrors": {"Scope": "activity"}}})
-        act_recs = db.activity_records.find_one({"UserID": ObjectId(user)})
-        for act in act_recs["Activities"]:
-            if "FailureCounts" in act and svcRec.Service.ID in act["FailureCounts"]:
-                del act["FailureCounts"][svcRec.Service.ID]
-        db.activity_records.save(act_recs)
+        ActivityRecordStore.ClearFailureCounts(ObjectId(user), svcRec.Service.ID)
     else:
         delta = False
 